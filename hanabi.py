@@ -2,8 +2,17 @@ import sys
 import os
 import random
 import cmd
+import collections
 import cPickle as pickle
 import itertools
+import multiprocessing
+import math
+import struct
+import signal
+import time
+import cProfile
+import pstats
+from array import array
 from collections import defaultdict
 from copy import deepcopy
 from itertools import chain
@@ -11,9 +20,11 @@ from itertools import chain
 VALUES = range(1, 6)
 COLOURS = ("Blue", "Green", "Rainbow", "Red", "Yellow", "White")
 COLOURS_SHORT = dict(zip(COLOURS, ["B", "G", "A", "R", "Y", "W"]))
+COLOUR_INDEX = dict([(c, i) for i, c in enumerate(COLOURS)])
 # The number of each face value, in value order (pad a 0 so that it is
 # indexable by value)
 VALUES_COUNT = (0, 3, 2, 2, 2, 1)
+DECK_SIZE = sum(VALUES_COUNT) * len(COLOURS)
 # The number of cards dealt depending on the number of players
 HAND_COUNT = {2: 5, 3: 5, 4: 4, 5: 4}
 INITIAL_LIVES = 3
@@ -25,13 +36,64 @@ INITIAL_CLUES = 8
 # deck = [card, ...]
 # played = [card, ...]
 # discarded = [card, ...]
-# game = {"players": , "deck": , "played": , "discarded": , "lives": , "clues": }
+# game = {"players": , "deck": , "played": , "discarded": , "lives": , "clues": ,
+#         "fireworks": , "discard_counts": , "clue_index": , "clue_tables": }
+# fireworks = [highest value played, ...] indexed by colour index
+# discard_counts = [[number discarded, ...], ...] indexed by colour index
+#                  then value
+# clue_index = {player id: {card ID: [(move number, from player id,
+#                                      clue_data), ...]}}
+# clue_tables = {player id: {clue_data: (card IDs), ...}} the cards a
+#               clue would touch, for each clue_data in the hand
 # move = {"type": "clue" | "discard" | "play", "data": }
 MOVE_TYPES = ["clue", "discard", "play"]
-# clue data = (player id, clue_data, [card IDs])
+# clue data = (player id, clue_data, (card IDs))
 # clue_data = e.g. "blue" or "4"
 # The card IDs above are added by the game engine, not the user
 # discard data | play data = card_id
+# The engine also takes a move as a (type, data) tuple
+# All the clue_data in the order moves are generated
+CLUES = list(COLOURS) + VALUES
+
+# A compact card packs a card into one small int so that hands, the deck
+# and the piles can be held in arrays and compared with integer
+# operations:
+#
+# compact card = card ID << 6 | colour index << 3 | value
+#
+# The low bits (the "face") are the same for cards that only differ by
+# ID. Colour indices are the position of the colour in COLOURS.
+#
+# This is only an encoding with helpers to convert to and from it. The
+# engine and the strategies still play with (colour, value, id) tuples.
+# Compact cards are used by game_key, the game records, the deal pools
+# (hanabi_deals) and the batch simulator (hanabi_batch).
+CARD_VALUE_MASK = 0x7
+CARD_COLOUR_MASK = 0x7
+CARD_COLOUR_SHIFT = 3
+CARD_ID_SHIFT = 6
+CARD_FACE_MASK = (1 << CARD_ID_SHIFT) - 1
+# array typecode for compact cards, 16 bits is plenty for 60 card IDs
+COMPACT_TYPECODE = "H"
+
+# A game record is the game's seed, number of players and number of
+# moves, then the deck as dealt as compact cards, then the moves. A
+# compact move packs a move into one small int:
+#
+# compact move = move type index << 12 | data
+#
+# where the data is the card ID for a discard or play, or
+# player id << 4 | index of the clue_data in CLUES for a clue. Everything
+# is little endian.
+#
+# A game forfeited for an invalid move (see InvalidMovePolicy) has
+# FORFEIT_MOVE after its moves, which is counted in the number of moves.
+RECORD_HEADER = struct.Struct("<QBH")
+MOVE_TYPE_SHIFT = 12
+MOVE_DATA_MASK = (1 << MOVE_TYPE_SHIFT) - 1
+FORFEIT_MOVE = 0xffff
+CLUE_PLAYER_SHIFT = 4
+CLUE_DATA_MASK = (1 << CLUE_PLAYER_SHIFT) - 1
 
 SEED_FILENAME = "hanabi_seed.dat"
 
@@ -41,37 +103,68 @@ MAX_SCORE = len(VALUES) * len(COLOURS)
 def pct(a, b):
     return (float(a)/b) * 100
 
-def mmm(l, n):
-    """Return the min, mean, and max from the values in `l' based on a
-    population size of `n'."""
-    return (min(l), float(sum(l))/n, max(l))
-
-def create_new_deck():
-    """Returns all cards shuffled"""
+def mmm(l):
+    """Return the min, mean, and max from the values in `l'."""
+    return (min(l), float(sum(l))/len(l), max(l))
+
+def game_seed(master_seed, game_index):
+    """Return the seed for game number `game_index' of a run started
+    from `master_seed'. It only depends on those two numbers so a game
+    gets the same deal whichever process ends up playing it."""
+    return (master_seed << 32) | game_index
+
+def strategy_seed(master_seed, game_index):
+    """Return the seed of the global random module while the players
+    play game number `game_index'. It differs from the game's own seed
+    so the players' random numbers aren't the ones the deal was
+    shuffled with."""
+    return game_seed(master_seed, game_index) | (1 << 64)
+
+def load_master_seed():
+    """Return the master seed of the last run, as saved by `play'."""
+    with open(SEED_FILENAME, "rb") as fh:
+        state = pickle.load(fh)
+    if isinstance(state, tuple):
+        # An older file with the whole state of the random module, which
+        # the master seed was drawn from
+        random.setstate(state)
+        return random.getrandbits(32)
+    return state
+
+def create_new_deck(rng = random):
+    """Returns all cards shuffled by `rng', a random.Random or the
+    random module."""
     cards = [(c, v) for c in COLOURS for v in VALUES for i in xrange(VALUES_COUNT[v])]
-    random.shuffle(cards)
+    rng.shuffle(cards)
     cards = [(c[0], c[1], id) for id, c in enumerate(cards)]
     return cards
 
-def create_new_game(num_players):
+def create_new_game(num_players, deck = None, rng = random):
+    """Deal a new game. `deck' is the deck to deal from, as returned by
+    `create_new_deck', or None to shuffle a new one with `rng'."""
     assert(num_players in HAND_COUNT.keys())
-    deck = create_new_deck()
-    players = defaultdict(list)
-    # Deal out the cards - doesn't seem an nicer way than this to
-    # remove the first n elements
+    if deck is None:
+        deck = create_new_deck(rng)
+    # Deal out the cards, the rest of the deck is a new list so the
+    # `deck' passed in isn't changed
     hc = HAND_COUNT[num_players]
-    for i in xrange(num_players):
-        players[i].extend(deck[0:hc])
-        del deck[0:hc]
+    players = defaultdict(list, [(i, list(deck[i * hc:(i + 1) * hc])) for i in xrange(num_players)])
+    deck = list(deck[num_players * hc:])
 
     return {"players": players,
             "current_player": None,
             "deck": deck,
             "deck_len": len(deck),
+            # The player who drew the last card, once the deck is empty
+            "final_player": None,
             "played": [],
             "discarded": [],
+            "fireworks": [0] * len(COLOURS),
+            "discard_counts": [[0] * len(VALUES_COUNT) for c in COLOURS],
             "lives": INITIAL_LIVES,
             "clues": INITIAL_CLUES,
+            "clue_index": dict([(pid, {}) for pid in players.keys()]),
+            "clue_tables": dict([(pid, clue_table(hand)) for pid, hand in players.iteritems()]),
             "moves": []}
 
 def card_str(c, print_card_id = False):
@@ -95,23 +188,28 @@ def sort_by_colour(d, reverse = False):
 def playable_value(game, colour):
     """Return the value that is playable for the `colour' or None if the
     `colour' is complete."""
-    played_sorted = sort_by_colour(game["played"], True)
-    # First value if no cards of the colour have been played
-    if not colour in played_sorted:
-        return VALUES[0]
-    played_colours = played_sorted[colour]
+    # 0 if no cards of the colour have been played
+    highest = game["fireworks"][COLOUR_INDEX[colour]]
     # Check if that colour is complete
-    if played_colours[0] >= VALUES[-1]:
+    if highest >= VALUES[-1]:
         return None
     # Otherwise return the next value
-    return played_colours[0] + 1
+    return highest + 1
 
 def playable(game, card):
     return (card[1] == playable_value(game, card[0]))
 
+def played_count(game, card):
+    """Return the number of times `card' has been played, i.e. 0 or 1."""
+    return int(card[1] <= game["fireworks"][COLOUR_INDEX[card[0]]])
+
+def discarded_count(game, card):
+    """Return the number of times `card' has been discarded."""
+    return game["discard_counts"][COLOUR_INDEX[card[0]]][card[1]]
+
 def discardable(game, card):
     # First look at whether the card has already been played
-    if hand_has(game["played"], card):
+    if played_count(game, card):
         return True
     
     # Then see if a colour is dead by looking to see if all cards
@@ -119,7 +217,7 @@ def discardable(game, card):
     the_playable_value = playable_value(game, card[0])
 
     # Don't need to pass ID
-    return (hand_has(game["discarded"], (card[0], the_playable_value)) >= VALUES_COUNT[the_playable_value])
+    return (discarded_count(game, (card[0], the_playable_value)) >= VALUES_COUNT[the_playable_value])
 
 def hand_has(hand, other_card):
     """Return the number of times `other_card' is in the `hand'."""
@@ -153,6 +251,137 @@ def get_card_ids(hand, colour_or_value):
     else:
         return get_card_ids_for_value(hand, colour_or_value)
     
+def card_id(card):
+    """Return the ID of a card, which may already be obfuscated to an ID."""
+    if isinstance(card, int):
+        return card
+    return card[2]
+
+def clue_table(hand):
+    """Return the card IDs each clue would touch in the `hand', for
+    just the colours and values in the hand."""
+    table = {}
+    for card in hand:
+        for clue in (card[0], card[1]):
+            if clue in table:
+                table[clue] += (card[2],)
+            else:
+                table[clue] = (card[2],)
+    return table
+
+def pack_card(card):
+    """Return the compact int for the (colour, value, id) `card'."""
+    return (card[2] << CARD_ID_SHIFT) | (COLOUR_INDEX[card[0]] << CARD_COLOUR_SHIFT) | card[1]
+
+def unpack_card(c):
+    """Return the (colour, value, id) card for the compact card `c'."""
+    return (COLOURS[(c >> CARD_COLOUR_SHIFT) & CARD_COLOUR_MASK], c & CARD_VALUE_MASK, c >> CARD_ID_SHIFT)
+
+def pack_face(colour, value):
+    """Return the compact face of a card, i.e. a compact card without
+    the ID."""
+    return (COLOUR_INDEX[colour] << CARD_COLOUR_SHIFT) | value
+
+def pack_cards(cards):
+    return array(COMPACT_TYPECODE, [pack_card(c) for c in cards])
+
+def unpack_cards(cards):
+    return [unpack_card(c) for c in cards]
+
+def compact_game(g):
+    """Return a copy of the game `g' with the hands, deck and piles as
+    arrays of compact cards. The moves are shared with `g'."""
+    cg = dict(g)
+    cg["players"] = dict([(pid, pack_cards(hand)) for pid, hand in g["players"].iteritems()])
+    for key in ("deck", "played", "discarded"):
+        cg[key] = pack_cards(g[key])
+    cg["fireworks"] = list(g["fireworks"])
+    cg["discard_counts"] = [list(counts) for counts in g["discard_counts"]]
+    return cg
+
+def expand_game(cg):
+    """Return a copy of the compact game `cg' with cards as (colour,
+    value, id) tuples again, see `compact_game'."""
+    g = dict(cg)
+    g["players"] = defaultdict(list, [(pid, unpack_cards(hand)) for pid, hand in cg["players"].iteritems()])
+    for key in ("deck", "played", "discarded"):
+        g[key] = unpack_cards(cg[key])
+    g["fireworks"] = list(cg["fireworks"])
+    g["discard_counts"] = [list(counts) for counts in cg["discard_counts"]]
+    return g
+
+def pack_move(move):
+    """Return the compact move for the `move' dict, see RECORD_HEADER."""
+    d = move["data"]
+    if move["type"] == "clue":
+        d = (d[0] << CLUE_PLAYER_SHIFT) | CLUES.index(d[1])
+    return (MOVE_TYPES.index(move["type"]) << MOVE_TYPE_SHIFT) | d
+
+def unpack_move(m):
+    """Return the move dict for the compact move `m', as it would be
+    given by a player, i.e. without the card IDs of a clue."""
+    move_type = MOVE_TYPES[m >> MOVE_TYPE_SHIFT]
+    d = m & MOVE_DATA_MASK
+    if move_type == "clue":
+        d = (d >> CLUE_PLAYER_SHIFT, CLUES[d & CLUE_DATA_MASK])
+    return {"type": move_type, "data": d}
+
+def _little_endian(a):
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+def encode_record(seed, deck, g):
+    """Return the record of the game `g', which was seeded with `seed'
+    and dealt from `deck', as a string of bytes."""
+    moves = array(COMPACT_TYPECODE, [pack_move(m) for p, m in g["moves"]])
+    if g.get("forfeited"):
+        moves.append(FORFEIT_MOVE)
+    return RECORD_HEADER.pack(seed, len(g["players"]), len(moves)) + \
+        _little_endian(pack_cards(deck)).tostring() + _little_endian(moves).tostring()
+
+def decode_record(data, offset = 0):
+    """Return the game record starting at `offset' in the string `data'
+    as a dict with the seed, number of players, deck, moves and whether
+    the game was forfeited, and the offset of the next record."""
+    (seed, num_players, num_moves) = RECORD_HEADER.unpack_from(data, offset)
+    offset += RECORD_HEADER.size
+    cards = array(COMPACT_TYPECODE)
+    moves = array(COMPACT_TYPECODE)
+    for a, n in ((cards, DECK_SIZE), (moves, num_moves)):
+        end = offset + n * a.itemsize
+        a.fromstring(data[offset:end])
+        _little_endian(a)
+        offset = end
+    forfeited = len(moves) > 0 and moves[-1] == FORFEIT_MOVE
+    if forfeited:
+        moves.pop()
+    record = {"seed": seed,
+              "num_players": num_players,
+              "deck": unpack_cards(cards),
+              "moves": [unpack_move(m) for m in moves],
+              "forfeited": forfeited}
+    return (record, offset)
+
+# The hand predicates for code holding compact hands, e.g. from
+# compact_game. The engine doesn't use them. Colours are given by index.
+def compact_hand_has(hand, face):
+    """Return the number of times the compact `face' is in the `hand'."""
+    face &= CARD_FACE_MASK
+    return sum([(c & CARD_FACE_MASK) == face for c in hand])
+
+def compact_hand_has_colour(hand, colour_index):
+    return sum([((c >> CARD_COLOUR_SHIFT) & CARD_COLOUR_MASK) == colour_index for c in hand])
+
+def compact_hand_has_value(hand, value):
+    return sum([(c & CARD_VALUE_MASK) == value for c in hand])
+
+def compact_card_ids_for_colour(hand, colour_index):
+    return [c >> CARD_ID_SHIFT for c in hand if ((c >> CARD_COLOUR_SHIFT) & CARD_COLOUR_MASK) == colour_index]
+
+def compact_card_ids_for_value(hand, value):
+    return [c >> CARD_ID_SHIFT for c in hand if (c & CARD_VALUE_MASK) == value]
+
 def get_player_order(game, current_player):
     """Return a list of player IDs in the order of play from the
     `current_player'."""
@@ -165,10 +394,19 @@ def get_player_order(game, current_player):
     return pids[(current_player + 1)%(length + 1):length] + pids[0:current_player]
 
 def cards_given_clue(game, player):
-    """Return the card IDs for which the `player' was given clues about."""
-    clues = [m for from_player, m in game["moves"] if m["type"] == "clue"]
-    # Flatten
-    return list(chain.from_iterable([clue["data"][2] for clue in clues if clue["data"][0] == player]))
+    """Return the card IDs for which the `player' was given clues about,
+    in the order they were first given a clue."""
+    index = game["clue_index"][player]
+    return sorted(index.keys(), key = lambda id: index[id][0][0])
+
+def was_given_clue(game, player, card_id):
+    """Return whether `player' was given a clue about the card."""
+    return card_id in game["clue_index"][player]
+
+def clues_for_card(game, player, card_id):
+    """Return the clues that `player' was given about the card as a list
+    of (move number, from player ID, clue_data)."""
+    return game["clue_index"][player].get(card_id, [])
 
 def score(game):
     return len(game["played"])
@@ -179,6 +417,24 @@ def have_won(game):
 def have_lost(game):
     return (g["lives"] <= 0)
 
+def game_key(game):
+    """Return a compact, hashable key for the state of the `game'. Two
+    states of a game played from the same deal have the same key when
+    they are the same position, however they were reached: the key
+    holds the current player, clues, lives, deck position, fireworks,
+    the hands as compact cards and what each card in a hand has been
+    told by clues, but not the order of the moves.
+
+    Cards must not be obfuscated, i.e. this is for simulating games.
+    """
+    hands = []
+    for pid in sorted(game["players"].keys()):
+        index = game["clue_index"][pid]
+        hands.append(tuple([(pack_card(c), tuple(sorted(set([clue[2] for clue in index.get(c[2], [])]))))
+                            for c in game["players"][pid]]))
+    return (game["current_player"], game["clues"], game["lives"], game["deck_len"], game["final_player"],
+            tuple(game["fireworks"]), tuple(hands))
+
 def print_moves(moves):
     if len(moves):
         print "<move number>: <from player ID> -> <move>"
@@ -212,19 +468,18 @@ def print_game(g, current_player, print_card_id):
 
     # Print the highest values in each suit
     print "Played:"
-    played_sorted = sort_by_colour(g["played"], True)
-    for c in COLOURS:
-        if c in played_sorted and len(played_sorted[c]):
-            print "%s: %s" % (COLOURS_SHORT[c], played_sorted[c][0])
+    for c, highest in zip(COLOURS, g["fireworks"]):
+        if highest:
+            print "%s: %s" % (COLOURS_SHORT[c], highest)
         else:
             print "%s: ." % COLOURS_SHORT[c]
     
     print
     print "Discarded:"
-    discarded_sorted = sort_by_colour(g["discarded"])
-    for c in COLOURS:
-        if c in discarded_sorted and len(discarded_sorted[c]):
-            print "%s: %s" % (COLOURS_SHORT[c], ", ".join(["%d" % v for v in discarded_sorted[c]]))
+    for c, counts in zip(COLOURS, g["discard_counts"]):
+        discarded = ["%d" % v for v in VALUES for i in xrange(counts[v])]
+        if discarded:
+            print "%s: %s" % (COLOURS_SHORT[c], ", ".join(discarded))
         else:
             print "%s: ." % COLOURS_SHORT[c]
     
@@ -259,12 +514,10 @@ def valid_move(g, p, m):
         if isinstance(d[1], int) and not d[1] in VALUES:
             return (False, "clue data is not a valid value")
         # Don't allow misleading clues
-        if isinstance(d[1], str):
-            if not hand_has_colour(g["players"][d[0]], d[1]):
+        if not d[1] in g["clue_tables"][d[0]]:
+            if isinstance(d[1], str):
                 return (False, "other players hand does not have the colour given in the clue")
-        if isinstance(d[1], int):
-            if not hand_has_value(g["players"][d[0]], d[1]):
-                return (False, "other players hand does not have the value given in the clue")
+            return (False, "other players hand does not have the value given in the clue")
     else:
         if not isinstance(d, int):
             return (False, "discard or play move data is not an int")
@@ -279,96 +532,574 @@ def check_play_move_funcs(num_players, play_move_func):
     # Using callable means it can be a function or class method
     if isinstance(play_move_func, dict):
         for pid, func in play_move_func.iteritems():
-            if isinstance(pid, int):
-                sys.exit("Error: If `play_move_func' is a dictionary then it's keys must be integers.")
+            if not isinstance(pid, int):
+                raise ValueError("If `play_move_func' is a dictionary then it's keys must be integers.")
             if not pid in player_ids:
-                sys.exit("Error: If `play_move_func' is a dictionary then it's keys must be valid player IDs.")
+                raise ValueError("If `play_move_func' is a dictionary then it's keys must be valid player IDs.")
             if not callable(func):
-                sys.exit("Error: Function for player %d is not callable" % pid)
+                raise ValueError("Function for player %d is not callable" % pid)
             play_move_per_player[pid] = func
     elif callable(play_move_func):
         for pid in player_ids:
             play_move_per_player[pid] = play_move_func
     else:
-        sys.exit("Error: `play_move_func' must be a dictionary or a function.")
+        raise ValueError("`play_move_func' must be a dictionary or a function.")
 
     return play_move_per_player
 
-def play_one_turn(g, current_player, play_move, play_move_func_args, memory, obfuscate_game):
-    # Use deep copy because of nested data structures
-    new_g = deepcopy(g)
-    current_players_hand = g["players"][current_player]
-    if obfuscate_game:
-        # Replace the current player's hand from the game state given
-        # to her with just the card IDs
-        new_g["players"][current_player] = [c[2] for c in current_players_hand]
-        # And don't let the player see the deck!
-        new_g["deck"] = []
-        
-    move = play_move(new_g,
-                     current_player,
-                     memory,
-                     play_move_func_args)
+def freeze(x):
+    """Return a read-only view of `x' without copying it. Lists and
+    dicts are wrapped, anything else is immutable already apart from
+    tuples holding lists, e.g. the data of a clue move."""
+    t = type(x)
+    if t is list:
+        return ReadOnlyList(x)
+    if t is dict or t is defaultdict:
+        return ReadOnlyDict(x)
+    if t is tuple:
+        for i in x:
+            if type(i) in (list, dict):
+                return tuple([freeze(i) for i in x])
+    return x
+
+class ReadOnlyList(collections.Sequence):
+    """A list that can be read but not changed. Items are frozen as
+    they are read so nested lists and dicts can't be changed either."""
+    __slots__ = ("_l",)
 
-    (is_valid_move, error_str) = valid_move(g, current_player, move)
-    if not is_valid_move:
-        print "Error %s was not a valid move by player %d because '%s'." % (move, current_player, error_str)
-        print "Game state:"
-        print_game(g, -1, True)
-        print "Moves:"
-        print_moves(g["moves"])
-        sys.exit()
+    def __init__(self, l):
+        self._l = l
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return self.__class__(self._l[i])
+        return freeze(self._l[i])
+
+    def __len__(self):
+        return len(self._l)
+
+    def __iter__(self):
+        return itertools.imap(freeze, self._l)
+
+    def __contains__(self, x):
+        return x in self._l
+
+    def __eq__(self, other):
+        if type(other) is list:
+            return self._l == other
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._l)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self._l, memo)
+
+class FlatList(ReadOnlyList):
+    """A read-only list of immutable items, e.g. a hand, deck or pile of
+    cards. The items don't need freezing, which makes reading these much
+    cheaper."""
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return FlatList(self._l[i])
+        return self._l[i]
+
+    def __iter__(self):
+        return iter(self._l)
+
+class MoveList(ReadOnlyList):
+    """The read-only moves of a game. The data of a move is immutable
+    once it has been played, so only the move dict needs wrapping."""
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        if type(i) is slice:
+            return MoveList(self._l[i])
+        m = self._l[i]
+        return (m[0], MoveView(m[1]))
+
+    def __iter__(self):
+        for m in self._l:
+            yield (m[0], MoveView(m[1]))
+
+class ReadOnlyDict(collections.Mapping):
+    """A dict that can be read but not changed, see `ReadOnlyList'."""
+    __slots__ = ("_d",)
+
+    def __init__(self, d):
+        self._d = d
+
+    def __getitem__(self, key):
+        return freeze(self._d[key])
+
+    def __len__(self):
+        return len(self._d)
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def __repr__(self):
+        return repr(self._d)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(self._d, memo)
+
+class MoveView(ReadOnlyDict):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self._d[key]
 
-    if move["type"] is "clue":
+class PlayersView(ReadOnlyDict):
+    """The players' hands with the hand of `current_player' replaced by
+    just the card IDs."""
+    __slots__ = ("_current_player",)
+
+    def __init__(self, players, current_player):
+        self._d = players
+        self._current_player = current_player
+
+    def __getitem__(self, pid):
+        if pid == self._current_player:
+            return FlatList([c[2] for c in self._d[pid]])
+        return FlatList(self._d[pid])
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __deepcopy__(self, memo):
+        players = defaultdict(list)
+        for pid in self:
+            players[pid] = deepcopy(self[pid], memo)
+        return players
+
+# The game keys that hold a list of immutable items
+FLAT_LIST_KEYS = ("deck", "played", "discarded", "fireworks")
+
+class GameView(ReadOnlyDict):
+    """The game `g' as given to `current_player' for a turn. Nothing is
+    copied when the view is made, reads go straight through to the game
+    but nothing can be changed. With `obfuscate_game' the player's own
+    hand is replaced by card IDs and the deck is hidden, see `play'.
+
+    Use deepcopy to get a plain game dict from a view, e.g. to simulate
+    moves on it.
+    """
+    __slots__ = ("_current_player", "_obfuscate_game")
+
+    def __init__(self, g, current_player, obfuscate_game):
+        self._d = g
+        self._current_player = current_player
+        self._obfuscate_game = obfuscate_game
+
+    def __getitem__(self, key):
+        if key in FLAT_LIST_KEYS:
+            if key == "deck" and self._obfuscate_game:
+                return FlatList([])
+            return FlatList(self._d[key])
+        if key == "moves":
+            return MoveList(self._d["moves"])
+        if key == "players":
+            return PlayersView(self._d["players"],
+                               self._current_player if self._obfuscate_game else None)
+        if key == "clue_tables" and self._obfuscate_game:
+            # The player's own table would give away their hand
+            return ReadOnlyDict(dict([(pid, table) for pid, table in self._d[key].iteritems()
+                                      if pid != self._current_player]))
+        return freeze(self._d[key])
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __deepcopy__(self, memo):
+        return dict([(key, deepcopy(self[key], memo)) for key in self])
+
+def apply_move(g, current_player, move):
+    """Apply the valid `move' by `current_player' to the game `g' in
+    place and pass the turn to the next player. Returns an undo token
+    for `undo_move', which puts the game back exactly as it was. The
+    card IDs are added to the data of a clue `move'. The `move' can also
+    be a (type, data) tuple, as from legal_moves, in which case a move
+    dict is made for it."""
+    if type(move) is tuple:
+        move = {"type": move[0], "data": move[1]}
+    hand = g["players"][current_player]
+    # Enough to undo the move: (player, current player, clues, lives,
+    # move, move data, hand index, card, whether a card was drawn,
+    # previous firework or None if the card was discarded, previous
+    # clue table)
+    token = [current_player, g["current_player"], g["clues"], g["lives"], move, move["data"], None, None, False, None, None]
+
+    if move["type"] == "clue":
         g["clues"] -= 1
         # Add the card IDs for the clue - the user doesn't have to do this
         to_player = move["data"][0]
         clue_type = move["data"][1]
-        move["data"] = (to_player, clue_type, get_card_ids(g["players"][to_player], clue_type))
-    elif move["type"] is "discard":
-        card = [(i, c) for i, c in enumerate(current_players_hand) if c[2] == move["data"]]
-        assert(len(card) == 1)
-        current_players_hand.pop(card[0][0])
-        card = card[0][1]
-        g["discarded"].append(card)
-        # Only pick up if there are cards remaining
-        if g["deck_len"] > 0:
-            current_players_hand.append(g["deck"].pop())
-            g["clues"] += 1
+        move["data"] = (to_player, clue_type, g["clue_tables"][to_player][clue_type])
+        index = g["clue_index"][to_player]
+        for card_id in move["data"][2]:
+            index.setdefault(card_id, []).append((len(g["moves"]), current_player, clue_type))
     else:
-        # Played
-        card = [(i, c) for i, c in enumerate(current_players_hand) if c[2] == move["data"]]
-        assert(len(card) == 1)
-        current_players_hand.pop(card[0][0])
-        card = card[0][1]
-        if playable(g, card):
+        for i, card in enumerate(hand):
+            if card[2] == move["data"]:
+                break
+        else:
+            assert(False)
+        hand.pop(i)
+        token[6], token[7] = i, card
+        ci = COLOUR_INDEX[card[0]]
+        if move["type"] == "play" and playable(g, card):
+            token[9] = g["fireworks"][ci]
             g["played"].append(card)
+            g["fireworks"][ci] = card[1]
             # Extra clue on completing a colour set
             if card[1] == 5:
                 g["clues"] += 1
         else:
-            g["lives"] -= 1
+            if move["type"] == "play":
+                g["lives"] -= 1
             g["discarded"].append(card)
-            # Only pick up if there are cards remaining
+            g["discard_counts"][ci][card[1]] += 1
+        # Only pick up if there are cards remaining
         if g["deck_len"] > 0:
-            current_players_hand.append(g["deck"].pop())
+            hand.append(g["deck"].pop())
+            token[8] = True
+            # Every player but this one has one more turn
+            if not g["deck"]:
+                g["final_player"] = current_player
+            if move["type"] == "discard":
+                g["clues"] += 1
+        token[10] = g["clue_tables"][current_player]
+        g["clue_tables"][current_player] = clue_table(hand)
 
     g["moves"].append((current_player, move))
     g["deck_len"] = len(g["deck"])
+    g["current_player"] = (current_player + 1) % len(g["players"])
+
+    return tuple(token)
+
+def undo_move(g, token):
+    """Undo the move given by the `token' from `apply_move'. Moves must
+    be undone in the reverse order they were applied."""
+    (player, current_player, clues, lives, move, data, i, card, drew, firework, table) = token
+    g["moves"].pop()
+    if move["type"] == "clue":
+        index = g["clue_index"][data[0]]
+        for card_id in move["data"][2]:
+            clues_for_card = index[card_id]
+            clues_for_card.pop()
+            if not clues_for_card:
+                del index[card_id]
+        move["data"] = data
+    else:
+        hand = g["players"][player]
+        if drew:
+            if not g["deck"]:
+                g["final_player"] = None
+            g["deck"].append(hand.pop())
+        hand.insert(i, card)
+        g["clue_tables"][player] = table
+        ci = COLOUR_INDEX[card[0]]
+        if firework is None:
+            g["discarded"].pop()
+            g["discard_counts"][ci][card[1]] -= 1
+        else:
+            g["played"].pop()
+            g["fireworks"][ci] = firework
+    g["clues"] = clues
+    g["lives"] = lives
+    g["current_player"] = current_player
+    g["deck_len"] = len(g["deck"])
+
+def legal_moves(g, p):
+    """Return every legal move of player `p' in the game `g' as (type,
+    data) tuples, which apply_move takes as well as move dicts. The
+    player's hand may be obfuscated to card IDs."""
+    moves = []
+    for card in g["players"][p]:
+        if type(card) is not int:
+            card = card[2]
+        moves.append(("play", card))
+        moves.append(("discard", card))
+    if g["clues"] > 0:
+        for pid, table in g["clue_tables"].iteritems():
+            if pid != p:
+                for clue in CLUES:
+                    if clue in table:
+                        moves.append(("clue", (pid, clue)))
+    return moves
+
+class MoveTimeout(BaseException):
+    """Raised in a strategy that runs over its TimeBudget. It isn't an
+    Exception so that a strategy's `except Exception' doesn't stop it."""
+    pass
+
+class InvalidMoveError(Exception):
+    """Player `player' made the invalid `move' in the game `game' for the
+    `reason' given by valid_move. When raised out of `play' the game's
+    number is in `game_index' and its record up to the move in `record',
+    see encode_record, which can be replayed with
+    hanabi_record.replay_record."""
+    def __init__(self, reason, player, move, game = None):
+        Exception.__init__(self, "%s was not a valid move by player %d because '%s'" % (move, player, reason))
+        self.reason = reason
+        self.player = player
+        self.move = move
+        self.game = game
+        self.move_number = None if game is None else len(game["moves"])
+        self.game_index = None
+        self.record = None
+
+    def __reduce__(self):
+        # The game isn't sent back from a worker, the record has it
+        state = dict(self.__dict__)
+        state["game"] = None
+        return (InvalidMoveError, (self.reason, self.player, self.move), state)
+
+# What `play' can do about an invalid move
+INVALID_MOVE_ACTIONS = ("abort", "forfeit", "substitute")
+
+class InvalidMovePolicy(object):
+    """What to do when a strategy makes an invalid move: "abort" raises
+    an InvalidMoveError out of `play', "forfeit" ends the game there as
+    lost (no lives are left), and "substitute" has the `fallback' move
+    function make a move instead. Pass one to `play' so that a bad move
+    doesn't end a long run.
+
+    `errors' has a dict for every invalid move with the game number,
+    move number, player, move, reason and the record of the game (see
+    encode_record), which replays up to the move with
+    hanabi_record.replay_record.
+    """
+    def __init__(self, action = "abort", fallback = None):
+        assert(action in INVALID_MOVE_ACTIONS)
+        self.action = action
+        self.fallback = fallback if fallback is not None else play_move_random
+        self.errors = []
+        self.game_errors = []
+        self.fallback_memory = {}
+
+    def copy(self):
+        """Return a new InvalidMovePolicy with the same action."""
+        return InvalidMovePolicy(self.action, self.fallback)
+
+    def start_game(self):
+        self.game_errors = []
+        self.fallback_memory = {}
+
+    def end_game(self, game_index, seed, deck, g):
+        if self.game_errors:
+            record = encode_record(seed, deck, g)
+            for error in self.game_errors:
+                error["game"] = game_index
+                error["record"] = record
+            self.errors.extend(self.game_errors)
+            self.game_errors = []
+
+    def merge(self, other):
+        self.errors.extend(other.errors)
+
+    def games(self):
+        """Return the numbers of the games with an invalid move."""
+        return sorted(set([e["game"] for e in self.errors]))
+
+    def handle(self, error, game):
+        """Return the move to make instead of the invalid one in the
+        InvalidMoveError `error', or None to forfeit the game. `game' is
+        what the player was given for the move."""
+        if self.action == "abort":
+            raise error
+        self.game_errors.append({"move_number": error.move_number,
+                                 "player": error.player,
+                                 "move": repr(error.move),
+                                 "reason": error.reason})
+        if self.action == "forfeit":
+            return None
+        return self.fallback(game, error.player, self.fallback_memory.setdefault(error.player, {}), {})
+
+def _raise_move_timeout(signum, frame):
+    raise MoveTimeout()
+
+class TimeBudget(object):
+    """Limits how long the strategies can take: `move_seconds' for any
+    one move and `game_seconds' for all of a player's moves in a game,
+    either of which can be None for no limit. A strategy that runs over
+    is stopped and the `fallback' move function makes its move instead,
+    and once a player has used up their time for the game the fallback
+    makes the rest of their moves. Pass one to `play' to use it, the
+    number of moves made by the fallback is printed with the stats.
+
+    Strategies are stopped with SIGALRM, so this only works in the main
+    thread of a process, which includes the workers of the parallel
+    runner. Elsewhere a move that runs over is only replaced once it
+    has finished. A strategy that is stopped may have left its memory
+    half updated.
+    """
+    def __init__(self, move_seconds = None, game_seconds = None, fallback = None):
+        self.move_seconds = move_seconds
+        self.game_seconds = game_seconds
+        self.fallback = fallback if fallback is not None else play_move_random
+        self.turns = 0
+        self.overruns = 0
+        self.games = 0
+        self.games_over = 0
+        # For the game being played, the seconds each player has used,
+        # the fallback's memory for each player and how many moves ran
+        # over
+        self.used = {}
+        self.fallback_memory = {}
+        self.game_overruns = 0
+
+    def copy(self):
+        """Return a new TimeBudget with the same limits."""
+        return TimeBudget(self.move_seconds, self.game_seconds, self.fallback)
+
+    def start_game(self):
+        self.used = {}
+        self.fallback_memory = {}
+        self.game_overruns = 0
+
+    def end_game(self):
+        self.games += 1
+        if self.game_overruns:
+            self.games_over += 1
+
+    def merge(self, other):
+        """Add in the moves and games of another TimeBudget, e.g. from a
+        worker."""
+        for key in ("turns", "overruns", "games", "games_over"):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+
+    def limit(self, player):
+        """Return the seconds `player' has for their next move, or None."""
+        limits = []
+        if self.move_seconds is not None:
+            limits.append(self.move_seconds)
+        if self.game_seconds is not None:
+            limits.append(self.game_seconds - self.used.get(player, 0.0))
+        return min(limits) if limits else None
+
+    def call(self, play_move, game, current_player, memory, user_args):
+        """Return the move of `play_move', or of the fallback if it runs
+        over."""
+        self.turns += 1
+        limit = self.limit(current_player)
+        move = None
+        timed_out = limit is not None and limit <= 0
+        if not timed_out:
+            start = time.time()
+            alarm = limit is not None and hasattr(signal, "setitimer")
+            if alarm:
+                try:
+                    old_handler = signal.signal(signal.SIGALRM, _raise_move_timeout)
+                except ValueError:
+                    # Not the main thread
+                    alarm = False
+            try:
+                # The timer is stopped inside the try, so if it goes off
+                # just as the move returns it is still caught
+                try:
+                    if alarm:
+                        signal.setitimer(signal.ITIMER_REAL, limit)
+                    move = play_move(game, current_player, memory, user_args)
+                finally:
+                    if alarm:
+                        signal.setitimer(signal.ITIMER_REAL, 0)
+            except MoveTimeout:
+                timed_out = True
+            finally:
+                if alarm:
+                    signal.signal(signal.SIGALRM, old_handler)
+            elapsed = time.time() - start
+            self.used[current_player] = self.used.get(current_player, 0.0) + elapsed
+            if limit is not None and elapsed > limit:
+                timed_out = True
+        if timed_out:
+            self.overruns += 1
+            self.game_overruns += 1
+            move = self.fallback(game, current_player, self.fallback_memory.setdefault(current_player, {}), {})
+        return move
+
+def play_one_turn(g, current_player, play_move, play_move_func_args, memory, obfuscate_game, copy_game = False, profile = None, budget = None, error_policy = None):
+    if profile is not None:
+        t0 = time.time()
+    if copy_game:
+        # Use deep copy because of nested data structures
+        new_g = deepcopy(g)
+        if obfuscate_game:
+            # Replace the current player's hand from the game state given
+            # to her with just the card IDs
+            new_g["players"][current_player] = [c[2] for c in g["players"][current_player]]
+            del new_g["clue_tables"][current_player]
+            # And don't let the player see the deck!
+            new_g["deck"] = []
+    else:
+        new_g = GameView(g, current_player, obfuscate_game)
+    if profile is not None:
+        t1 = time.time()
+
+    if budget is None:
+        move = play_move(new_g,
+                         current_player,
+                         memory,
+                         play_move_func_args)
+    else:
+        move = budget.call(play_move, new_g, current_player, memory, play_move_func_args)
+    if profile is not None:
+        t2 = time.time()
+
+    (is_valid_move, error_str) = valid_move(g, current_player, move)
+    if not is_valid_move:
+        error = InvalidMoveError(error_str, current_player, move, g)
+        if error_policy is None:
+            print "Error %s" % error
+            print "Game state:"
+            print_game(g, -1, True)
+            print "Moves:"
+            print_moves(g["moves"])
+            raise error
+        move = error_policy.handle(error, new_g)
+        if move is None or not valid_move(g, current_player, move)[0]:
+            # Forfeit, so the game ends here as lost. It is marked so its
+            # record can say so, see encode_record
+            g["lives"] = 0
+            g["forfeited"] = True
+            if profile is not None:
+                profile.add_turn(current_player, (t1 - t0, t2 - t1, time.time() - t2, 0.0))
+            return g
+    if profile is not None:
+        t3 = time.time()
+
+    apply_move(g, current_player, move)
+    if profile is not None:
+        profile.add_turn(current_player, (t1 - t0, t2 - t1, t3 - t2, time.time() - t3))
     
     return g
 
-def play_one_game(num_players, play_move_per_player, play_move_func_args, obfuscate_game = True):
-    g = create_new_game(num_players)
+def play_one_game(num_players, play_move_per_player, play_move_func_args, obfuscate_game = True, copy_game = False, deck = None, profile = None, budget = None, error_policy = None):
+    g = create_new_game(num_players, deck)
+    profiler = None
+    if profile is not None:
+        profiler = profile.start_game()
+    if budget is not None:
+        budget.start_game()
+    if error_policy is not None:
+        error_policy.start_game()
 
     # Initial set up
     # Always play from player 0 in ascending order
     player_order = itertools.cycle(sorted(g["players"].keys()))
     # Doesn't matter if the same player always goes first
-    previous_player, current_player = None, next(player_order)
+    current_player = next(player_order)
     g["current_player"] = current_player
-    final_player = None
-    final_round = False
     # Each memory needs to be something so that a reference is passed
     # in to an empty dict. If it is left as None then updates within
     # the player's play_move function can't update a None reference,
@@ -376,25 +1107,374 @@ def play_one_game(num_players, play_move_per_player, play_move_func_args, obfusc
     memory = dict([(pid, {}) for pid in g["players"].keys()])
 
     # Main loop
-    while not game_finished(g, current_player, final_player):
-        # Assign the final player here so she gets a final move
-        if g["deck_len"] <= 0 and not final_round:
-            final_player = previous_player
-            final_round = True
-
+    # Once the last card is drawn apply_move sets the final player, and
+    # the game ends when it is their turn again
+    while not game_finished(g, current_player, g["final_player"]):
         g = play_one_turn(g,
                           current_player,
                           play_move_per_player[current_player],
                           play_move_func_args,
                           memory[current_player],
-                          obfuscate_game)
+                          obfuscate_game,
+                          copy_game,
+                          profile,
+                          budget,
+                          error_policy)
         
-        previous_player, current_player = current_player, next(player_order)
+        current_player = next(player_order)
         g["current_player"] = current_player
 
+    if profile is not None:
+        profile.end_game(profiler)
+    if budget is not None:
+        budget.end_game()
     return g
 
-def play(num_games, num_players, play_move_func, play_move_func_args = {}, load_state = False, obfuscate_game = True):
+def game_stats(g):
+    """Return the stats tuple recorded for a finished game `g'."""
+    return (g["lives"] > 0, score(g), len(g["moves"]), g["clues"], g["lives"])
+
+class RunningStat(object):
+    """The count, min, max, mean and variance of a stream of numbers,
+    kept in constant memory as their count, sum and sum of squares. Two
+    can be merged, e.g. from different workers. The sums of integers,
+    such as the stats of games, are exact, so merging gives exactly the
+    same results whichever way the numbers were split up."""
+    __slots__ = ("n", "total", "total_squares", "min", "max")
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0
+        self.total_squares = 0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        self.total_squares += x * x
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        self.n += other.n
+        self.total += other.total
+        self.total_squares += other.total_squares
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return float(self.total) / self.n if self.n else 0.0
+
+    def variance(self):
+        """Return the sample variance."""
+        if self.n < 2:
+            return 0.0
+        # Only divided once the numerator is worked out from the sums, so
+        # it is exact for integers
+        return max(self.n * self.total_squares - self.total * self.total, 0) / float(self.n * (self.n - 1))
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+    def confidence(self, z = 1.96):
+        """Return the half width of the confidence interval of the mean,
+        95% for the default `z'."""
+        return z * self.stdev() / math.sqrt(self.n) if self.n > 1 else 0.0
+
+    def mmm(self):
+        return (self.min, self.mean, self.max)
+
+# The outcomes of a game: lost games are those where all the lives are
+# lost, finished games are those where the deck runs out without losing
+# all the lives but without the full score, and won games are those
+# where the full score is reached
+OUTCOMES = ("won", "finished", "lost")
+
+def game_outcome(stats):
+    """Return the outcome in OUTCOMES of the stats tuple of a game."""
+    if not stats[0]:
+        return "lost"
+    return "won" if stats[1] == MAX_SCORE else "finished"
+
+class StatsAggregator(object):
+    """Aggregates the stats tuples of games (see game_stats) as they
+    finish, in constant memory. For each outcome it keeps a RunningStat
+    of the score, moves, clues and lives and a histogram of the scores.
+    Two can be merged, e.g. from different workers."""
+    def __init__(self):
+        self.num_games = 0
+        self.start = time.time()
+        self.counts = dict([(o, 0) for o in OUTCOMES])
+        self.columns = dict([(o, dict([(c, RunningStat()) for c in ("score", "moves", "clues", "lives")]))
+                             for o in OUTCOMES])
+        self.histograms = dict([(o, [0] * (MAX_SCORE + 1)) for o in OUTCOMES])
+
+    def add(self, stats):
+        outcome = game_outcome(stats)
+        self.num_games += 1
+        self.counts[outcome] += 1
+        columns = self.columns[outcome]
+        for name, x in zip(("score", "moves", "clues", "lives"), stats[1:]):
+            columns[name].add(x)
+        self.histograms[outcome][stats[1]] += 1
+
+    def merge(self, other):
+        self.num_games += other.num_games
+        for o in OUTCOMES:
+            self.counts[o] += other.counts[o]
+            for name, stat in other.columns[o].iteritems():
+                self.columns[o][name].merge(stat)
+            for score, n in enumerate(other.histograms[o]):
+                self.histograms[o][score] += n
+
+    def score(self):
+        """Return the RunningStat of the score of all the games."""
+        stat = RunningStat()
+        for o in OUTCOMES:
+            stat.merge(self.columns[o]["score"])
+        return stat
+
+    def progress_str(self):
+        elapsed = time.time() - self.start
+        score = self.score()
+        return "After %d games (%.1f games/sec): won %d, finished %d, lost %d, score %.2f +/- %.2f" % \
+            (self.num_games, self.num_games / elapsed if elapsed > 0 else 0.0,
+             self.counts["won"], self.counts["finished"], self.counts["lost"], score.mean, score.confidence())
+
+    def print_summary(self, num_players):
+        num_games = self.num_games
+        (won, finished, lost) = [self.counts[o] for o in OUTCOMES]
+        print "For %d game%s with %d players, stats:" % (num_games, ("s" if num_games > 1 else ""), num_players)
+        print "\tWon: %d (%.2f%%)" % (won, pct(won, num_games))
+        print "\tFinished: %d (%.2f%%)" % (finished, pct(finished, num_games))
+        print "\tLost: %d (%.2f%%)" % (lost, pct(lost, num_games))
+        if won:
+            columns = self.columns["won"]
+            print "\tFor won games, "
+            print "  lives left: %.2f/%.2f/%.2f (min/mean/max)" % columns["lives"].mmm()
+            print "  clues used: %.2f/%.2f/%.2f (min/mean/max)" % columns["clues"].mmm()
+            print "  moves used: %.2f/%.2f/%.2f (min/mean/max)" % columns["moves"].mmm()
+        for o in ("finished", "lost"):
+            if self.counts[o]:
+                score = self.columns[o]["score"]
+                print "\tFor %s games, scores: %.2f/%.2f/%.2f (min/mean/max), sd %.2f, 95%% CI +/- %.2f" % \
+                    ((o,) + score.mmm() + (score.stdev(), score.confidence()))
+        if num_games:
+            score = self.score()
+            print "\tAll scores: mean %.2f, sd %.2f, 95%% CI +/- %.2f" % (score.mean, score.stdev(), score.confidence())
+            histogram = [sum([self.histograms[o][i] for o in OUTCOMES]) for i in xrange(MAX_SCORE + 1)]
+            print "\tScore histogram: %s" % ", ".join(["%d: %d" % (i, n) for i, n in enumerate(histogram) if n])
+
+# The phases of a turn timed by GameProfile
+TURN_PHASES = ("view", "strategy", "validate", "apply")
+# The upper bounds in seconds of the buckets of the strategy latency
+# histogram, the last bucket is everything slower
+LATENCY_BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0)
+
+def duration_str(seconds):
+    """Return e.g. "10us", "1ms" or "2.5s" for the `seconds'."""
+    for scale, unit in ((1.0, "s"), (1e-3, "ms")):
+        if seconds >= scale:
+            return "%g%s" % (seconds / scale, unit)
+    return "%gus" % (seconds * 1e6)
+
+class _SavedProfile(object):
+    # What pstats.Stats needs to load the stats of a profile that has
+    # been pickled
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class GameProfile(object):
+    """Times each phase of every turn (see TURN_PHASES) for each player,
+    and keeps a histogram of how long the strategy took to decide. Pass
+    one to `play' to have a summary printed after the stats.
+
+    With `profile_every' set, one in that many games is also run under
+    cProfile, counted separately in each shard when the games are played
+    across workers. Nothing is timed unless a GameProfile is given, so this
+    costs nothing otherwise.
+    """
+    def __init__(self, profile_every = 0):
+        self.profile_every = profile_every
+        self.games = 0
+        # {player id: [seconds in each phase]}
+        self.player_seconds = {}
+        self.player_turns = {}
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.profiled_games = 0
+        self.profile_stats = None
+
+    def start_game(self):
+        """Return a running cProfile.Profile if this game is sampled."""
+        if self.profile_every and self.games % self.profile_every == 0:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        return None
+
+    def end_game(self, profiler):
+        self.games += 1
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            self.add_profile_stats(profiler.stats)
+            self.profiled_games += 1
+
+    def add_profile_stats(self, stats):
+        if self.profile_stats is None:
+            self.profile_stats = pstats.Stats(_SavedProfile(stats))
+        else:
+            self.profile_stats.add(_SavedProfile(stats))
+
+    def add_turn(self, player, seconds):
+        """Add a turn of `player' that took `seconds' in each phase."""
+        if not player in self.player_seconds:
+            self.player_seconds[player] = [0.0] * len(TURN_PHASES)
+            self.player_turns[player] = 0
+        totals = self.player_seconds[player]
+        for i, t in enumerate(seconds):
+            totals[i] += t
+        self.player_turns[player] += 1
+        strategy = seconds[1]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if strategy < bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.latency_counts[i] += 1
+
+    def merge(self, other):
+        """Add in what another GameProfile has timed, e.g. from a worker."""
+        self.games += other.games
+        for player, seconds in other.player_seconds.iteritems():
+            if not player in self.player_seconds:
+                self.player_seconds[player] = [0.0] * len(TURN_PHASES)
+                self.player_turns[player] = 0
+            for i, t in enumerate(seconds):
+                self.player_seconds[player][i] += t
+            self.player_turns[player] += other.player_turns[player]
+        for i, n in enumerate(other.latency_counts):
+            self.latency_counts[i] += n
+        if other.profile_stats is not None:
+            self.add_profile_stats(other.profile_stats.stats)
+        self.profiled_games += other.profiled_games
+
+    def __getstate__(self):
+        # pstats.Stats holds a stream, so only the stats are pickled
+        state = dict(self.__dict__)
+        if self.profile_stats is not None:
+            state["profile_stats"] = self.profile_stats.stats
+        return state
+
+    def __setstate__(self, state):
+        stats = state["profile_stats"]
+        state["profile_stats"] = None
+        self.__dict__.update(state)
+        if stats is not None:
+            self.add_profile_stats(stats)
+
+    def turns(self):
+        return sum(self.player_turns.values())
+
+    def print_summary(self, num_profile_lines = 20):
+        turns = self.turns()
+        phase_seconds = [sum([seconds[i] for seconds in self.player_seconds.values()]) for i in xrange(len(TURN_PHASES))]
+        total = sum(phase_seconds)
+        print "Timing for %d turns of %d game%s:" % (turns, self.games, ("s" if self.games != 1 else ""))
+        for phase, t in zip(TURN_PHASES, phase_seconds):
+            print "\t%-8s %8.3fs (%6.2f%%) %10.1fus/turn" % (phase, t, pct(t, total) if total else 0.0, 1e6 * t / turns if turns else 0.0)
+        print "\tStrategy time per player:"
+        for player in sorted(self.player_seconds):
+            t = self.player_seconds[player][1]
+            print "\t  P%d: %.3fs over %d turns, %.1fus/turn" % (player, t, self.player_turns[player], 1e6 * t / self.player_turns[player])
+        print "\tStrategy latency:"
+        lower = 0.0
+        for bound, n in zip(LATENCY_BUCKETS + (None,), self.latency_counts):
+            label = (">= " + duration_str(lower)) if bound is None else ("< " + duration_str(bound))
+            print "\t  %-10s %8d (%6.2f%%)" % (label, n, pct(n, turns) if turns else 0.0)
+            lower = bound
+        if self.profile_stats is not None:
+            print "cProfile of %d sampled game%s:" % (self.profiled_games, ("s" if self.profiled_games != 1 else ""))
+            self.profile_stats.sort_stats("cumulative").print_stats(num_profile_lines)
+
+def _play_seeded_game(master_seed, game_index, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game, profile = None, budget = None, error_policy = None, deals = None):
+    # The deal has its own random.Random so it doesn't depend on how many
+    # random numbers the players use, and the players get the global
+    # random module seeded for just this game. A deal pool holds the
+    # same decks already shuffled
+    if deals is not None:
+        deck = deals.deck(game_index)
+    else:
+        deck = create_new_deck(random.Random(game_seed(master_seed, game_index)))
+    random.seed(strategy_seed(master_seed, game_index))
+    seed = game_seed(master_seed, game_index)
+    try:
+        g = play_one_game(num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game, deck, profile, budget, error_policy)
+    except InvalidMoveError as error:
+        error.game_index = game_index
+        error.record = encode_record(seed, deck, error.game)
+        raise
+    if error_policy is not None:
+        error_policy.end_game(game_index, seed, deck, g)
+    return (deck, g)
+
+def replay_game(master_seed, game_index, num_players, play_move_func, play_move_func_args = {}, obfuscate_game = True, copy_game = False):
+    """Return game number `game_index' of a run of `play' started from
+    `master_seed' (see load_master_seed), played again without playing
+    the games before it. The other arguments are as for `play' and must
+    be the same to get the same game."""
+    play_move_per_player = check_play_move_funcs(num_players, play_move_func)
+    return _play_seeded_game(master_seed, game_index, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game)[1]
+
+def play_games(start, stop, master_seed, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game, record = False, profile = None, budget = None, error_policy = None, aggregator = None, deals = None):
+    """Play the games numbered `start' up to (but not including) `stop'
+    and return their stats, their records if `record' is True (see
+    encode_record), the GameProfile `profile' they were timed with, the
+    TimeBudget `budget' they were played under, the InvalidMovePolicy
+    `error_policy' with any invalid moves and the StatsAggregator
+    `aggregator' their stats were added to.
+    Each game is seeded from `master_seed' and its
+    number, so the result doesn't depend on which other games are played
+    in the same process. The decks are taken from the deal pool `deals'
+    if it is given, see hanabi_deals.DealPool."""
+    stats = []
+    records = []
+    for i in xrange(start, stop):
+        (deck, g) = _play_seeded_game(master_seed, i, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game, profile, budget, error_policy, deals)
+        stats.append(game_stats(g))
+        if aggregator is not None:
+            aggregator.add(stats[-1])
+        if record:
+            records.append(encode_record(game_seed(master_seed, i), deck, g))
+    return (stats, records, profile, budget, error_policy, aggregator)
+
+def _play_games_worker(args):
+    # Pool.map only passes a single argument
+    return play_games(*args)
+
+# The most games in a shard, so that long runs come back in pieces and
+# progress can be shown
+MAX_SHARD_SIZE = 1000
+
+def shard_games(num_games, workers):
+    """Split `num_games' into contiguous (start, stop) ranges. There are
+    a few shards per worker so that a worker which gets a run of long
+    games doesn't hold up the others, and no more than MAX_SHARD_SIZE
+    games in a shard."""
+    num_shards = min(num_games, max(workers * 4, -(-num_games // MAX_SHARD_SIZE)))
+    bounds = [(num_games * i) // num_shards for i in xrange(num_shards + 1)]
+    return zip(bounds[:-1], bounds[1:])
+
+def play(num_games, num_players, play_move_func, play_move_func_args = {}, load_state = False, obfuscate_game = True, workers = 1, copy_game = False, record = None, profile = None, time_budget = None, error_policy = None, keep_stats = True, progress_every = 0, deals = None):
     """Call this when you are ready to play, it is the main
     loop. `play_move_func' is either one function that gets called for
     every player, or a dictionary mapping the player ID (starting from
@@ -405,14 +1485,19 @@ def play(num_games, num_players, play_move_func, play_move_func_args = {}, load_
     having to edit the code.
 
     `load_state' allows you to re-run with the same seed as that
-    written out to the file hanabi_seed.dat.
+    written out to the file hanabi_seed.dat. Each game is dealt from
+    its own random.Random seeded from that master seed and the game's
+    number, and the global random module is seeded the same way for the
+    players, so any one game can be played again with `replay_game'.
 
     The `play_move_func' has the following definition:
 
        def play_move(game, current_player, memory, user_args)
     
-    Using the information given, return a valid move. Program will
-    exit if not valid.
+    Using the information given, return a valid move. If it is not
+    valid the game is printed and an InvalidMoveError is raised, unless
+    an `error_policy' is given (see InvalidMovePolicy) to forfeit the
+    game or substitute another move instead and carry on.
 
     You can't declare global variables in order to exchange
     information between players. You can use the `memory' dictionary
@@ -423,58 +1508,138 @@ def play(num_games, num_players, play_move_func, play_move_func_args = {}, load_
     of knowledge as they would in a real game, i.e. they won't see
     their own cards nor will they see the deck. Set this to False when
     you need to full state for simulating games, but don't cheat!
+
+    The `game' given to the `play_move_func' is a read-only view of the
+    real game (see `GameView'), so it is cheap to make each turn but
+    can't be changed. Use deepcopy on it to get a game dict you can
+    modify. Set `copy_game' to True to be given a deep copied game dict
+    instead, as in older versions.
+
+    `workers' is the number of processes to spread the games across. Every
+    game is seeded from a master seed and the game number, so the stats
+    are the same whatever the number of workers. With more than one
+    worker the `play_move_func' and `play_move_func_args' must be
+    picklable, i.e. module level functions rather than lambdas.
+
+    `record' is something with a `write' method, e.g. a
+    hanabi_record.RecordWriter, that is given the record of each game in
+    game order as the games finish, see encode_record.
+
+    `profile' is a GameProfile to time the turns with, the summary of
+    which is printed after the stats.
+
+    `time_budget' is a TimeBudget limiting how long the strategies can
+    take for each move and game, so that a slow strategy can't hold up
+    a run.
+
+    The stats are aggregated as the games finish, see StatsAggregator,
+    with a line of progress printed every `progress_every' games if it
+    is set.
+
+    `deals' is a deal pool (see hanabi_deals.DealPool) to take the decks
+    from rather than shuffling each one, for at least `num_games' games.
+    Its master seed is used in place of a new or loaded one, so the
+    games are the same as those played without the pool.
+
+    Returns the list of stats tuples, one per game, as (lives remaining >
+    0, score, moves, clues, lives). With `keep_stats' False the list
+    isn't kept, so that memory doesn't grow with the number of games,
+    and the StatsAggregator is returned instead.
     """
     # Check if this is a re-run first
-    if load_state:
+    if deals is not None:
+        if len(deals) < num_games:
+            raise ValueError("Deal pool only has %d deals for %d games" % (len(deals), num_games))
+        master_seed = deals.master_seed
+        with open(SEED_FILENAME, "wb") as fh:
+            pickle.dump(master_seed, fh)
+    elif load_state:
         if os.path.exists(SEED_FILENAME):
-            with open(SEED_FILENAME, "rb") as fh:
-                state = pickle.load(fh)
-            random.setstate(state)
+            master_seed = load_master_seed()
         else:
-            sys.exit("Error: load_state set to True, but file '%s' for reading random state not found." % SEED_FILENAME)
+            sys.exit("Error: load_state set to True, but file '%s' for reading the master seed not found." % SEED_FILENAME)
     else:
+        master_seed = random.getrandbits(32)
         with open(SEED_FILENAME, "wb") as fh:
-            pickle.dump(random.getstate(), fh)
+            pickle.dump(master_seed, fh)
     
     # First, work out what function each player uses
     play_move_per_player = check_play_move_funcs(num_players, play_move_func)
 
-    stats = []
-    for i in xrange(num_games):
-        g = play_one_game(num_players, play_move_per_player, play_move_func_args, obfuscate_game)
-        stats.append((g["lives"] > 0, score(g), len(g["moves"]), g["clues"], g["lives"]))
-
-    # Lost games are those where are lives are lost
-    #
-    # Finished games are those where you finish the deck without
-    # losing all lives, but don't attain the full score
-    #
-    # Won games are those the full score has been attained
-    won_games = [s for s in stats if s[0] and s[1] == MAX_SCORE]
-    finished_games = [s for s in stats if s[0] and s[1] != MAX_SCORE]
-    lost_games = [s for s in stats if not s[0]]
-    finished_scores = [s[1] for s in finished_games]
-    lost_scores = [s[1] for s in lost_games]
-    won = len(won_games)
-    finished = len(finished_games)
-    lost = num_games - won - finished
-    print "For %d game%s with %d players, stats:" % (num_games, ("s" if num_games > 1 else ""), num_players)
-    print "\tWon: %d (%.2f%%)" % (won, pct(won, num_games))
-    print "\tFinished: %d (%.2f%%)" % (finished, pct(finished, num_games))
-    print "\tLost: %d (%.2f%%)" % (lost, pct(lost, num_games))
-    if len(won_games):
-        won_lives = [s[4] for s in won_games]
-        won_clues = [s[3] for s in won_games]
-        won_moves = [s[2] for s in won_games]
-        print "\tFor won games, "
-        print "  lives left: %.2f/%.2f/%.2f (min/mean/max)" % mmm(won_lives, num_games)
-        print "  clues used: %.2f/%.2f/%.2f (min/mean/max)" % mmm(won_clues, num_games)
-        print "  moves used: %.2f/%.2f/%.2f (min/mean/max)" % mmm(won_moves, num_games)
-    if len(finished_scores):
-        print "\tFor finished games, scores: %.2f/%.2f/%.2f (min/mean/max)" % mmm(finished_scores, num_games)
-        #TODO: Add how many games completed and with how many lives and clues used
-    if len(lost_scores):
-        print "\tFor lost games, scores: %.2f/%.2f/%.2f (min/mean/max)" % mmm(lost_scores, num_games)
+    aggregator = StatsAggregator()
+    stats = [] if keep_stats else None
+
+    def add_stats(new_stats, num_games_before):
+        if stats is not None:
+            stats.extend(new_stats)
+        if progress_every and aggregator.num_games // progress_every > num_games_before // progress_every:
+            print aggregator.progress_str()
+
+    if workers > 1 and num_games > 1:
+        # Each shard is timed with its own profile, added in below. A
+        # deal pool is pickled as its file name, which each worker maps
+        shards = [(start, stop, master_seed, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game, record is not None,
+                   None if profile is None else GameProfile(profile.profile_every),
+                   None if time_budget is None else time_budget.copy(),
+                   None if error_policy is None else error_policy.copy(),
+                   StatsAggregator(), deals)
+                  for start, stop in shard_games(num_games, workers)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            # imap keeps the shards in order so the stats are in game
+            # order, and gives each shard as it is done so its records
+            # can be written straight away
+            for shard_stats, records, shard_profile, shard_budget, shard_errors, shard_aggregator in pool.imap(_play_games_worker, shards):
+                for r in records:
+                    record.write(r)
+                if profile is not None:
+                    profile.merge(shard_profile)
+                if time_budget is not None:
+                    time_budget.merge(shard_budget)
+                if error_policy is not None:
+                    error_policy.merge(shard_errors)
+                num_games_before = aggregator.num_games
+                aggregator.merge(shard_aggregator)
+                add_stats(shard_stats, num_games_before)
+        except BaseException:
+            # Stop the shards still playing rather than waiting for them
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        # One game at a time so the records are written and the progress
+        # shown as they finish. The games seed the global random module
+        # for the players, so it is put back afterwards to leave it as a
+        # parallel run does
+        random_state = random.getstate()
+        try:
+            for i in xrange(num_games):
+                (one_stats, records, profile, time_budget, error_policy, aggregator) = \
+                    play_games(i, i + 1, master_seed, num_players, play_move_per_player, play_move_func_args, obfuscate_game, copy_game,
+                               record is not None, profile, time_budget, error_policy, aggregator, deals)
+                for r in records:
+                    record.write(r)
+                add_stats(one_stats, i)
+        finally:
+            random.setstate(random_state)
+
+    aggregator.print_summary(num_players)
+    if time_budget is not None:
+        print "\tMoves over the time limit: %d of %d (%.2f%%), in %d game%s" % \
+            (time_budget.overruns, time_budget.turns, pct(time_budget.overruns, time_budget.turns) if time_budget.turns else 0.0,
+             time_budget.games_over, ("s" if time_budget.games_over != 1 else ""))
+    if error_policy is not None and error_policy.errors:
+        num_games_with_errors = len(error_policy.games())
+        print "\tInvalid moves: %d, in %d game%s (%s)" % \
+            (len(error_policy.errors), num_games_with_errors, ("s" if num_games_with_errors != 1 else ""),
+             "forfeited" if error_policy.action == "forfeit" else "substituted")
+    if profile is not None:
+        profile.print_summary()
+
+    return stats if keep_stats else aggregator
 
 ################################################################################        
 # Some standard moves to test with
@@ -602,43 +1767,49 @@ def play_move_manual(game, current_player, memory, user_args):
     else:
         sys.exit()
 
-def create_random_clue(game, current_player, method = 0):
+def create_random_clue(game, current_player, method = 0, rng = random):
     # Make sure it is a valid clue
-    pid = random.choice([pid for pid in game["players"].keys() if pid != current_player])
+    pid = rng.choice([pid for pid in game["players"].keys() if pid != current_player])
     other_hand = game["players"][pid]
     # Picking a card then a colour or value ensures an even
     # distribution, instead of getting the colours and values then
     # picking one, which would skew the distribution towards which
     # colour or value was more frequent
     if method == 0:
-        card = random.choice(other_hand)
-        clue_data = random.choice(card[0:1])
+        card = rng.choice(other_hand)
+        clue_data = rng.choice(card[0:1])
     else:
-        clue_data = random.choice([c[0] for c in other_hand] + [c[1] for c in other_hand])
+        clue_data = rng.choice([c[0] for c in other_hand] + [c[1] for c in other_hand])
 
     return {"type": "clue",
             "data": (pid, clue_data)}
 
 def play_move_random(game, current_player, memory, user_args):
     clue_method = 0
+    # The global random module is seeded for each game by `play', a
+    # "seed" in the user_args gives the player a random.Random of its
+    # own instead
+    rng = random
     if isinstance(user_args, dict):
         if "seed" in user_args:
-            random.seed(user_args["seed"])
+            if not "rng" in memory:
+                memory["rng"] = random.Random(user_args["seed"])
+            rng = memory["rng"]
         if "clue_method" in user_args:
             clue_method = user_args["clue_method"]
     
     my_hand = game["players"][current_player]
 
     if game["clues"] > 0:
-        m = random.choice(MOVE_TYPES)
+        m = rng.choice(MOVE_TYPES)
     else:
-        m = random.choice(["discard", "play"])
+        m = rng.choice(["discard", "play"])
 
     if m == "clue":
-        return create_random_clue(game, current_player, clue_method)
+        return create_random_clue(game, current_player, clue_method, rng)
     else:
-        # Discard or played
-        return {"type": m, "data": random.choice(my_hand)}
+        # Discard or played, the hand is only card IDs when obfuscated
+        return {"type": m, "data": card_id(rng.choice(my_hand))}
 
 if __name__ == "__main__":
     play(10, 3, play_move_random)
@@ -0,0 +1,393 @@
+import numpy as np
+from hanabi import *
+
+# Plays many games in lockstep with the state of every game held in
+# NumPy arrays. Cards are compact cards (see pack_card) and every game
+# takes its turn at the same time, so a turn is a handful of array
+# operations over all the games instead of a Python loop per game.
+#
+# The rules follow play_one_turn and play_one_game exactly, so the same
+# deals and moves give the same stats as the scalar engine.
+#
+# A move for the batch is a tuple of arrays, one entry per game:
+#   (move type, hand slot, clue player, clue colour index, clue value)
+# where the move type indexes MOVE_TYPES, the hand slot is the
+# position of the card in the hand for a discard or play, and a clue
+# has either the colour index or the value set, the other being -1.
+CLUE, DISCARD, PLAY = [MOVE_TYPES.index(t) for t in ("clue", "discard", "play")]
+EMPTY = -1
+
+# Card possibilities are 30 bit masks, one bit per face in the order
+# colour index * len(VALUES) + value - 1
+NUM_FACES = len(COLOURS) * len(VALUES)
+FULL_MASK = (1 << NUM_FACES) - 1
+FACE_BITS = np.array([1 << i for i in xrange(NUM_FACES)], np.uint32)
+COLOUR_MASKS = np.array([((1 << len(VALUES)) - 1) << (ci * len(VALUES)) for ci in xrange(len(COLOURS))], np.uint32)
+VALUE_MASKS = np.array([0] + [sum([1 << (ci * len(VALUES) + v - 1) for ci in xrange(len(COLOURS))]) for v in VALUES], np.uint32)
+FACE_COLOURS = np.array([ci for ci in xrange(len(COLOURS)) for v in VALUES])
+FACE_VALUES = np.array([v for ci in xrange(len(COLOURS)) for v in VALUES])
+FACE_TOTALS = np.array([VALUES_COUNT[v] for ci in xrange(len(COLOURS)) for v in VALUES])
+# The compact faces of a deck before shuffling, in create_new_deck order
+DECK_FACES = np.array([pack_face(c, v) for c in COLOURS for v in VALUES for i in xrange(VALUES_COUNT[v])], np.int16)
+# Number of bits set in each 16 bit number
+POPCOUNT_16 = np.array([bin(i).count("1") for i in xrange(1 << 16)], np.uint8)
+
+def popcount(masks):
+    masks = np.asarray(masks, np.uint32)
+    return POPCOUNT_16[masks & 0xffff].astype(np.int32) + POPCOUNT_16[masks >> 16]
+
+def mask_to_bools(masks):
+    """Return a bool array with an extra last axis of the faces set in
+    the `masks'."""
+    return (np.asarray(masks, np.uint32)[..., None] & FACE_BITS) != 0
+
+def bools_to_mask(bools):
+    return (bools * FACE_BITS).sum(-1).astype(np.uint32)
+
+def card_colours(cards):
+    return (cards >> CARD_COLOUR_SHIFT) & CARD_COLOUR_MASK
+
+def card_values(cards):
+    return cards & CARD_VALUE_MASK
+
+def card_faces(cards):
+    """Return the face index of each compact card, see FACE_BITS."""
+    return card_colours(cards) * len(VALUES) + card_values(cards) - 1
+
+def new_deals(num_games, rng):
+    """Return `num_games' shuffled decks as a (num_games, DECK_SIZE)
+    array of compact cards. Like create_new_deck the card IDs are the
+    position of the card in the deck."""
+    order = np.argsort(rng.random_sample((num_games, DECK_SIZE)), axis = 1)
+    return DECK_FACES[order] | (np.arange(DECK_SIZE, dtype = np.int16) << CARD_ID_SHIFT)
+
+def deal_to_deck(deal):
+    """Return the deck for create_new_game from a row of `new_deals'."""
+    return unpack_cards(np.asarray(deal).tolist())
+
+def deck_to_deal(deck):
+    return np.array([pack_card(c) for c in deck], np.int16)
+
+class BatchGame(object):
+    """The state of `deals.shape[0]' games of `num_players' players,
+    played from the `deals' (see `new_deals')."""
+    def __init__(self, deals, num_players):
+        assert(num_players in HAND_COUNT.keys())
+        n = deals.shape[0]
+        hc = HAND_COUNT[num_players]
+        self.num_games = n
+        self.num_players = num_players
+        self.hand_count = hc
+        self.deals = np.asarray(deals, np.int16)
+        self.hands = self.deals[:, :num_players * hc].reshape(n, num_players, hc).copy()
+        self.hand_size = np.full((n, num_players), hc, np.int16)
+        # What each player knows of their cards from clues, and which
+        # cards have been touched by a clue
+        self.knowledge = np.full((n, num_players, hc), FULL_MASK, np.uint32)
+        self.clued = np.zeros((n, num_players, hc), bool)
+        # The faces ruled out for each player by all the clues given to
+        # them. Like build_possible_hands, cards drawn after a clue still
+        # count as not being touched by it.
+        self.ruled_out = np.zeros((n, num_players), np.uint32)
+        self.deck_len = np.full(n, DECK_SIZE - num_players * hc, np.int16)
+        self.fireworks = np.zeros((n, len(COLOURS)), np.int16)
+        self.discard_counts = np.zeros((n, len(COLOURS), len(VALUES_COUNT)), np.int16)
+        self.clues = np.full(n, INITIAL_CLUES, np.int16)
+        self.lives = np.full(n, INITIAL_LIVES, np.int16)
+        self.num_moves = np.zeros(n, np.int32)
+        self.done = np.zeros(n, bool)
+        self.final_player = np.full(n, EMPTY, np.int16)
+        self.current_player = 0
+        self.previous_player = EMPTY
+
+    def start_turn(self):
+        """Mark the games that have finished before the current player's
+        turn, see game_finished, and return the games still playing."""
+        cp = self.current_player
+        self.done |= (self.lives <= 0) | ((self.deck_len <= 0) & (self.final_player == cp))
+        # Assign the final player so they get a final move
+        final_round = ~self.done & (self.deck_len <= 0) & (self.final_player == EMPTY)
+        self.final_player[final_round] = self.previous_player
+        return ~self.done
+
+    def end_turn(self):
+        self.previous_player = self.current_player
+        self.current_player = (self.current_player + 1) % self.num_players
+
+    def valid_moves(self, moves, rows):
+        """Return whether each of the current player's `moves' is valid
+        in the games `rows', as valid_move decides for one game."""
+        (move_type, slot, clue_player, clue_colour, clue_value) = [np.asarray(a)[rows] for a in moves]
+        cp = self.current_player
+        player_ok = (clue_player >= 0) & (clue_player < self.num_players)
+        colour_ok = (clue_colour >= 0) & (clue_colour < len(COLOURS)) & (clue_value == EMPTY)
+        value_ok = (clue_value >= VALUES[0]) & (clue_value <= VALUES[-1]) & (clue_colour == EMPTY)
+        # Don't allow misleading clues
+        cards = self.hands[rows, np.where(player_ok, clue_player, 0)]
+        touched = (cards != EMPTY) & np.where(colour_ok[:, None],
+                                              card_colours(cards) == clue_colour[:, None],
+                                              card_values(cards) == clue_value[:, None])
+        clue_ok = (self.clues[rows] > 0) & player_ok & (colour_ok | value_ok) & touched.any(1)
+        card_ok = (move_type >= 0) & (move_type < len(MOVE_TYPES)) & (slot >= 0) & (slot < self.hand_size[rows, cp])
+        return np.where(move_type == CLUE, clue_ok, card_ok)
+
+    def apply(self, moves, active):
+        """Apply the current player's `moves' to the `active' games. The
+        moves are checked with valid_moves unless assertions are off."""
+        (move_type, slot, clue_player, clue_colour, clue_value) = moves
+        cp = self.current_player
+        rows = np.nonzero(active)[0]
+        assert(self.valid_moves(moves, rows).all())
+        mt = move_type[rows]
+
+        clue_rows = rows[mt == CLUE]
+        if len(clue_rows):
+            self.apply_clues(clue_rows, clue_player[clue_rows], clue_colour[clue_rows], clue_value[clue_rows])
+
+        card_rows = rows[mt != CLUE]
+        if len(card_rows):
+            s = slot[card_rows]
+            cards = self.hands[card_rows, cp, s]
+            assert((cards != EMPTY).all())
+            self.remove_cards(card_rows, s)
+            colours = card_colours(cards)
+            values = card_values(cards)
+
+            discard = (mt[mt != CLUE] == DISCARD)
+            playable = (values == self.fireworks[card_rows, colours] + 1) & ~discard
+            # Only pick up a clue if there are cards remaining
+            self.clues[card_rows] += (discard & (self.deck_len[card_rows] > 0)) | (playable & (values == VALUES[-1]))
+            self.lives[card_rows] -= (~discard & ~playable)
+            self.fireworks[card_rows[playable], colours[playable]] = values[playable]
+            self.discard_counts[card_rows[~playable], colours[~playable], values[~playable]] += 1
+
+            self.draw_cards(card_rows[self.deck_len[card_rows] > 0])
+
+        self.num_moves[rows] += 1
+
+    def apply_clues(self, rows, players, colours, values):
+        cards = self.hands[rows, players]
+        attr_masks = np.where(colours >= 0, COLOUR_MASKS[colours], VALUE_MASKS[np.maximum(values, 0)])
+        touched = (cards != EMPTY) & np.where((colours >= 0)[:, None],
+                                              card_colours(cards) == colours[:, None],
+                                              card_values(cards) == values[:, None])
+        knowledge = self.knowledge[rows, players]
+        self.knowledge[rows, players] = np.where(touched, knowledge & attr_masks[:, None], knowledge & ~attr_masks[:, None])
+        self.clued[rows, players] |= touched
+        self.ruled_out[rows, players] |= attr_masks
+        self.clues[rows] -= 1
+
+    def remove_cards(self, rows, slots):
+        """Remove the cards at `slots' from the current player's hand,
+        shifting the later cards down like list.pop."""
+        cp = self.current_player
+        j = np.arange(self.hand_count)
+        src = np.minimum(j + (j >= slots[:, None]), self.hand_count - 1)
+        for a in (self.hands, self.knowledge, self.clued):
+            a[rows, cp] = np.take_along_axis(a[rows, cp], src, 1)
+        last = self.hand_size[rows, cp] - 1
+        self.hands[rows, cp, last] = EMPTY
+        self.knowledge[rows, cp, last] = FULL_MASK
+        self.clued[rows, cp, last] = False
+        self.hand_size[rows, cp] = last
+
+    def draw_cards(self, rows):
+        """Draw a card into the end of the current player's hand. Like
+        list.pop the cards are drawn from the end of the deck."""
+        cp = self.current_player
+        pos = self.hand_size[rows, cp]
+        self.hands[rows, cp, pos] = self.deals[rows, self.num_players * self.hand_count + self.deck_len[rows] - 1]
+        self.knowledge[rows, cp, pos] = FULL_MASK & ~self.ruled_out[rows, cp]
+        self.clued[rows, cp, pos] = False
+        self.hand_size[rows, cp] = pos + 1
+        self.deck_len[rows] -= 1
+
+    def scores(self):
+        return self.fireworks.sum(1)
+
+    def stats(self):
+        """Return the stats tuple of each game, as returned by play()."""
+        return [(bool(l > 0), int(s), int(m), int(c), int(l))
+                for l, s, m, c in zip(self.lives, self.scores(), self.num_moves, self.clues)]
+
+    def other_players(self):
+        """Return the other players in order of play from the current
+        player, see get_player_order."""
+        return [(self.current_player + i) % self.num_players for i in xrange(1, self.num_players)]
+
+    def valid_slots(self, player):
+        return np.arange(self.hand_count) < self.hand_size[:, player, None]
+
+    def playable_mask(self):
+        """Return the faces that are playable in each game."""
+        fw = self.fireworks
+        bits = (FACE_VALUES == fw[:, FACE_COLOURS] + 1)
+        return bools_to_mask(bits)
+
+    def discardable_mask(self):
+        """Return the faces that are discardable in each game, see
+        discardable."""
+        n = self.num_games
+        fw = self.fireworks[:, FACE_COLOURS]
+        played = (FACE_VALUES <= fw)
+        # A colour is dead once all the cards of its playable value are
+        # discarded
+        next_value = np.minimum(self.fireworks + 1, VALUES[-1])
+        next_discarded = self.discard_counts[np.arange(n)[:, None], np.arange(len(COLOURS)), next_value]
+        dead = (next_discarded >= np.array(VALUES_COUNT)[next_value]) & (self.fireworks < VALUES[-1])
+        return bools_to_mask(played | dead[:, FACE_COLOURS])
+
+    def face_counts(self, players):
+        """Return the number of each face in the hands of `players'."""
+        n = self.num_games
+        counts = np.zeros((n, NUM_FACES), np.int32)
+        for p in players:
+            valid = self.hands[:, p] != EMPTY
+            rows = np.nonzero(valid)[0]
+            np.add.at(counts, (rows, card_faces(self.hands[:, p][valid])), 1)
+        return counts
+
+    def critical_mask(self, discardable_mask):
+        """Return the faces that are still needed and have only one copy
+        left in each game, see hanabi_dgraham.critical_mask."""
+        discarded = self.discard_counts[:, FACE_COLOURS, FACE_VALUES]
+        return bools_to_mask(~mask_to_bools(discardable_mask) & (discarded == FACE_TOTALS - 1))
+
+    def unseen_counts(self, player):
+        """Return how many of each face `player' hasn't seen in each
+        game."""
+        others = [p for p in xrange(self.num_players) if p != player]
+        fw = self.fireworks[:, FACE_COLOURS]
+        discarded = self.discard_counts[:, FACE_COLOURS, FACE_VALUES]
+        return FACE_TOTALS - self.face_counts(others) - (FACE_VALUES <= fw) - discarded
+
+    def possibilities(self, player):
+        """Return what each card in `player's hand could be from their
+        perspective, combining their clues with what is left unseen, see
+        build_possible_hands."""
+        return self.knowledge[:, player] & bools_to_mask(self.unseen_counts(player) > 0)[:, None]
+
+def play_batch(num_games, num_players, policy, policy_args = {}, deals = None, seed = None):
+    """Play `num_games' games in lockstep and return the stats tuple of
+    each game as play() does. The `policy' is called once per turn as
+    policy(batch, rng, policy_args) and returns a move for every game,
+    see batch_move_random. `deals' are the decks to play, see
+    new_deals, otherwise they are shuffled from `seed'."""
+    rng = np.random.RandomState(seed)
+    if deals is None:
+        deals = new_deals(num_games, rng)
+    batch = BatchGame(deals, num_players)
+    while True:
+        active = batch.start_turn()
+        if not active.any():
+            break
+        batch.apply(policy(batch, rng, policy_args), active)
+        batch.end_turn()
+    return batch.stats()
+
+################################################################################
+# Vectorized versions of the standard moves
+#
+# batch_move_random - play_move_random for every game
+# batch_play_move   - the rules of hanabi_dgraham.play_move for every game
+################################################################################
+def random_slots(rng, hand_size):
+    return (rng.random_sample(hand_size.shape) * hand_size).astype(np.int16)
+
+def random_clues(batch, rng):
+    """Return a random colour clue for every game, see create_random_clue."""
+    n = batch.num_games
+    players = ((batch.current_player + rng.randint(1, batch.num_players, n)) % batch.num_players).astype(np.int16)
+    rows = np.arange(n)
+    cards = batch.hands[rows, players, random_slots(rng, batch.hand_size[rows, players])]
+    return players, card_colours(cards).astype(np.int16)
+
+def batch_move_random(batch, rng, args = None):
+    n = batch.num_games
+    move_type = np.where(batch.clues > 0, rng.randint(0, 3, n), rng.randint(1, 3, n))
+    slot = random_slots(rng, batch.hand_size[:, batch.current_player])
+    clue_player, clue_colour = random_clues(batch, rng)
+    return (move_type, slot, clue_player, clue_colour, np.full(n, EMPTY, np.int16))
+
+def first_true(bools):
+    """Return the index of the first True in each row and whether there
+    was one."""
+    return bools.argmax(1), bools.any(1)
+
+def batch_play_move(batch, rng, args = {}):
+    clue_algorithm = args.get("clue_algorithm", 0)
+    discard_algorithm = args.get("discard_algorithm", 0)
+    n = batch.num_games
+    rows = np.arange(n)
+    cp = batch.current_player
+    valid = batch.valid_slots(cp)
+
+    possible = batch.possibilities(cp)
+    num_possible = popcount(possible)
+    playable_mask = batch.playable_mask()[:, None]
+    discardable_mask = batch.discardable_mask()[:, None]
+    num_playable = popcount(possible & playable_mask)
+    num_discardable = popcount(possible & discardable_mask)
+    maybe_playable = valid & (num_playable > 0)
+    maybe_discardable = valid & (num_discardable > 0)
+    definitely_playable = maybe_playable & ((num_playable == num_possible) | batch.clued[:, cp])
+    definitely_discardable = maybe_discardable & (num_discardable == num_possible)
+
+    move_type = np.full(n, DISCARD, np.int16)
+    slot = random_slots(rng, batch.hand_size[:, cp])
+    clue_player, clue_colour = random_clues(batch, rng)
+    clue_value = np.full(n, EMPTY, np.int16)
+
+    # Play the first card known to be playable
+    play_slot, play = first_true(definitely_playable)
+    move_type[play] = PLAY
+    slot[play] = play_slot[play]
+
+    # Otherwise give a clue about a playable card in another hand
+    clue = ~play & (batch.clues > 0)
+    move_type[clue] = CLUE
+    others = batch.other_players()
+    hands = batch.hands[:, others]
+    playable_cards = (hands != EMPTY) & ((mask_to_bools(playable_mask[:, 0])[rows[:, None, None], card_faces(hands) % NUM_FACES]))
+    values = np.where(playable_cards, card_values(hands), VALUES[-1] + 1)
+    any_playable = playable_cards.any(2).any(1) & clue
+    flat = playable_cards.reshape(n, -1)
+    if clue_algorithm == 1:
+        i, _ = first_true(flat)
+    elif clue_algorithm == 2:
+        i = values.reshape(n, -1).argmin(1)
+    elif clue_algorithm == 3:
+        k, _ = first_true(playable_cards.any(2))
+        i = k * batch.hand_count + values[rows, k].argmin(1)
+    if clue_algorithm in (1, 2, 3):
+        k, j = i // batch.hand_count, i % batch.hand_count
+        cards = hands[rows, k, j]
+        clue_player[any_playable] = np.array(others, np.int16)[k[any_playable]]
+        if clue_algorithm == 1:
+            clue_value[any_playable] = card_values(cards[any_playable])
+            clue_colour[any_playable] = EMPTY
+        else:
+            clue_colour[any_playable] = card_colours(cards[any_playable])
+
+    # Otherwise discard
+    discard = ~play & ~clue
+    discard_slot, certain = first_true(definitely_discardable)
+    certain &= discard
+    slot[certain] = discard_slot[certain]
+    if discard_algorithm == 1:
+        # The card most likely to be discardable, then least likely to be
+        # critical or playable, every unseen copy of what it could be
+        # being as likely (see hanabi_dgraham.ProbabilityEngine)
+        weights = mask_to_bools(possible) * batch.unseen_counts(cp)[:, None, :]
+        total = np.maximum(weights.sum(2), 1).astype(float)
+        critical_mask = batch.critical_mask(discardable_mask[:, 0])[:, None]
+        prob_playable, prob_discardable, prob_critical = \
+            [(weights * mask_to_bools(m)).sum(2) / total for m in (playable_mask, discardable_mask, critical_mask)]
+        best = valid.copy()
+        for k in (prob_discardable, -prob_critical, -prob_playable):
+            k = np.where(best, k, -np.inf)
+            best &= (k == k.max(1)[:, None])
+        best_slot, _ = first_true(best)
+        slot[discard & ~certain] = best_slot[discard & ~certain]
+
+    return (move_type, slot, clue_player, clue_colour, clue_value)
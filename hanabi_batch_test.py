@@ -0,0 +1,144 @@
+import unittest
+import random
+import numpy as np
+from hanabi import *
+from hanabi_batch import *
+import hanabi_dgraham
+
+def replay_policy(games):
+    """Return a batch policy that replays the moves of the scalar `games'."""
+    def policy(batch, rng, args):
+        n = batch.num_games
+        cp = batch.current_player
+        moves = [np.zeros(n, np.int16), np.zeros(n, np.int16), np.zeros(n, np.int16),
+                 np.full(n, EMPTY, np.int16), np.full(n, EMPTY, np.int16)]
+        for i, g in enumerate(games):
+            if batch.done[i]:
+                continue
+            player, m = g["moves"][batch.num_moves[i]]
+            assert(player == cp)
+            moves[0][i] = MOVE_TYPES.index(m["type"])
+            if m["type"] == "clue":
+                moves[2][i] = m["data"][0]
+                if isinstance(m["data"][1], str):
+                    moves[3][i] = COLOUR_INDEX[m["data"][1]]
+                else:
+                    moves[4][i] = m["data"][1]
+            else:
+                ids = list(batch.hands[i, cp] >> CARD_ID_SHIFT)
+                moves[1][i] = ids.index(m["data"])
+        return tuple(moves)
+    return policy
+
+def scalar_rank(g, cp, card_id, args):
+    """Return how the scalar hanabi_dgraham.play_move rates playing or
+    discarding the card of `cp' in the game `g' from what they know,
+    as (definitely playable, definitely discardable, discard order), the
+    discard order being None unless discard algorithm 1 is used."""
+    view = GameView(g, cp, True)
+    possible = hanabi_dgraham.build_possible_hands(view, cp)[cp][card_id]
+    # A card that can't be anything is neither
+    num_playable = len(possible & hanabi_dgraham.playable_mask(view))
+    num_discardable = len(possible & hanabi_dgraham.discardable_mask(view))
+    playable = num_playable > 0 and (num_playable == len(possible) or was_given_clue(view, cp, card_id))
+    discardable = num_discardable > 0 and num_discardable == len(possible)
+    order = None
+    if args["discard_algorithm"] == 1:
+        engine = hanabi_dgraham.ProbabilityEngine()
+        p = engine.probabilities(view, {card_id: possible.mask}, hanabi_dgraham.unseen_counts(view, cp))[card_id]
+        order = tuple([round(x, 9) for x in (p[1], -p[2], -p[0])])
+    return (playable, discardable, order)
+
+def checked_policy(test, games, deals, args):
+    """Return a batch policy that replays the moves hanabi_dgraham.play_move
+    made in the scalar `games' of the `deals', checking each time that
+    batch_play_move would make the same move or one the scalar bot rates
+    the same. Only the random choices of the bots may differ."""
+    replay = replay_policy(games)
+    # The scalar games played along with the batch
+    replays = [create_new_game(len(g["players"]), deal_to_deck(deal)) for g, deal in zip(games, deals)]
+    def policy(batch, rng, policy_args):
+        cp = batch.current_player
+        moves = batch_play_move(batch, rng, args)
+        for i, (g, r) in enumerate(zip(games, replays)):
+            if batch.done[i]:
+                continue
+            r["current_player"] = cp
+            m = g["moves"][batch.num_moves[i]][1]
+            move_type, slot, clue_player, clue_colour, clue_value = [int(a[i]) for a in moves]
+            test.assertEqual(MOVE_TYPES[move_type], m["type"])
+            if m["type"] == "clue":
+                others_playable = any([playable(r, c) for p in r["players"] if p != cp for c in r["players"][p]])
+                if args["clue_algorithm"] and others_playable:
+                    clue = COLOURS[clue_colour] if clue_colour != EMPTY else clue_value
+                    test.assertEqual((clue_player, clue), m["data"][0:2])
+                apply_move(r, cp, {"type": "clue", "data": m["data"][0:2]})
+            else:
+                card_id = int(batch.hands[i, cp, slot]) >> CARD_ID_SHIFT
+                (scalar_playable, scalar_discardable, scalar_order) = scalar_rank(r, cp, m["data"], args)
+                (batch_playable, batch_discardable, batch_order) = scalar_rank(r, cp, card_id, args)
+                if m["type"] == "play":
+                    test.assertTrue(scalar_playable and batch_playable)
+                else:
+                    test.assertEqual(batch_discardable, scalar_discardable)
+                    if not scalar_discardable and scalar_order is not None:
+                        test.assertEqual(batch_order, scalar_order)
+                apply_move(r, cp, {"type": m["type"], "data": m["data"]})
+        return replay(batch, rng, policy_args)
+    return policy
+
+class BatchGameTest(unittest.TestCase):
+
+    def testSameStatsAsScalarEngine(self):
+        random.seed(0)
+        deals = new_deals(50, np.random.RandomState(0))
+        for num_players in HAND_COUNT.keys():
+            play_move_per_player = check_play_move_funcs(num_players, play_move_random)
+            games = [play_one_game(num_players, play_move_per_player, {}, deck = deal_to_deck(deal))
+                     for deal in deals]
+            stats = play_batch(len(deals), num_players, replay_policy(games), deals = deals)
+            self.assertEqual(stats, [game_stats(g) for g in games])
+
+    def testPoliciesPlayValidMoves(self):
+        for num_players in HAND_COUNT.keys():
+            stats = play_batch(100, num_players, batch_move_random, seed = 0)
+            self.assertEqual(len(stats), 100)
+            for ca in xrange(4):
+                for da in xrange(2):
+                    stats = play_batch(100, num_players, batch_play_move,
+                                       {"clue_algorithm": ca, "discard_algorithm": da}, seed = 0)
+                    self.assertTrue(all([0 <= s[1] <= MAX_SCORE for s in stats]))
+
+    def testSameMovesAsScalarBot(self):
+        random.seed(0)
+        deals = new_deals(5, np.random.RandomState(0))
+        for num_players in HAND_COUNT.keys():
+            play_move_per_player = check_play_move_funcs(num_players, hanabi_dgraham.play_move)
+            for ca in xrange(4):
+                for da in xrange(2):
+                    args = {"clue_algorithm": ca, "discard_algorithm": da}
+                    games = [play_one_game(num_players, play_move_per_player, args, deck = deal_to_deck(deal))
+                             for deal in deals]
+                    stats = play_batch(len(deals), num_players, checked_policy(self, games, deals, args), deals = deals)
+                    self.assertEqual(stats, [game_stats(g) for g in games])
+
+    def testInvalidMovesRejected(self):
+        deals = new_deals(2, np.random.RandomState(0))
+        batch = BatchGame(deals, 3)
+        active = batch.start_turn()
+        n = batch.num_games
+        def moves(move_type, slot = 0, clue_player = 1, clue_colour = EMPTY, clue_value = EMPTY):
+            return tuple([np.full(n, x, np.int16) for x in (move_type, slot, clue_player, clue_colour, clue_value)])
+        colours = card_colours(batch.hands[:, 1, 0])
+        good = moves(CLUE, clue_colour = 0)
+        good[3][:] = colours
+        self.assertTrue(batch.valid_moves(good, np.nonzero(active)[0]).all())
+        for bad in (moves(PLAY, slot = batch.hand_count), moves(DISCARD, slot = -1), moves(3),
+                    moves(CLUE), moves(CLUE, clue_player = 3, clue_value = 1),
+                    moves(CLUE, clue_colour = 0, clue_value = 1), moves(CLUE, clue_value = 6)):
+            self.assertRaises(AssertionError, batch.apply, bad, active)
+        batch.clues[:] = 0
+        self.assertRaises(AssertionError, batch.apply, good, active)
+
+if __name__ == '__main__':
+    unittest.main()
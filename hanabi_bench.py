@@ -0,0 +1,216 @@
+import sys
+import json
+import time
+import platform
+import random
+from copy import deepcopy
+from hanabi import *
+import hanabi_dgraham
+
+# Benchmarks of the engine and the bots. Each benchmark is timed a few
+# times and the best rate is kept, since anything else running on the
+# machine only ever makes a run slower.
+#
+# results = {name: {"rate": per second, "unit": what is counted,
+#                   "seconds": best time, "count": how many were timed}}
+
+BENCH_SEED = 1
+PLAYER_COUNTS = sorted(HAND_COUNT.keys())
+# A benchmark is a regression if its rate drops by more than this
+# fraction of the baseline
+DEFAULT_THRESHOLD = 0.1
+# The benchmarks timed over sample_positions
+MICRO_BENCHMARKS = ["play_one_turn", "build_possible_hands", "playable_value", "discardable",
+                    "all_moves", "simulate", "valid_move"]
+
+def wanted(names, only):
+    return only is None or any([only in name for name in names])
+
+def best_time(func, repeat):
+    """Return the shortest of `repeat' timings of calling `func'."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def result(seconds, count, unit):
+    return {"rate": count / seconds if seconds > 0 else float("inf"),
+            "unit": unit,
+            "seconds": seconds,
+            "count": count}
+
+def bench_games(num_games, repeat, only = None):
+    """Time whole games of play_move_random and hanabi_dgraham.play_move
+    for each number of players, by games and by turns per second. Each
+    timing starts from an empty ProbabilityEngine so it doesn't depend
+    on what was run before it."""
+    results = {}
+    bots = (("random", play_move_random, lambda: {}),
+            ("dgraham", hanabi_dgraham.play_move,
+             lambda: {"clue_algorithm": 1, "discard_algorithm": 1, "probability_engine": hanabi_dgraham.ProbabilityEngine()}))
+    for name, func, new_args in bots:
+        for num_players in PLAYER_COUNTS:
+            names = ["%s/%s/%dp" % (unit, name, num_players) for unit in ("games", "turns")]
+            if not wanted(names, only):
+                continue
+            play_move_per_player = check_play_move_funcs(num_players, func)
+            turns = []
+
+            def run():
+                del turns[:]
+                args = new_args()
+                for i in xrange(num_games):
+                    random.seed(game_seed(BENCH_SEED, i))
+                    g = play_one_game(num_players, play_move_per_player, dict(args))
+                    turns.append(len(g["moves"]))
+
+            seconds = best_time(run, repeat)
+            results[names[0]] = result(seconds, num_games, "games")
+            results[names[1]] = result(seconds, sum(turns), "turns")
+    return results
+
+def sample_positions(num_games, num_players = 3):
+    """Return the positions of `num_games' games of play_move_random as
+    (game, current player) pairs, one for every turn."""
+    play_move_per_player = check_play_move_funcs(num_players, play_move_random)
+    positions = []
+    for i in xrange(num_games):
+        random.seed(game_seed(BENCH_SEED, i))
+        g = create_new_game(num_players)
+        g["current_player"] = 0
+        while not game_finished(g, g["current_player"], None):
+            cp = g["current_player"]
+            positions.append((deepcopy(g), cp))
+            apply_move(g, cp, play_move_random(GameView(g, cp, True), cp, {}, {}))
+    return positions
+
+def bench_micro(positions, repeat, only = None):
+    """Time the engine and bot functions over the `positions', by calls
+    per second."""
+    results = {}
+    views = [(GameView(g, cp, True), cp) for g, cp in positions]
+    moves = [(g, cp, hanabi_dgraham.all_moves(g, cp)) for g, cp in positions]
+    move_dicts = [(g, cp, [{"type": t, "data": d} for t, d in m]) for g, cp, m in moves]
+    num_moves = sum([len(m) for g, cp, m in moves])
+
+    def turns():
+        # play_one_turn changes the game so it needs a fresh copy each
+        # time, made outside of the timing
+        games = [(deepcopy(g), cp) for g, cp in positions]
+        start = time.time()
+        for g, cp in games:
+            play_one_turn(g, cp, play_move_random, {}, {}, True)
+        return time.time() - start
+
+    def best_of(func):
+        return min([func() for i in xrange(repeat)])
+
+    def possible_hands():
+        for view, cp in views:
+            hanabi_dgraham.build_possible_hands(view, cp)
+
+    def playable_values():
+        for g, cp in positions:
+            for c in COLOURS:
+                playable_value(g, c)
+
+    def discardables():
+        for g, cp in positions:
+            for card in hanabi_dgraham.FULL_SET:
+                discardable(g, card)
+
+    def generate_moves():
+        for g, cp in positions:
+            hanabi_dgraham.all_moves(g, cp)
+
+    def simulate_moves():
+        for g, cp, m in moves:
+            hanabi_dgraham.simulate(g, m[0])
+
+    def valid_moves():
+        for g, cp, m in move_dicts:
+            for move in m:
+                valid_move(g, cp, move)
+
+    n = len(positions)
+    if wanted(["play_one_turn"], only):
+        results["play_one_turn"] = result(best_of(turns), n, "calls")
+    benches = (("build_possible_hands", possible_hands, n),
+               ("playable_value", playable_values, n * len(COLOURS)),
+               ("discardable", discardables, n * len(hanabi_dgraham.FULL_SET)),
+               ("all_moves", generate_moves, n),
+               ("simulate", simulate_moves, n),
+               ("valid_move", valid_moves, num_moves))
+    for name, func, count in benches:
+        if wanted([name], only):
+            results[name] = result(best_time(func, repeat), count, "calls")
+    return results
+
+def run_benchmarks(num_games = 20, repeat = 3, only = None):
+    """Return the results of all the benchmarks, or just those with a
+    name containing `only'."""
+    results = bench_games(num_games, repeat, only)
+    if wanted(MICRO_BENCHMARKS, only):
+        results.update(bench_micro(sample_positions(num_games), repeat, only))
+    return results
+
+def compare_results(results, baseline, threshold = DEFAULT_THRESHOLD):
+    """Return (name, baseline rate, rate, ratio, regressed) for each
+    benchmark in both `results' and `baseline', where a benchmark has
+    regressed if its rate is more than `threshold' below the baseline."""
+    rows = []
+    for name in sorted(results):
+        if name in baseline:
+            base_rate, rate = baseline[name]["rate"], results[name]["rate"]
+            ratio = rate / base_rate if base_rate > 0 else float("inf")
+            rows.append((name, base_rate, rate, ratio, ratio < 1.0 - threshold))
+    return rows
+
+def write_results(filename, results):
+    with open(filename, "w") as fh:
+        json.dump({"python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "time": time.time(),
+                   "results": results}, fh, indent = 2, sort_keys = True)
+
+def read_results(filename):
+    with open(filename) as fh:
+        return json.load(fh)["results"]
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Benchmark the engine and the bots.")
+    parser.add_argument("-n", type = int, default = 20,
+                        help = "How many games each benchmark plays.")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "How many times to time each benchmark, the best is kept.")
+    parser.add_argument("--only", type = str, default = None,
+                        help = "Only run the benchmarks with names containing this.")
+    parser.add_argument("-o", "--output", type = str, default = None,
+                        help = "Write the results as JSON to this file.")
+    parser.add_argument("--compare", type = str, default = None,
+                        help = "A results file to compare against, exits with 1 if any benchmark regressed.")
+    parser.add_argument("--threshold", type = float, default = DEFAULT_THRESHOLD,
+                        help = "The fraction a rate can drop by before it is a regression.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.n, args.repeat, args.only)
+    for name in sorted(results):
+        r = results[name]
+        print "%-24s %12.1f %s/sec" % (name, r["rate"], r["unit"])
+    if args.output:
+        write_results(args.output, results)
+
+    if args.compare:
+        rows = compare_results(results, read_results(args.compare), args.threshold)
+        print
+        print "%-24s %12s %12s %8s" % ("Compared to " + args.compare, "baseline", "now", "ratio")
+        for name, base_rate, rate, ratio, regressed in rows:
+            print "%-24s %12.1f %12.1f %7.2fx%s" % (name, base_rate, rate, ratio, "  REGRESSED" if regressed else "")
+        if any([row[4] for row in rows]):
+            sys.exit(1)
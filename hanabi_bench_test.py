@@ -0,0 +1,37 @@
+import unittest
+import hanabi_bench
+from hanabi_bench import *
+
+class BenchTest(unittest.TestCase):
+
+    def testRunsOnlyWanted(self):
+        results = run_benchmarks(1, 1, "3p")
+        self.assertEqual(sorted(results), ["games/dgraham/3p", "games/random/3p", "turns/dgraham/3p", "turns/random/3p"])
+        self.assertTrue(all([r["rate"] > 0 for r in results.values()]))
+
+    def testNoPositionsWithoutMicroBenchmarks(self):
+        calls = []
+        sample = hanabi_bench.sample_positions
+        hanabi_bench.sample_positions = lambda *args: calls.append(args) or sample(*args)
+        try:
+            run_benchmarks(1, 1, "games/random/2p")
+            self.assertEqual(calls, [])
+            self.assertEqual(sorted(run_benchmarks(1, 1, "all_moves")), ["all_moves"])
+            self.assertEqual(len(calls), 1)
+        finally:
+            hanabi_bench.sample_positions = sample
+
+    def testGamesDontUseSharedCache(self):
+        table = hanabi_dgraham.PROBABILITIES.table
+        lookups = table.hits + table.misses
+        bench_games(1, 2, "dgraham/3p")
+        self.assertEqual(table.hits + table.misses, lookups)
+
+    def testCompareFlagsRegressions(self):
+        baseline = {"a": result(1.0, 100, "calls"), "b": result(1.0, 100, "calls")}
+        results = {"a": result(1.0, 95, "calls"), "b": result(1.0, 80, "calls"), "c": result(1.0, 1, "calls")}
+        rows = compare_results(results, baseline, 0.1)
+        self.assertEqual([(row[0], row[4]) for row in rows], [("a", False), ("b", True)])
+
+if __name__ == '__main__':
+    unittest.main()
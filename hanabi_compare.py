@@ -0,0 +1,184 @@
+import math
+import random
+import multiprocessing
+from itertools import chain
+from hanabi import *
+
+# Compares two or more strategies by playing them all on the same games.
+# Game i of a comparison is dealt from game_seed(master_seed, i), and the
+# players' random numbers come from strategy_seed(master_seed, i) (see
+# _play_seeded_game), so each strategy sees the same deck and the same
+# random numbers. The differences in score between the first strategy
+# and each of the others are then taken game by game, which removes the
+# luck of the deal from them, and far fewer games are needed to tell
+# the strategies apart than with separate runs of `play'.
+#
+# The games are played in batches, and after each batch the comparison
+# stops early if every difference is significant. As it is tested after
+# every batch rather than once, the default z is well above the 1.96 of
+# a single test at 95%.
+DEFAULT_Z = 3.0
+DEFAULT_BATCH_SIZE = 100
+
+class PairedComparison(object):
+    """The stats of the strategies named in `names' over the games they
+    have played so far, and a RunningStat for each strategy after the
+    first of its score minus the first strategy's in the same game."""
+    def __init__(self, names, num_players, master_seed):
+        self.names = names
+        self.num_players = num_players
+        self.master_seed = master_seed
+        self.aggregators = [StatsAggregator() for name in names]
+        self.differences = [RunningStat() for name in names[1:]]
+        self.stopped_early = False
+
+    def num_games(self):
+        return self.aggregators[0].num_games
+
+    def add(self, stats_per_strategy):
+        """Add the stats of the same games, played by each strategy in
+        turn."""
+        for aggregator, stats in zip(self.aggregators, stats_per_strategy):
+            for s in stats:
+                aggregator.add(s)
+        baseline = stats_per_strategy[0]
+        for difference, stats in zip(self.differences, stats_per_strategy[1:]):
+            for s, b in zip(stats, baseline):
+                difference.add(s[1] - b[1])
+
+    def standard_error(self, i):
+        """Return the standard error of the mean difference in score
+        between strategy `i' and the first strategy."""
+        difference = self.differences[i - 1]
+        return difference.stdev() / math.sqrt(difference.n) if difference.n > 1 else float("inf")
+
+    def unpaired_standard_error(self, i):
+        """Return the standard error the difference would have if the
+        strategies had been played on different games."""
+        a, b = self.aggregators[0].score(), self.aggregators[i].score()
+        return math.sqrt(a.variance() / a.n + b.variance() / b.n) if a.n > 1 else float("inf")
+
+    def z_score(self, i):
+        mean, se = self.differences[i - 1].mean, self.standard_error(i)
+        if se == 0:
+            return 0.0 if mean == 0 else math.copysign(float("inf"), mean)
+        return mean / se
+
+    def significant(self, z = DEFAULT_Z):
+        """Return whether every strategy differs from the first by more
+        than `z' standard errors."""
+        return all([abs(self.z_score(i)) > z for i in xrange(1, len(self.names))])
+
+    def print_summary(self, z = DEFAULT_Z):
+        num_games = self.num_games()
+        print "For %d game%s with %d players%s, master seed %d:" % \
+            (num_games, ("s" if num_games != 1 else ""), self.num_players,
+             " (stopped early)" if self.stopped_early else "", self.master_seed)
+        for name, aggregator in zip(self.names, self.aggregators):
+            score = aggregator.score()
+            print "\t%s: score %.2f +/- %.2f, won %.2f%%, lost %.2f%%" % \
+                (name, score.mean, score.confidence(), pct(aggregator.counts["won"], num_games),
+                 pct(aggregator.counts["lost"], num_games))
+        for i in xrange(1, len(self.names)):
+            se, unpaired_se = self.standard_error(i), self.unpaired_standard_error(i)
+            print "\t%s - %s: %+.3f, standard error %.3f (%.3f unpaired), z %.2f%s" % \
+                (self.names[i], self.names[0], self.differences[i - 1].mean, se, unpaired_se, self.z_score(i),
+                 " *" if abs(self.z_score(i)) > z else "")
+
+def _compare_worker(args):
+    (master_seed, start, stop, num_players, play_move_func, play_move_func_args, obfuscate_game) = args
+    play_move_per_player = check_play_move_funcs(num_players, play_move_func)
+    # The games seed the global random module for the players, so it is
+    # put back afterwards as play() does
+    random_state = random.getstate()
+    try:
+        return play_games(start, stop, master_seed, num_players, play_move_per_player, play_move_func_args, obfuscate_game, False)[0]
+    finally:
+        random.setstate(random_state)
+
+def compare(strategies, num_players, max_games, master_seed = None, batch_size = DEFAULT_BATCH_SIZE, min_games = None, z = DEFAULT_Z, workers = 1, obfuscate_game = True):
+    """Play each of `strategies', a list of (name, play_move_func,
+    play_move_func_args), on the same games until `max_games' have been
+    played or, once there have been at least `min_games' (by default a
+    batch), every strategy differs significantly from the first. Returns
+    the PairedComparison.
+
+    The games are played `batch_size' at a time, and a batch is split
+    across `workers' processes. A comparison can be repeated or extended
+    by passing the `master_seed' printed with its summary.
+    """
+    if len(strategies) < 2:
+        raise ValueError("Need at least two strategies to compare")
+    if master_seed is None:
+        master_seed = random.getrandbits(32)
+    if min_games is None:
+        min_games = batch_size
+    comparison = PairedComparison([name for name, func, args in strategies], num_players, master_seed)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        start = 0
+        while start < max_games:
+            stop = min(start + batch_size, max_games)
+            tasks = [(master_seed, shard_start + start, shard_stop + start, num_players, func, args, obfuscate_game)
+                     for name, func, args in strategies
+                     for shard_start, shard_stop in shard_games(stop - start, workers)]
+            results = pool.map(_compare_worker, tasks) if pool is not None else map(_compare_worker, tasks)
+            shards_per_strategy = len(results) // len(strategies)
+            comparison.add([list(chain.from_iterable(results[i:i + shards_per_strategy]))
+                            for i in xrange(0, len(results), shards_per_strategy)])
+            start = stop
+            if start < max_games and start >= min_games and comparison.significant(z):
+                comparison.stopped_early = True
+                break
+    except BaseException:
+        # Stop the games still playing rather than waiting for them
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+    return comparison
+
+def parse_strategy(spec):
+    """Return the (name, play_move_func, play_move_func_args) for
+    `spec', "random" or "dgraham:<clue algorithm>:<discard algorithm>"."""
+    if spec == "random":
+        return (spec, play_move_random, {})
+    parts = spec.split(":")
+    if parts[0] == "dgraham" and len(parts) == 3:
+        import hanabi_dgraham
+        return (spec, hanabi_dgraham.play_move, {"clue_algorithm": int(parts[1]), "discard_algorithm": int(parts[2])})
+    raise ValueError("Unknown strategy '%s'" % spec)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Compare strategies by playing them on the same games.")
+    parser.add_argument("strategies", nargs = "+",
+                        help = "The strategies, 'random' or 'dgraham:<clue algorithm>:<discard algorithm>'. The first is the baseline.")
+    parser.add_argument("-n", type = int, default = 10000,
+                        help = "The most games to play.")
+    parser.add_argument("-p", type = int, default = 3, choices = sorted(HAND_COUNT.keys()),
+                        help = "The number of players.")
+    parser.add_argument("--seed", type = int, default = None,
+                        help = "The master seed to deal the games from, random by default.")
+    parser.add_argument("--batch-size", type = int, default = DEFAULT_BATCH_SIZE,
+                        help = "How many games to play between checks for significance.")
+    parser.add_argument("--min-games", type = int, default = None,
+                        help = "How many games to play before stopping early, a batch by default.")
+    parser.add_argument("-z", type = float, default = DEFAULT_Z,
+                        help = "How many standard errors a difference must be to be significant.")
+    parser.add_argument("-w", "--workers", type = int, default = 1,
+                        help = "How many processes to play the games in.")
+    args = parser.parse_args()
+
+    try:
+        strategies = [parse_strategy(spec) for spec in args.strategies]
+    except ValueError as e:
+        parser.error(str(e))
+    comparison = compare(strategies, args.p, args.n, args.seed, args.batch_size, args.min_games, args.z, args.workers)
+    comparison.print_summary(args.z)
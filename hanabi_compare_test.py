@@ -0,0 +1,41 @@
+import unittest
+import random
+from hanabi_compare import *
+
+class CompareTest(unittest.TestCase):
+
+    def testPairedByGame(self):
+        strategies = [parse_strategy("random"), parse_strategy("dgraham:1:1")]
+        comparison = compare(strategies, 3, 10, master_seed = 3, batch_size = 4, min_games = 10)
+        self.assertEqual(comparison.num_games(), 10)
+        self.assertFalse(comparison.stopped_early)
+        stats = [play_games(0, 10, 3, 3, check_play_move_funcs(3, func), args, True, False)[0] for name, func, args in strategies]
+        differences = [b[1] - a[1] for a, b in zip(*stats)]
+        self.assertAlmostEqual(comparison.differences[0].mean, float(sum(differences)) / len(differences))
+        parallel = compare(strategies, 3, 10, master_seed = 3, batch_size = 4, min_games = 10, workers = 2)
+        self.assertEqual(parallel.aggregators[1].histograms, comparison.aggregators[1].histograms)
+        self.assertAlmostEqual(parallel.differences[0].variance(), comparison.differences[0].variance())
+
+    def testStopsEarly(self):
+        strategies = [parse_strategy("random"), parse_strategy("random"), parse_strategy("dgraham:1:1")]
+        # The same strategy on the same games never differs
+        comparison = compare(strategies[:2], 3, 20, master_seed = 1, batch_size = 10)
+        self.assertEqual(comparison.num_games(), 20)
+        self.assertEqual(comparison.z_score(1), 0.0)
+        comparison = compare(strategies[1:], 3, 1000, master_seed = 1, batch_size = 20)
+        self.assertTrue(comparison.stopped_early)
+        self.assertTrue(comparison.num_games() < 1000)
+        self.assertTrue(comparison.z_score(1) > DEFAULT_Z)
+
+    def testRandomStateKept(self):
+        random.seed(0)
+        state = random.getstate()
+        compare([parse_strategy("random"), parse_strategy("dgraham:1:1")], 3, 4, master_seed = 3, batch_size = 2)
+        self.assertEqual(random.getstate(), state)
+
+    def testBadStrategies(self):
+        self.assertRaises(ValueError, parse_strategy, "dgraham:1")
+        self.assertRaises(ValueError, compare, [parse_strategy("random")], 3, 10)
+
+if __name__ == '__main__':
+    unittest.main()
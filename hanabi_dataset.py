@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from hanabi import *
+from hanabi_record import replay_record, read_records
+
+# A dataset holds games in two files of fixed width rows that can be
+# memory mapped, so columns can be read across millions of games
+# without parsing anything:
+#
+#   <path>.games - a GAME_DTYPE row per game
+#   <path>.moves - a MOVE_DTYPE row per move, the moves of each game in
+#                  order and the games one after another
+#
+# A game's moves are rows first_move up to first_move + moves of the
+# moves file. Rows are little endian and are only ever appended, so a
+# dataset can be added to by later runs.
+GAMES_SUFFIX = ".games"
+MOVES_SUFFIX = ".moves"
+# The outcome columns are those of game_stats
+GAME_DTYPE = np.dtype([("seed", "<u8"),
+                       ("num_players", "u1"),
+                       ("alive", "u1"),
+                       ("score", "u1"),
+                       ("moves", "<u2"),
+                       ("clues", "u1"),
+                       ("lives", "u1"),
+                       ("first_move", "<u8"),
+                       ("deck", "<u2", (DECK_SIZE,))])
+# The move is a compact move (see pack_move), the card is the compact
+# card discarded or played, or NO_CARD for a clue, and touched is the
+# number of cards a clue touched
+MOVE_DTYPE = np.dtype([("game", "<u4"),
+                       ("player", "u1"),
+                       ("move", "<u2"),
+                       ("card", "<u2"),
+                       ("touched", "u1"),
+                       ("life_lost", "u1")])
+NO_CARD = 0xffff
+
+def _memmap(filename, dtype):
+    # numpy can't map an empty file
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype)
+    return np.memmap(filename, dtype, "r")
+
+class DatasetWriter(object):
+    """Appends games to the dataset at `path', writing every
+    `games_per_flush' games. It takes game records (see encode_record)
+    so it can be given as the `record' argument of `play', or fed from a
+    record file with `add_record_file'. Each record is replayed to fill
+    in the per move columns.
+
+    Use it in a with statement, or call `close', so the last games are
+    written."""
+    def __init__(self, path, games_per_flush = 4096):
+        self.games_fh = open(path + GAMES_SUFFIX, "ab")
+        self.moves_fh = open(path + MOVES_SUFFIX, "ab")
+        self.games_per_flush = games_per_flush
+        # Carry on numbering from what is already in the files
+        self.num_games = self.games_fh.tell() // GAME_DTYPE.itemsize
+        self.num_moves = self.moves_fh.tell() // MOVE_DTYPE.itemsize
+        self.games = []
+        self.moves = []
+
+    def write(self, record):
+        self.add(decode_record(record)[0])
+
+    def add(self, record):
+        """Add the decoded game `record', see decode_record."""
+        g = replay_record(record)
+        cards = dict([(c[2], c) for c in record["deck"]])
+        played = set([c[2] for c in g["played"]])
+        for player, m in g["moves"]:
+            if m["type"] == "clue":
+                row = (self.num_games, player, pack_move(m), NO_CARD, len(m["data"][2]), False)
+            else:
+                row = (self.num_games, player, pack_move(m), pack_card(cards[m["data"]]), 0,
+                       m["type"] == "play" and not m["data"] in played)
+            self.moves.append(row)
+        stats = game_stats(g)
+        self.games.append((record["seed"], record["num_players"]) + stats +
+                          (self.num_moves, [pack_card(c) for c in record["deck"]]))
+        self.num_games += 1
+        self.num_moves += len(g["moves"])
+        if len(self.games) >= self.games_per_flush:
+            self.flush()
+
+    def add_record_file(self, filename):
+        """Add every game in the record file `filename'."""
+        for record in read_records(filename):
+            self.add(record)
+
+    def flush(self):
+        if self.games:
+            np.array(self.games, GAME_DTYPE).tofile(self.games_fh)
+            np.array(self.moves, MOVE_DTYPE).tofile(self.moves_fh)
+            self.games = []
+            self.moves = []
+        self.games_fh.flush()
+        self.moves_fh.flush()
+
+    def close(self):
+        self.flush()
+        self.games_fh.close()
+        self.moves_fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Dataset(object):
+    """The dataset at `path' opened read only. `games' and `moves' are
+    memory mapped record arrays of GAME_DTYPE and MOVE_DTYPE rows, so a
+    column such as games["score"] or moves["life_lost"] is read straight
+    from the file without copying.
+    """
+    def __init__(self, path):
+        self.games = _memmap(path + GAMES_SUFFIX, GAME_DTYPE)
+        self.moves = _memmap(path + MOVES_SUFFIX, MOVE_DTYPE)
+
+    def __len__(self):
+        return len(self.games)
+
+    def stats(self, i):
+        """Return the stats tuple of game `i', as game_stats."""
+        row = self.games[i]
+        return (bool(row["alive"]), int(row["score"]), int(row["moves"]), int(row["clues"]), int(row["lives"]))
+
+    def game_moves(self, i):
+        """Return the MOVE_DTYPE rows of the moves of game `i'."""
+        first = int(self.games[i]["first_move"])
+        return self.moves[first:first + int(self.games[i]["moves"])]
+
+    def record(self, i):
+        """Return game `i' as a record, see decode_record, e.g. to replay
+        it with replay_record."""
+        row = self.games[i]
+        moves = self.game_moves(i)
+        # A lost game that didn't lose all its lives was forfeited
+        return {"seed": int(row["seed"]),
+                "num_players": int(row["num_players"]),
+                "deck": unpack_cards(row["deck"].tolist()),
+                "moves": [unpack_move(m) for m in moves["move"].tolist()],
+                "forfeited": not row["alive"] and moves["life_lost"].sum() < INITIAL_LIVES}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Build a dataset from record files and summarise it.")
+    parser.add_argument("path", help = "The dataset to add to and summarise.")
+    parser.add_argument("records", nargs = "*", help = "Record files to add to the dataset.")
+    args = parser.parse_args()
+
+    if args.records:
+        with DatasetWriter(args.path) as writer:
+            for filename in args.records:
+                writer.add_record_file(filename)
+    dataset = Dataset(args.path)
+    games = dataset.games
+    print "%d games, %d moves" % (len(games), len(dataset.moves))
+    if len(games):
+        print "\tScores: %.2f/%.2f/%.2f (min/mean/max)" % (games["score"].min(), games["score"].mean(), games["score"].max())
+        print "\tLives lost: %d" % dataset.moves["life_lost"].sum()
+        move_types = np.bincount(dataset.moves["move"] >> MOVE_TYPE_SHIFT, minlength = len(MOVE_TYPES))
+        for t, n in zip(MOVE_TYPES, move_types):
+            print "\t%s: %d (%.2f%%)" % (t, n, pct(n, len(dataset.moves)))
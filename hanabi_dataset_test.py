@@ -0,0 +1,54 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+from hanabi import *
+from hanabi_record import *
+from hanabi_dataset import *
+from hanabi_test import SeedFileTest
+
+def forfeit_move(game, current_player, memory, user_args):
+    # Some of the games are forfeited after a few moves
+    if len(game["moves"]) == 5 and random.random() < 0.5:
+        return {"type": "play", "data": 99}
+    return play_move_random(game, current_player, memory, user_args)
+
+class DatasetTest(SeedFileTest):
+
+    def setUp(self):
+        SeedFileTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "games")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SeedFileTest.tearDown(self)
+
+    def testColumnsMatchGames(self):
+        random.seed(0)
+        stats = []
+        for num_players in (2, 5):
+            with DatasetWriter(self.path, games_per_flush = 4) as writer:
+                stats.extend(play(10, num_players, play_move_random, record = writer))
+        with DatasetWriter(self.path) as writer:
+            policy = InvalidMovePolicy("forfeit")
+            stats.extend(play(10, 3, forfeit_move, record = writer, error_policy = policy))
+        self.assertTrue(0 < len(policy.games()) < 10)
+        dataset = Dataset(self.path)
+        self.assertEqual(len(dataset), len(stats))
+        self.assertEqual(dataset.games["score"].tolist(), [s[1] for s in stats])
+        self.assertEqual(len(dataset.moves), sum([s[2] for s in stats]))
+        for i in xrange(len(dataset)):
+            self.assertEqual(dataset.stats(i), stats[i])
+            g = replay_record(dataset.record(i))
+            self.assertEqual(game_stats(g), stats[i])
+            moves = dataset.game_moves(i)
+            self.assertTrue((moves["game"] == i).all())
+            if not g.get("forfeited"):
+                self.assertEqual(moves["life_lost"].sum(), INITIAL_LIVES - g["lives"])
+            self.assertEqual(moves["player"].tolist(), [p for p, m in g["moves"]])
+
+if __name__ == '__main__':
+    unittest.main()
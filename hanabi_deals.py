@@ -0,0 +1,75 @@
+import random
+import struct
+import numpy as np
+from hanabi import *
+
+# A deal pool file holds the decks of a run of games, already shuffled,
+# so that a run doesn't have to shuffle a new deck for every game. It is
+# a DEAL_POOL_HEADER of the magic, the master seed and the number of
+# deals, then a row per game of the DECK_SIZE compact cards (see
+# pack_card) of its deck as little endian int16s, the same layout as
+# hanabi_batch.new_deals.
+#
+# Row i is the deck create_new_deck deals game i of a run started from
+# the master seed (see game_seed), so a run from a pool plays the same
+# games as one without it, and its records and replay_game still work.
+#
+# The rows are memory mapped read only. A DealPool is pickled as its
+# file name, so the workers of a parallel run each map the file and
+# share its pages, rather than being sent the decks.
+DEAL_POOL_MAGIC = "HNBDEALS"
+DEAL_POOL_HEADER = struct.Struct("<8sQI")
+DEAL_DTYPE = np.dtype("<i2")
+
+def seeded_deals(master_seed, start, stop):
+    """Return the decks of games `start' up to (but not including)
+    `stop' of a run from `master_seed' as rows of compact cards."""
+    return np.array([[pack_card(c) for c in create_new_deck(random.Random(game_seed(master_seed, i)))]
+                     for i in xrange(start, stop)], DEAL_DTYPE).reshape(-1, DECK_SIZE)
+
+def write_deal_pool(filename, num_deals, master_seed, deals_per_write = 4096):
+    """Write a deal pool of the first `num_deals' decks of a run from
+    `master_seed' to `filename' and return it as a DealPool."""
+    with open(filename, "wb") as fh:
+        fh.write(DEAL_POOL_HEADER.pack(DEAL_POOL_MAGIC, master_seed, num_deals))
+        for start in xrange(0, num_deals, deals_per_write):
+            fh.write(seeded_deals(master_seed, start, min(start + deals_per_write, num_deals)).tostring())
+    return DealPool(filename)
+
+class DealPool(object):
+    """The deal pool in the file `filename', see write_deal_pool. The
+    rows of compact cards are `deals', e.g. for hanabi_batch.play_batch,
+    and `deck' gives the deck of a game for create_new_game. Pass it as
+    the `deals' argument of `play' to play the games in it."""
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fh:
+            (magic, self.master_seed, num_deals) = DEAL_POOL_HEADER.unpack(fh.read(DEAL_POOL_HEADER.size))
+        if magic != DEAL_POOL_MAGIC:
+            raise ValueError("'%s' isn't a deal pool" % filename)
+        self.deals = np.memmap(filename, DEAL_DTYPE, "r", DEAL_POOL_HEADER.size, (num_deals, DECK_SIZE))
+
+    def __len__(self):
+        return self.deals.shape[0]
+
+    def deck(self, game_index):
+        return unpack_cards(self.deals[game_index].tolist())
+
+    def __reduce__(self):
+        # Only the file name is pickled, the file is mapped again
+        return (DealPool, (self.filename,))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Write a deal pool for play() and the batch simulator to take decks from.")
+    parser.add_argument("filename", help = "The deal pool file to write.")
+    parser.add_argument("-n", type = int, default = 100000,
+                        help = "How many deals to write.")
+    parser.add_argument("--seed", type = int, default = None,
+                        help = "The master seed to deal from, random by default.")
+    args = parser.parse_args()
+
+    master_seed = random.getrandbits(32) if args.seed is None else args.seed
+    pool = write_deal_pool(args.filename, args.n, master_seed)
+    print "Wrote %d deals from master seed %d to %s" % (len(pool), pool.master_seed, args.filename)
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hanabi_deals import *
+from hanabi_batch import play_batch, batch_move_random
+from hanabi_test import SeedFileTest
+
+class DealPoolTest(SeedFileTest):
+
+    def setUp(self):
+        SeedFileTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "pool.deals")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SeedFileTest.tearDown(self)
+
+    def testDecksAreSeededDecks(self):
+        pool = write_deal_pool(self.filename, 10, 1234, deals_per_write = 3)
+        self.assertEqual(len(pool), 10)
+        self.assertEqual(pool.master_seed, 1234)
+        for i in (0, 4, 9):
+            self.assertEqual(pool.deck(i), create_new_deck(random.Random(game_seed(1234, i))))
+        # The rows can go straight to the batch simulator
+        self.assertEqual(pool.deals.dtype, np.int16)
+        self.assertEqual(len(play_batch(10, 3, batch_move_random, deals = pool.deals, seed = 0)), 10)
+
+    def testSameGamesAsWithoutPool(self):
+        pool = write_deal_pool(self.filename, 8, 99)
+        for workers in (1, 2):
+            random.seed(0)
+            stats = play(8, 3, play_move_random, workers = workers, deals = pool)
+            master_seed = load_master_seed()
+            self.assertEqual(master_seed, 99)
+            for i in (0, 7):
+                self.assertEqual(game_stats(replay_game(master_seed, i, 3, play_move_random)), stats[i])
+        self.assertRaises(ValueError, play, 9, 3, play_move_random, deals = pool)
+
+    def testNotAPool(self):
+        with open(self.filename, "wb") as fh:
+            fh.write("\0" * 100)
+        self.assertRaises(ValueError, DealPool, self.filename)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,32 @@
 from hanabi import *
 from itertools import chain, repeat
 from operator import itemgetter
-from simpleai.search import SearchProblem, breadth_first
+from simpleai.search import SearchProblem
+from simpleai.search.models import SearchNode
 from simpleai.search.viewers import *
 from copy import deepcopy
+from collections import OrderedDict, deque
 from tabulate import tabulate
+import math
 import string
+import time
 
 FULL_SET = [(c, v) for c in COLOURS for v in VALUES]
 CARDS_PER_VALUE = [v for v in VALUES for i in xrange(VALUES_COUNT[v])]
+# Each card in FULL_SET is a bit in a possibility mask
+FACE_BITS = [(card, 1 << i) for i, card in enumerate(FULL_SET)]
+FACE_BIT = dict(FACE_BITS)
+ALL_FACES = (1 << len(FULL_SET)) - 1
+CLUE_MASKS = dict([(c, sum([FACE_BIT[(c, v)] for v in VALUES])) for c in COLOURS] +
+                  [(v, sum([FACE_BIT[(c, v)] for c in COLOURS])) for v in VALUES])
 # Include the default random algorithm
 NUM_CLUE_ALGORITHMS = 4
 NUM_DISCARD_ALGORITHMS = 2
+SEARCH_MODES = ["beam", "mcts"]
+# How much a life and a clue are worth compared to a point of score
+# when searching
+LIFE_VALUE = 1.0
+CLUE_VALUE = 0.1
 
 # From http://stackoverflow.com/a/44512
 def merge_dicts(d1, d2, merge_fn=lambda x,y:y):
@@ -51,43 +66,121 @@ def get_from(d, key, default):
 
     return d[key]
 
+def mask_to_list(mask):
+    """Return the cards in FULL_SET order that are set in the `mask'."""
+    return [card for card, bit in FACE_BITS if mask & bit]
+
+def popcount(mask):
+    return bin(mask).count("1")
+
+def faces_mask(cards):
+    """Return the mask of the (colour, value) `cards'."""
+    mask = 0
+    for c in cards:
+        mask |= FACE_BIT[(c[0], c[1])]
+    return mask
+
+def playable_mask(game):
+    """Return the mask of the cards that are playable."""
+    mask = 0
+    for c in COLOURS:
+        v = playable_value(game, c)
+        if v is not None:
+            mask |= FACE_BIT[(c, v)]
+    return mask
+
+def discardable_mask(game):
+    """Return the mask of the cards that are discardable, see
+    discardable. Those are the played cards of a colour, or all of them
+    once it is complete or dead."""
+    mask = 0
+    fireworks = game["fireworks"]
+    discard_counts = game["discard_counts"]
+    for ci, c in enumerate(COLOURS):
+        highest = fireworks[ci]
+        if highest >= VALUES[-1] or discard_counts[ci][highest + 1] >= VALUES_COUNT[highest + 1]:
+            mask |= CLUE_MASKS[c]
+        else:
+            for v in xrange(1, highest + 1):
+                mask |= FACE_BIT[(c, v)]
+    return mask
+
+class PossibilitySet(object):
+    """The cards in FULL_SET that a card could be, held as a bitmask.
+
+    It reads like the list of those cards in FULL_SET order (iterating,
+    `in', len and remove work as for a list) but narrowing it down with
+    clues or what is unseen is a single integer operation.
+    """
+    __slots__ = ("mask",)
+
+    def __init__(self, mask = ALL_FACES):
+        self.mask = mask
+
+    def __iter__(self):
+        return iter(mask_to_list(self.mask))
+
+    def __len__(self):
+        return popcount(self.mask)
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    def __contains__(self, card):
+        return bool(self.mask & FACE_BIT.get((card[0], card[1]), 0))
+
+    def __and__(self, mask):
+        if isinstance(mask, PossibilitySet):
+            mask = mask.mask
+        return PossibilitySet(self.mask & mask)
+
+    def __eq__(self, other):
+        if isinstance(other, PossibilitySet):
+            return self.mask == other.mask
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def remove(self, card):
+        self.mask &= ~FACE_BIT[(card[0], card[1])]
+
+    def count(self, mask):
+        """Return how many of the cards are also in the `mask'."""
+        return popcount(self.mask & mask)
+
 def rule_out(my_hand, colour, value):
-    for id in my_hand.keys():
-        # Only remove it if it hasn't already been removed
-        if (colour, value) in my_hand[id]:
-            my_hand[id].remove((colour, value))
+    for possible_cards in my_hand.values():
+        possible_cards.remove((colour, value))
 
 def prune(my_hand, ids, colour_or_value):
-    my_ids = my_hand.keys()
-    for id in my_ids:
+    mask = CLUE_MASKS[colour_or_value]
+    for id, possible_cards in my_hand.iteritems():
         if id in ids:
             # If the clue is for this card, then remove all cards that
             # are not the indicated colour or value
-            if isinstance(colour_or_value, str):
-                my_hand[id] = [c for c in my_hand[id] if c[0] == colour_or_value]
-            else:
-                my_hand[id] = [c for c in my_hand[id] if c[1] == colour_or_value]
+            possible_cards.mask &= mask
         else:
             # Else if the clue is not for this card, then we know it
             # is not the indicated colour or value
-            if isinstance(colour_or_value, str):
-                my_hand[id] = [c for c in my_hand[id] if c[0] != colour_or_value]
-            else:
-                my_hand[id] = [c for c in my_hand[id] if c[1] != colour_or_value]
+            possible_cards.mask &= ~mask
 
 def build_possible_hands(game, current_player):
     """Return the possibilities for each card in every other player's
-    hand from the perspective of the `current_player'.
+    hand from the perspective of the `current_player', as a
+    PossibilitySet per card ID.
     """
     hand_possibilities = {}
-    whats_left = {}
     for p, h in game["players"].iteritems():
         # Initialise what each of the players cards could be
-        hand_possibilities[p] = dict([(id, list(FULL_SET)) for id in h])
+        hand_possibilities[p] = dict([(card_id(c), PossibilitySet()) for c in h])
 
         # Initialise all the possible cards which we will then update
         # as we assess the game
-        whats_left[p] = dict([(c, list(CARDS_PER_VALUE)) for c in COLOURS])
+        whats_left = dict([(card, VALUES_COUNT[card[1]]) for card in FULL_SET])
 
         # Remove what's in other players' hands and what's been played
         # or discarded. Since we don't know the current player's hand
@@ -97,14 +190,13 @@ def build_possible_hands(game, current_player):
                                                     if (p1 != p and p1 != current_player)]),
                                game["played"], game["discarded"]))
         for (colour, value, id) in all_cards:
-            whats_left[p][colour].remove(value)
+            whats_left[(colour, value)] -= 1
 
         # Rule out from each player's hand any card not possible from
         # what's left
-        for colour, values in whats_left[p].iteritems():
-            for v in VALUES:
-                if not v in values:
-                    rule_out(hand_possibilities[p], colour, v)
+        unseen = faces_mask([card for card, count in whats_left.iteritems() if count > 0])
+        for possible_cards in hand_possibilities[p].values():
+            possible_cards.mask &= unseen
 
         # Update the hand with any clues given to this player
         for clue_data in [m[1]["data"] for m in game["moves"] if m[1]["type"] == "clue" and \
@@ -113,6 +205,202 @@ def build_possible_hands(game, current_player):
 
     return hand_possibilities
 
+class KnowledgeTracker(object):
+    """Keeps what `player' can work out about every player's hand up to
+    date from one turn to the next, giving the same possibilities as
+    build_possible_hands without rebuilding them from all the moves.
+
+    Call `update' with the game each turn, it only looks at what has
+    changed since the last call.
+    """
+    def __init__(self, player):
+        self.player = player
+        # The number of moves, played and discarded cards already seen
+        self.num_moves = 0
+        self.num_played = 0
+        self.num_discarded = 0
+        # For each player, the card IDs in the hand when last seen and
+        # the possibility mask of each of them from clues alone
+        self.hands = {}
+        self.knowledge = {}
+        # For each player, the cards ruled out by all the clues given to
+        # them. Like build_possible_hands, this applies to cards drawn
+        # after the clue as well.
+        self.ruled_out = {}
+        # For each player, how many of each card are left from their
+        # perspective as far as `player' can tell, and the mask of cards
+        # with some left
+        self.left = {}
+        self.available = {}
+        # The player holding each card seen in another player's hand
+        self.holder = {}
+        # The possibility mask of each card in `player's own hand from
+        # only the clues given while it was in the hand
+        self.clued = {}
+
+    def update(self, game):
+        players = game["players"]
+        if not self.left:
+            for p in players.keys():
+                self.hands[p] = []
+                self.knowledge[p] = {}
+                self.ruled_out[p] = 0
+                self.left[p] = dict([(card, VALUES_COUNT[card[1]]) for card in FULL_SET])
+                self.available[p] = ALL_FACES
+
+        # Played and discarded cards are seen by everyone
+        for pile, num_seen in ((game["played"], self.num_played), (game["discarded"], self.num_discarded)):
+            for i in xrange(num_seen, len(pile)):
+                card = pile[i]
+                if card[2] in self.holder:
+                    self.seen(card, [self.holder.pop(card[2])])
+                else:
+                    self.seen(card, players.keys())
+        self.num_played = len(game["played"])
+        self.num_discarded = len(game["discarded"])
+
+        # Cards that have left or joined each hand. Cards in other
+        # players' hands are seen by everyone except the holder.
+        for p, hand in players.iteritems():
+            ids = [card_id(c) for c in hand]
+            if ids == self.hands[p]:
+                continue
+            knowledge = self.knowledge[p]
+            for id in self.hands[p]:
+                if id not in ids:
+                    del knowledge[id]
+                    self.clued.pop(id, None)
+            for c, id in zip(hand, ids):
+                if id not in knowledge:
+                    knowledge[id] = ALL_FACES & ~self.ruled_out[p]
+                    if p == self.player:
+                        self.clued[id] = ALL_FACES
+                    else:
+                        self.holder[id] = p
+                        self.seen(c, [p1 for p1 in players.keys() if p1 != p])
+            self.hands[p] = ids
+
+        # Clues given since the last update. Applying these after the
+        # hands are up to date means a card drawn after a clue is
+        # treated as not touched by it, as in build_possible_hands.
+        moves = game["moves"]
+        for i in xrange(self.num_moves, len(moves)):
+            m = moves[i][1]
+            if m["type"] == "clue":
+                (p, colour_or_value, ids) = m["data"]
+                mask = CLUE_MASKS[colour_or_value]
+                knowledge = self.knowledge[p]
+                for id in knowledge:
+                    if id in ids:
+                        knowledge[id] &= mask
+                    else:
+                        knowledge[id] &= ~mask
+                self.ruled_out[p] |= mask
+                # The player's own hand only changes on their turn, so
+                # every card in it now was there for these clues
+                if p == self.player:
+                    for id in self.clued:
+                        if id in ids:
+                            self.clued[id] &= mask
+                        else:
+                            self.clued[id] &= ~mask
+        self.num_moves = len(moves)
+
+    def seen(self, card, players):
+        """Count the `card' as seen from the perspective of `players'."""
+        face = (card[0], card[1])
+        for p in players:
+            left = self.left[p]
+            left[face] -= 1
+            if left[face] <= 0:
+                self.available[p] &= ~FACE_BIT[face]
+
+    def possible_hand(self, p):
+        """Return the PossibilitySet of each card in `p's hand."""
+        available = self.available[p]
+        return dict([(id, PossibilitySet(mask & available)) for id, mask in self.knowledge[p].iteritems()])
+
+    def possible_hands(self):
+        """Return the possibilities of each card of each player in the
+        same form as build_possible_hands."""
+        return dict([(p, self.possible_hand(p)) for p in self.knowledge])
+
+    def own_hand_constraints(self):
+        """Return the mask of what each card in `player's own hand can
+        be. Unlike possible_hand this is exact: only the clues given
+        while a card was in the hand count against it, so the real hand
+        always fits."""
+        available = self.available[self.player]
+        return dict([(id, mask & available) for id, mask in self.clued.iteritems()])
+
+    def unseen(self):
+        """Return how many of each card `player' has not seen."""
+        return dict(self.left[self.player])
+
+class DealSampler(object):
+    """Draws full deals of the `game' consistent with what `player' has
+    seen, to search a game with hidden information as if it were known.
+
+    Each card in the player's hand is given a face allowed by its mask
+    in `constraints' and the rest of the `unseen' cards (a count per
+    face) are shuffled into the deck. The cards of the hand take faces
+    in proportion to the copies left, most constrained card first,
+    backing up if a later card is left with nothing, so a deal is never
+    rejected.
+    """
+    def __init__(self, game, player, constraints, unseen):
+        self.player = player
+        self.hand_ids = [card_id(c) for c in game["players"][player]]
+        # The FULL_SET index of each face each card can be
+        self.faces = [[i for i, (card, bit) in enumerate(FACE_BITS) if constraints[id] & bit]
+                      for id in self.hand_ids]
+        self.order = sorted(xrange(len(self.hand_ids)), key = lambda i: len(self.faces[i]))
+        self.counts = [unseen[card] for card in FULL_SET]
+        assert(sum(self.counts) == len(self.hand_ids) + game["deck_len"])
+        # Cards in the deck have not been seen, so give them the unused
+        # IDs
+        seen_ids = set(chain(self.hand_ids,
+                             [c[2] for c in chain(game["played"], game["discarded"])],
+                             [c[2] for p, h in game["players"].iteritems() if p != player for c in h]))
+        self.deck_ids = [id for id in xrange(DECK_SIZE) if id not in seen_ids]
+
+    def sample(self, rng):
+        """Return a deal as (hand, deck) using the random.Random `rng'."""
+        counts = list(self.counts)
+        faces = [None] * len(self.hand_ids)
+        if not self.assign(0, counts, faces, rng):
+            raise ValueError("no deal fits the clues given to player %d" % self.player)
+        hand = [FULL_SET[f] + (id,) for f, id in zip(faces, self.hand_ids)]
+        deck = list(chain.from_iterable([repeat(FULL_SET[f], n) for f, n in enumerate(counts) if n > 0]))
+        rng.shuffle(deck)
+        return (hand, [card + (id,) for card, id in zip(deck, self.deck_ids)])
+
+    def assign(self, k, counts, faces, rng):
+        if k == len(self.order):
+            return True
+        i = self.order[k]
+        candidates = [f for f in self.faces[i] if counts[f] > 0]
+        while candidates:
+            r = rng.random() * sum([counts[f] for f in candidates])
+            for j, f in enumerate(candidates):
+                r -= counts[f]
+                if r < 0:
+                    break
+            counts[f] -= 1
+            faces[i] = f
+            if self.assign(k + 1, counts, faces, rng):
+                return True
+            counts[f] += 1
+            candidates.pop(j)
+        return False
+
+    def determinize(self, game, rng):
+        """Fill in the player's hand and the deck of the plain `game'
+        dict in place with a new deal and return it."""
+        (game["players"][self.player], game["deck"]) = self.sample(rng)
+        game["clue_tables"][self.player] = clue_table(game["players"][self.player])
+        return game
+
 def card_possibilities_as_table(card_list):
     table = []
     for v in VALUES:
@@ -189,86 +477,226 @@ def print_hand_possibilities(hand, prob_playable, prob_discardable):
     print "\n".join(table_list)
 
 def all_moves(game, current_player):
-    """Return all moves for the current player."""
-    moves = []
+    """Return all moves for the current player, as (type, data) tuples.
+    Remember that our cards may be obfuscated."""
+    return legal_moves(game, current_player)
 
-    # Played and discard moves are easy
-    # Remember that our cards may be obfuscated
-    hand = game["players"][current_player]
+def simulate(game, move):
+    """Simulate the given `move' on the current game to see if it is worth
+    making. This does not modify the game passed in, it returns a
+    modified copy. Use apply_move and undo_move to walk through moves
+    without copying the game.
+    """
+    # Make a copy, of the move as well since the clue card IDs get
+    # added to it
+    new_game = deepcopy(game)
+    apply_move(new_game, new_game["current_player"], move if type(move) is tuple else dict(move))
 
-    if isinstance(hand[0], int):
-        card_ids = hand
-    else:
-        card_ids = [c[2] for c in hand]
+    return new_game
 
-    for card_id in card_ids:
-        moves.append({"type": "play", "data": card_id})
-        moves.append({"type": "discard", "data": card_id})
+class TranspositionTable(object):
+    """Remembers up to `max_size' values by key, forgetting the least
+    recently used when full."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, key):
+        """Return the value for `key' or None if it isn't known."""
+        value = self.table.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            # Re-insert to make it the most recently used
+            self.table[key] = value
+            self.hits += 1
+        return value
 
-    # Want every possible clue
-    for pid, hand in game["players"].iteritems():
-        if pid != current_player:
-            for c in colours_in_hand(hand):
-                moves.append({"type": "clue", "data": (pid, c)})
-            for v in values_in_hand(hand):
-                moves.append({"type": "clue", "data": (pid, v)})
+    def put(self, key, value):
+        self.table.pop(key, None)
+        self.table[key] = value
+        if len(self.table) > self.max_size:
+            self.table.popitem(last = False)
+            self.evictions += 1
 
-    return moves
+class SearchState(object):
+    """A game for searching over, hashed and compared by its game_key so
+    that the same position reached by different moves is one state."""
+    __slots__ = ("key", "game")
 
-def simulate(game, move):
-    """Simulate the given `move' on the current game to see if it is worth
-    making. This does not modify the game passed in, it returns a
-    modified copy.
-    """
+    def __init__(self, game, key = None):
+        self.game = game
+        self.key = game_key(game) if key is None else key
 
-    def play_one_move(game, current_player, memory, user_args):
-        return move
+    def __hash__(self):
+        return hash(self.key)
 
-    # Make a copy
-    new_game = deepcopy(game)
-    new_game = play_one_turn(new_game,
-                             new_game["current_player"],
-                             play_one_move,
-                             None,
-                             None,
-                             False)
+    def __eq__(self, other):
+        return self.key == other.key
 
-    return new_game
+    def __ne__(self, other):
+        return not self == other
 
 class HanabiProblem(SearchProblem):
-    def __init__(self, initial_game):
-        # Can't use the game as the state that gets passed around
-        # because it is a dictionary and that's not hashable. Can make
-        # it hashable but a hash would be too long, so it is easier to
-        # index into a list of game objects
-        super(HanabiProblem, self).__init__(0)
-        self.game_states = [initial_game]
-
-    def actions(self, game_id):
-        """this method receives the index into the list of game states
-        (`game_id'), and must return the list of moves that can be
-        performed from that particular game state.
+    def __init__(self, initial_game, table_size = 100000):
+        # The states are SearchStates, which are hashable so repeated
+        # positions can be spotted. States already seen are kept in a
+        # bounded transposition table so that reaching one again shares
+        # the existing state instead of simulating a new copy.
+        self.table = TranspositionTable(table_size)
+        initial_state = SearchState(initial_game)
+        self.table.put(initial_state.key, initial_state)
+        super(HanabiProblem, self).__init__(initial_state)
+
+    def actions(self, state):
+        """this method receives a SearchState, and must return the list
+        of moves that can be performed from that particular game state.
         """
-        game = self.game_states[game_id]
+        game = state.game
         return all_moves(game, game["current_player"])
 
-    def result(self, game_id, move):
-        """this method receives the index into the list of game states and a
-        move, and must return the resulting state of applying that
-        particular move from that particular game state.
+    def result(self, state, move):
+        """this method receives a SearchState and a move, and must return
+        the resulting state of applying that particular move from that
+        particular game state.
         """
-        game = self.game_states[game_id]
-        next_game = simulate(game, move)
-        self.game_states.append(next_game)
-        return (len(self.game_states) - 1)
-
-    def is_goal(self, game_id):
-        """this method receives the index into the list of game states, and
-        must return True if the game state is a goal state, or False
-        if don't.
+        next_game = simulate(state.game, move)
+        key = game_key(next_game)
+        next_state = self.table.get(key)
+        if next_state is None:
+            next_state = SearchState(next_game, key)
+            self.table.put(key, next_state)
+        return next_state
+
+    def new_result(self, state, move):
+        """Return the SearchState of applying `move' to `state', or None
+        if that position is already in the table."""
+        next_game = simulate(state.game, move)
+        key = game_key(next_game)
+        if self.table.get(key) is not None:
+            return None
+        next_state = SearchState(next_game, key)
+        self.table.put(key, next_state)
+        return next_state
+
+    def is_goal(self, state):
+        """this method receives a SearchState, and must return True if the
+        game state is a goal state, or False if don't.
         """
-        game = self.game_states[game_id]
-        return have_won(game)
+        return have_won(state.game)
+
+def bounded_breadth_first(problem, max_nodes = None):
+    """Search `problem', a HanabiProblem, breadth first for a won game
+    and return its SearchNode, or None if there isn't one within
+    `max_nodes' expanded nodes.
+
+    This is simpleai's breadth_first with graph_search, except that the
+    positions already seen are those in the problem's transposition
+    table rather than a set of every state expanded, so the memory they
+    take is bounded by its size. A position forgotten by the table may be
+    searched again.
+    """
+    fringe = deque([SearchNode(problem.initial_state, problem = problem)])
+    expanded = 0
+    while fringe:
+        node = fringe.popleft()
+        if problem.is_goal(node.state):
+            return node
+        if max_nodes is not None and expanded >= max_nodes:
+            break
+        expanded += 1
+        for move in problem.actions(node.state):
+            next_state = problem.new_result(node.state, move)
+            if next_state is not None:
+                fringe.append(SearchNode(next_state, node, move, node.cost + problem.cost(node.state, move, next_state),
+                                         problem, node.depth + 1))
+    return None
+
+def unseen_counts(game, player):
+    """Return how many of each card `player' has not seen in the `game',
+    as KnowledgeTracker.unseen does."""
+    left = dict([(card, VALUES_COUNT[card[1]]) for card in FULL_SET])
+    for (colour, value, id) in chain(chain.from_iterable([h for p, h in game["players"].iteritems() if p != player]),
+                                     game["played"], game["discarded"]):
+        left[(colour, value)] -= 1
+    return left
+
+def critical_mask(game, the_discardable_mask = None):
+    """Return the mask of the cards that are still needed and have only
+    one copy left. `the_discardable_mask' is the game's discardable_mask
+    if it is already known."""
+    if the_discardable_mask is None:
+        the_discardable_mask = discardable_mask(game)
+    discard_counts = game["discard_counts"]
+    mask = 0
+    for (c, v), bit in FACE_BITS:
+        if not the_discardable_mask & bit and discard_counts[COLOUR_INDEX[c]][v] == VALUES_COUNT[v] - 1:
+            mask |= bit
+    return mask
+
+# How many situations a ProbabilityEngine remembers. A key is about 60
+# ints, so this is around 10MB for each process
+PROBABILITY_CACHE_SIZE = 10000
+
+class ProbabilityEngine(object):
+    """Works out the chances that a card is playable, discardable or
+    critical (see critical_mask) from the mask of what it could be and
+    how many of each of those cards are unseen, every unseen copy being
+    equally likely.
+
+    The chances only depend on the mask, the unseen counts of the cards
+    in it, the fireworks and the discard counts, so they are remembered
+    by those in a TranspositionTable (which counts the hits and misses)
+    and the same situation in a later turn or game is looked up rather
+    than worked out again.
+    """
+    def __init__(self, max_size = PROBABILITY_CACHE_SIZE):
+        self.table = TranspositionTable(max_size)
+
+    def print_summary(self):
+        lookups = self.table.hits + self.table.misses
+        print "\tProbability cache: %d hits of %d lookups (%.2f%%), %d evictions, %d of %d entries used" % \
+            (self.table.hits, lookups, pct(self.table.hits, lookups) if lookups else 0.0,
+             self.table.evictions, len(self.table), self.table.max_size)
+
+    def probabilities(self, game, masks, unseen):
+        """Return (P(playable), P(discardable), P(critical)) for each
+        card ID in `masks', a dictionary of the mask of what each card
+        could be, with `unseen' the count of each card unseen. A card
+        that can't be anything is given 0.0 for each."""
+        state = (tuple(game["fireworks"]), tuple(chain.from_iterable(game["discard_counts"])))
+        # Only worked out if something isn't already known
+        situation_masks = None
+        result = {}
+        for id, mask in masks.iteritems():
+            faces = [(card, bit) for card, bit in FACE_BITS if mask & bit]
+            counts = tuple([unseen[card] for card, bit in faces])
+            key = (mask, counts) + state
+            chances = self.table.get(key)
+            if chances is None:
+                if situation_masks is None:
+                    the_discardable_mask = discardable_mask(game)
+                    situation_masks = (playable_mask(game), the_discardable_mask, critical_mask(game, the_discardable_mask))
+                total = float(sum(counts))
+                if total:
+                    chances = tuple([sum([n for (card, bit), n in zip(faces, counts) if bit & m]) / total
+                                     for m in situation_masks])
+                else:
+                    chances = (0.0, 0.0, 0.0)
+                self.table.put(key, chances)
+            result[id] = chances
+        return result
+
+# Used by the games that aren't given a "probability_engine" argument,
+# and shared by every one of them played in this process so situations
+# seen in one game are known in the next
+PROBABILITIES = ProbabilityEngine()
 
 def play_move(game, current_player, memory, user_args):
     hand = game["players"][current_player]
@@ -277,8 +705,15 @@ def play_move(game, current_player, memory, user_args):
     # be and the possible cards that other players could have from my
     # perspective (i.e. I can't see my hand)
     #
-    # Easier to build this each turn instead of keeping it in memory.
-    all_hands = build_possible_hands(game, game["current_player"])
+    # It is kept up to date in memory, unless there is no memory
+    # (e.g. when simulating) in which case it is built from scratch.
+    if memory is None:
+        all_hands = build_possible_hands(game, game["current_player"])
+        tracker = None
+    else:
+        tracker = get_from(memory, "knowledge", lambda: KnowledgeTracker(current_player))
+        tracker.update(game)
+        all_hands = tracker.possible_hands()
 
     my_hand = all_hands[current_player]
 
@@ -286,27 +721,27 @@ def play_move(game, current_player, memory, user_args):
     clue_algorithm = get_from(user_args, "clue_algorithm", 0)
     discard_algorithm = get_from(user_args, "discard_algorithm", 0)
 
-    other_players_cards = list(chain.from_iterable([h for p, h in game["players"].iteritems() if p != current_player]))
-
     # Now we have worked out what cards I might have, let's see if any
     # are playable
     my_playable = {}
+    the_playable_mask = playable_mask(game)
     for id, possible_cards in my_hand.iteritems():
-        l = [c for c in possible_cards if playable(game, c)]
+        l = possible_cards & the_playable_mask
         # Keep a recording of how many are playable
         if l:
             my_playable[id] = (len(l), len(possible_cards), float(len(l)) / len(possible_cards), l)
 
     my_discardable = {}
+    the_discardable_mask = discardable_mask(game)
     for id, possible_cards in my_hand.iteritems():
-        l = [c for c in possible_cards if discardable(game, c)]
+        l = possible_cards & the_discardable_mask
         # Keep a recording of how many are discardable
         if l:
             my_discardable[id] = (len(l), len(possible_cards), float(len(l)) / len(possible_cards), l)
 
     # Find if any are a dead certain
     definitely_playable = [id for id, data in my_playable.iteritems() \
-                           if (data[0] == data[1]) or (id in cards_given_clue(game, current_player))]
+                           if (data[0] == data[1]) or was_given_clue(game, current_player, id)]
 
     definitely_discardable = [id for id, data in my_discardable.iteritems() if data[0] == data[1]]
 
@@ -365,36 +800,12 @@ def play_move(game, current_player, memory, user_args):
                 card = definitely_discardable[0]
             else:
                 if discard_algorithm == 1:
-                    # Calculate the least likely to be playable
-                    prob_playable = {}
-                    for id, values in my_playable.iteritems():
-                        # Initialise to starting probability
-                        prob_playable[id] = values[2]
-                        # The card in my hand might have multiple playable
-                        # possibilities
-                        for possible_card in values[3]:
-                            prob_playable[id] = prob_playable[id] * pow(0.9, hand_has(other_players_cards, possible_card))
-
-                    # Calculate the most likely to be discardable
-                    prob_discardable = {}
-                    for id, values in my_discardable.iteritems():
-                        # Initialise to starting probability
-                        prob_discardable[id] = values[2]
-                        # The card in my hand might have multiple discardable
-                        # possibilities
-                        for possible_card in values[3]:
-                            prob_discardable[id] = prob_discardable[id] * pow(0.9, hand_has(other_players_cards, possible_card))
-
-                    # Multiple them together
-                    total_probs = merge_dicts(prob_playable, prob_discardable, merge_fn = lambda x,y: x * y)
-
-                    # Then get the minimum
-                    total_probs_sorted = sorted(total_probs.iteritems(), key = itemgetter(1))
-
-                    if total_probs_sorted:
-                        card = total_probs_sorted[0][0]
-                    else:
-                        card = random.choice(hand)
+                    # Discard the card most likely to be discardable,
+                    # then least likely to be critical or playable
+                    engine = user_args.get("probability_engine", PROBABILITIES)
+                    unseen = tracker.unseen() if tracker is not None else unseen_counts(game, current_player)
+                    probabilities = engine.probabilities(game, dict([(id, p.mask) for id, p in my_hand.iteritems()]), unseen)
+                    card = max(probabilities.iteritems(), key = lambda x: (x[1][1], -x[1][2], -x[1][0]))[0]
                 else:
                     card = random.choice(hand)
 
@@ -404,13 +815,234 @@ def play_move(game, current_player, memory, user_args):
     # easier to debug
     return m
 
+def evaluate(game):
+    """Return how good the position of the `game' is for searching. This
+    is mostly the score, with the lives and clues left breaking ties,
+    and a lost game is worse than any game still going."""
+    if game["lives"] <= 0:
+        return score(game) - MAX_SCORE
+    return score(game) + LIFE_VALUE * game["lives"] + CLUE_VALUE * game["clues"]
+
+def search_over(game):
+    """Return whether the `game' has ended, as game_finished decides for
+    a real game, or been won."""
+    return game_finished(game, game["current_player"], game["final_player"]) or have_won(game)
+
+class SearchBudget(object):
+    """Limits a search to `time_limit' seconds and `max_nodes' moves
+    applied, either of which can be None for no limit."""
+    def __init__(self, time_limit = None, max_nodes = None):
+        self.time_limit = time_limit
+        self.max_nodes = max_nodes
+        self.start = time.time()
+        self.nodes = 0
+
+    def exhausted(self):
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            return True
+        return self.time_limit is not None and self.elapsed() >= self.time_limit
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def nodes_per_sec(self):
+        elapsed = self.elapsed()
+        return self.nodes / elapsed if elapsed > 0 else 0.0
+
+def beam_search(game, budget, beam_width = 8, max_depth = 30, values = None):
+    """Return the best move for the current player of the `game' found
+    by a beam search of `beam_width' positions per ply. The game is
+    walked with apply_move/undo_move and is left as it was. Stops at
+    `max_depth' plies or when the `budget' runs out, returning the first
+    move towards the best position of the deepest ply reached.
+
+    If `values' is given, the value of the best position reached from
+    each first move is appended to its list in it, keyed by move.
+    A first move dropped from the beam keeps the value from the last
+    ply it was in."""
+    best_values = {}
+    best_move = all_moves(game, game["current_player"])[0]
+    # Each position in the beam is the moves from the game to reach it
+    beam = [()]
+    for depth in xrange(max_depth):
+        children = []
+        for path in beam:
+            tokens = [apply_move(game, game["current_player"], m) for m in path]
+            if not search_over(game):
+                for move in all_moves(game, game["current_player"]):
+                    if budget.exhausted():
+                        break
+                    token = apply_move(game, game["current_player"], move)
+                    budget.nodes += 1
+                    children.append((evaluate(game), path + (move,)))
+                    undo_move(game, token)
+            for token in reversed(tokens):
+                undo_move(game, token)
+            if budget.exhausted():
+                break
+        if not children:
+            break
+        # Stable so that equal positions keep the order of all_moves
+        children.sort(key = itemgetter(0), reverse = True)
+        best_move = children[0][1][0]
+        beam = [path for value, path in children[0:beam_width]]
+        if values is not None:
+            ply_values = {}
+            for value, path in children:
+                ply_values.setdefault(path[0], value)
+            best_values.update(ply_values)
+        if budget.exhausted():
+            break
+    if values is not None:
+        for key, value in best_values.iteritems():
+            values[key].append(value)
+    return best_move
+
+class MCTSNode(object):
+    __slots__ = ("untried", "children", "visits", "total")
+
+    def __init__(self, moves):
+        self.untried = moves
+        self.children = []
+        self.visits = 0
+        self.total = 0.0
+
+    def ucb(self, parent_visits, exploration):
+        # Scale the values so the exploration constant works the same
+        # whatever the size of the scores
+        return (self.total / self.visits) / MAX_SCORE + \
+            exploration * math.sqrt(math.log(parent_visits) / self.visits)
+
+def mcts_search(game, budget, rng, exploration = 1.4, rollout_depth = 10, votes = None, max_depth = None):
+    """Return the best move for the current player of the `game' found
+    by Monte Carlo tree search, with random rollouts of `rollout_depth'
+    moves. Neither the tree nor the rollouts go more than `max_depth'
+    moves past the `game' if it is given. The game is walked with
+    apply_move/undo_move and is left as it was. Runs until the `budget'
+    runs out and returns the most visited move. The visits of each move
+    are added to `votes' if it is given, keyed by move."""
+    root = MCTSNode(all_moves(game, game["current_player"]))
+    first_move = root.untried[0]
+    while not budget.exhausted():
+        node = root
+        path = [root]
+        tokens = []
+        # Selection
+        while not node.untried and node.children:
+            move, node = max(node.children, key = lambda c: c[1].ucb(path[-1].visits, exploration))
+            tokens.append(apply_move(game, game["current_player"], move))
+            path.append(node)
+        # Expansion
+        if node.untried:
+            move = node.untried.pop(rng.randrange(len(node.untried)))
+            tokens.append(apply_move(game, game["current_player"], move))
+            # A node at the depth limit is a leaf, like the end of the game
+            at_limit = max_depth is not None and len(tokens) >= max_depth
+            child = MCTSNode([] if at_limit or search_over(game) else all_moves(game, game["current_player"]))
+            node.children.append((move, child))
+            path.append(child)
+        # Rollout
+        for i in xrange(rollout_depth if max_depth is None else min(rollout_depth, max_depth - len(tokens))):
+            if search_over(game):
+                break
+            tokens.append(apply_move(game, game["current_player"], rng.choice(all_moves(game, game["current_player"]))))
+        value = evaluate(game)
+        budget.nodes += len(tokens)
+        for token in reversed(tokens):
+            undo_move(game, token)
+        for node in path:
+            node.visits += 1
+            node.total += value
+    if votes is not None:
+        for move, child in root.children:
+            votes[move] += child.visits
+    if not root.children:
+        return first_move
+    return max(root.children, key = lambda c: c[1].visits)[0]
+
 def play_move_ai(game, current_player, memory, user_args):
-    my_viewer = ConsoleViewer()
+    """Search for a move. With an obfuscated game the search is run on
+    deals sampled from what the player knows and the move that does
+    best across them is made, by mean value for beam search and total
+    visits for MCTS. Otherwise the search sees the full game. The
+    `user_args' can set:
+
+      search: one of SEARCH_MODES, default "beam"
+      time_limit: seconds per move, default 1.0, None for no limit
+      max_nodes: moves applied per move, default None for no limit
+      beam_width: positions kept per ply for beam search
+      determinizations: deals to sample per move, default 8
+      verbose: print the search rate for each move
+
+    The number of nodes, deals and seconds searched are totalled in
+    `memory'.
+    """
+    start = time.time()
+    time_limit = get_from(user_args, "time_limit", 1.0)
+    max_nodes = get_from(user_args, "max_nodes", None)
+    rng = random.Random(random.getrandbits(32))
+    mcts = get_from(user_args, "search", "beam") == "mcts"
+
+    # The one copy of the game, the search walks it in place
+    hidden = isinstance(game["players"][current_player][0], int)
+    if hidden:
+        tracker = get_from(memory, "knowledge", lambda: KnowledgeTracker(current_player))
+        tracker.update(game)
+        sampler = DealSampler(game, current_player, tracker.own_hand_constraints(), tracker.unseen())
+        num_deals = get_from(user_args, "determinizations", 8)
+        # Searching past the player's next turn would let them act on
+        # the sampled hand as if they knew it
+        max_depth = len(game["players"])
+    else:
+        num_deals = 1
+        max_depth = 30
+    game = deepcopy(game)
+
+    moves = all_moves(game, current_player)
+    # For each move, how many times MCTS visited it or the values beam
+    # search found for it in each deal
+    votes = dict([(m, 0) for m in moves])
+    values = dict([(m, []) for m in moves])
+    nodes = 0
+    for i in xrange(num_deals):
+        if hidden:
+            sampler.determinize(game, rng)
+        # Share what is left of the budget between the deals left
+        budget = SearchBudget(None if time_limit is None else (time_limit - (time.time() - start)) / (num_deals - i),
+                              None if max_nodes is None else (max_nodes - nodes) // (num_deals - i))
+        if mcts:
+            mcts_search(game, budget, rng, votes = votes, max_depth = max_depth)
+        else:
+            beam_search(game, budget, get_from(user_args, "beam_width", 8), max_depth, values = values)
+        nodes += budget.nodes
+    if not mcts:
+        # Moves the budget didn't reach in any deal come last
+        for key, l in values.iteritems():
+            votes[key] = float(sum(l)) / len(l) if l else float("-inf")
+    # Ties go to the move first in all_moves
+    move = max(moves, key = lambda m: votes[m])
+
+    elapsed = time.time() - start
+    stats = get_from(memory, "search_stats", lambda: {"nodes": 0, "deals": 0, "seconds": 0.0})
+    stats["nodes"] += nodes
+    stats["deals"] += num_deals
+    stats["seconds"] += elapsed
+    if user_args.get("verbose"):
+        print "P%d searched %d nodes over %d deals in %.3fs (%.0f nodes/sec)" % \
+            (current_player, nodes, num_deals, elapsed, nodes / elapsed if elapsed > 0 else 0.0)
+
+    return {"type": move[0], "data": move[1]}
+
+def play_move_bfs(game, current_player, memory, user_args):
+    """The original breadth first search over HanabiProblem, which only
+    prints what it finds."""
     my_problem = HanabiProblem(game)
-    result = breadth_first(my_problem, viewer=my_viewer)
-    #result = breadth_first(my_problem)
-    print result.state
-    print print_game(result.game_states[result.state], -1, True)
+    result = bounded_breadth_first(my_problem, user_args.get("max_nodes"))
+    if result is None:
+        print "No win found"
+        return
+    print result.state.key
+    print_game(result.state.game, -1, True)
     print result.path()
 
 
@@ -430,10 +1062,76 @@ if __name__ == "__main__":
                         help = "How many players.")
     parser.add_argument("-r", action = "store_true",
                         help = "Re-run from the previous random seed.")
+    parser.add_argument("-w", "--workers", type = int, default = 1,
+                        help = "How many processes to play the games across.")
+    parser.add_argument("--search", type = str, choices = SEARCH_MODES, default = "beam",
+                        help = "Which search the ai move function uses.")
+    parser.add_argument("--time-limit", type = float, default = 1.0,
+                        help = "Seconds the ai move function can search for each move.")
+    parser.add_argument("--max-nodes", type = int, default = None,
+                        help = "Nodes the ai move function can search for each move.")
+    parser.add_argument("--determinizations", type = int, default = 8,
+                        help = "Deals the ai move function samples for each move.")
+    parser.add_argument("-v", "--verbose", action = "store_true",
+                        help = "Print how fast the ai move function searches.")
+    parser.add_argument("--record", type = str, default = None,
+                        help = "Append a record of every game played to this file.")
+    parser.add_argument("--replay-game", type = int, default = None,
+                        help = "Play again just this game number of the previous run and print it. "
+                        "Uses the first of the clue and discard algorithms.")
+    parser.add_argument("--move-time-limit", type = float, default = None,
+                        help = "Seconds a player has for each move before a random move is made for them.")
+    parser.add_argument("--game-time-limit", type = float, default = None,
+                        help = "Seconds a player has for all their moves in a game before random moves are made for them.")
+    parser.add_argument("--on-invalid", type = str, choices = INVALID_MOVE_ACTIONS, default = "abort",
+                        help = "What to do when a move is invalid: stop, forfeit the game or make a random move instead.")
+    parser.add_argument("--profile", action = "store_true",
+                        help = "Time each phase of the turns and print a summary after the stats.")
+    parser.add_argument("--cprofile-every", type = int, default = 0,
+                        help = "With --profile, also run one in this many games under cProfile.")
+    parser.add_argument("--deals", type = str, default = None,
+                        help = "Take the decks from this deal pool, see hanabi_deals.")
+    parser.add_argument("--progress", type = int, default = 0,
+                        help = "Print the stats so far every this many games.")
     args = parser.parse_args()
 
     if args.f == "ai":
-        play(args.n, args.p, play_move_ai, {}, load_state = args.r, obfuscate_game = False)
+        move_func = play_move_ai
+        move_func_args = {"search": args.search, "time_limit": args.time_limit,
+                          "max_nodes": args.max_nodes, "determinizations": args.determinizations,
+                          "verbose": args.verbose}
+    else:
+        move_func = play_move
+        move_func_args = {"clue_algorithm": max(args.clue_algorithm, 0),
+                          "discard_algorithm": max(args.discard_algorithm, 0)}
+
+    if args.replay_game is not None:
+        g = replay_game(load_master_seed(), args.replay_game, args.p, move_func, move_func_args)
+        print_game(g, -1, True)
+        print_moves(g["moves"])
+        sys.exit()
+
+    if args.move_time_limit is not None or args.game_time_limit is not None:
+        time_budget = TimeBudget(args.move_time_limit, args.game_time_limit)
+    else:
+        time_budget = None
+
+    if args.record:
+        from hanabi_record import RecordWriter
+        writer = RecordWriter(args.record)
+    else:
+        writer = None
+
+    if args.deals:
+        from hanabi_deals import DealPool
+        deals = DealPool(args.deals)
+    else:
+        deals = None
+
+    if args.f == "ai":
+        play(args.n, args.p, play_move_ai, move_func_args, load_state = args.r, workers = args.workers, record = writer,
+             profile = GameProfile(args.cprofile_every) if args.profile else None, time_budget = time_budget,
+             error_policy = InvalidMovePolicy(args.on_invalid), keep_stats = False, progress_every = args.progress, deals = deals)
     else:
         if args.clue_algorithm == -1:
             clue_algorithms_to_run = range(NUM_CLUE_ALGORITHMS)
@@ -445,9 +1143,26 @@ if __name__ == "__main__":
         else:
             discard_algorithms_to_run = [args.discard_algorithm]
 
-        # Iterate the algorithms to compare
+        # Iterate the algorithms to compare. After the first they all
+        # load its master seed so they play the same deals, see
+        # hanabi_sweep for comparing them across seeds and player counts
+        load_state = args.r
         for ca in clue_algorithms_to_run:
             for da in discard_algorithms_to_run:
                 print "For clue algorithm %0d and discard algorithm %0d:" % (ca, da)
-                play(args.n, args.p, play_move, {"clue_algorithm": ca, "discard_algorithm": da}, load_state = args.r)
+                # A new engine for each run so one run's cache isn't kept
+                # through the next. The workers of a parallel run are
+                # each sent an empty copy, so it is only counted serially
+                engine = ProbabilityEngine()
+                play(args.n, args.p, play_move, {"clue_algorithm": ca, "discard_algorithm": da, "probability_engine": engine},
+                     load_state = load_state, workers = args.workers, record = writer,
+                     profile = GameProfile(args.cprofile_every) if args.profile else None,
+                     time_budget = None if time_budget is None else time_budget.copy(),
+                     error_policy = InvalidMovePolicy(args.on_invalid), keep_stats = False, progress_every = args.progress, deals = deals)
+                if engine.table.hits or engine.table.misses:
+                    engine.print_summary()
+                load_state = True
                 print "-" * 80
+
+    if writer is not None:
+        writer.close()
@@ -1,6 +1,206 @@
 import unittest
+import random
+from copy import deepcopy
+from collections import defaultdict
 from hanabi import *
-from hanabi_dgraham import build_possible_hands
+from hanabi_dgraham import *
+
+def checked_play_move(game, current_player, memory, user_args):
+    """play_move, checking the tracker against build_possible_hands
+    every turn."""
+    move = play_move(game, current_player, memory, user_args)
+    user_args["test"].assertEqual(memory["knowledge"].possible_hands(),
+                                  build_possible_hands(game, current_player))
+    return move
 
 class BuildPossibleHandsTest(unittest.TestCase):
-    pass
+
+    def testTrackerMatches(self):
+        random.seed(0)
+        for num_players in HAND_COUNT.keys():
+            play_move_per_player = check_play_move_funcs(num_players, checked_play_move)
+            for ca in xrange(4):
+                args = {"test": self, "clue_algorithm": ca, "discard_algorithm": 1}
+                play_one_game(num_players, play_move_per_player, args)
+
+class PossibilitySetTest(unittest.TestCase):
+
+    def testActsLikeList(self):
+        cards = PossibilitySet()
+        self.assertEqual(cards, FULL_SET)
+        cards.remove(("Blue", 1))
+        self.assertFalse(("Blue", 1) in cards)
+        self.assertEqual(len(cards), len(FULL_SET) - 1)
+        reds = cards & CLUE_MASKS["Red"]
+        self.assertEqual(reds, [("Red", v) for v in VALUES])
+        self.assertEqual(cards.count(CLUE_MASKS[1]), len(COLOURS) - 1)
+
+class HanabiProblemTest(unittest.TestCase):
+
+    def testRepeatedPositionsShared(self):
+        random.seed(0)
+        game = create_new_game(3)
+        game["current_player"] = 0
+        problem = HanabiProblem(game, table_size = 10)
+        # Giving the same two clues in either order reaches the same
+        # position
+        card = game["players"][2][0]
+        a = {"type": "clue", "data": (2, card[0])}
+        b = {"type": "clue", "data": (2, card[1])}
+        s1 = problem.result(problem.result(problem.initial_state, dict(a)), dict(b))
+        s2 = problem.result(problem.result(problem.initial_state, dict(b)), dict(a))
+        self.assertTrue(s1 is s2)
+        self.assertEqual(game_key(s1.game), game_key(deepcopy(s1.game)))
+
+    def testTableBounded(self):
+        table = TranspositionTable(2)
+        for i in xrange(5):
+            table.put(i, str(i))
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.evictions, 3)
+        self.assertEqual(table.get(0), None)
+        self.assertEqual(table.get(4), "4")
+
+    def testSearchMemoryBounded(self):
+        random.seed(0)
+        game = create_new_game(3)
+        game["current_player"] = 0
+        problem = HanabiProblem(game, table_size = 50)
+        self.assertEqual(bounded_breadth_first(problem, max_nodes = 200), None)
+        # Far more positions were seen than the table holds
+        self.assertTrue(problem.table.evictions > 50)
+        self.assertEqual(len(problem.table), 50)
+
+def checked_sampler_play_move(game, current_player, memory, user_args):
+    """play_move, checking deals sampled for the player fit the game."""
+    move = play_move(game, current_player, memory, user_args)
+    test, g = user_args["test"], user_args["game"]
+    tracker = memory["knowledge"]
+    constraints = tracker.own_hand_constraints()
+    # The real hand always fits
+    for card in g["players"][current_player]:
+        test.assertTrue(FACE_BIT[card[0:2]] & constraints[card[2]])
+    sampler = DealSampler(game, current_player, constraints, tracker.unseen())
+    hidden = sorted([c[0:2] for c in chain(g["players"][current_player], g["deck"])])
+    for i in xrange(20):
+        (hand, deck) = sampler.sample(user_args["rng"])
+        test.assertEqual([c[2] for c in hand], [c[2] for c in g["players"][current_player]])
+        test.assertEqual(len(deck), g["deck_len"])
+        test.assertEqual(sorted([c[0:2] for c in chain(hand, deck)]), hidden)
+        ids = [c[2] for c in chain(hand, deck, g["played"], g["discarded"],
+                                   *[h for p, h in g["players"].iteritems() if p != current_player])]
+        test.assertEqual(sorted(ids), range(DECK_SIZE))
+        for card in hand:
+            test.assertTrue(FACE_BIT[card[0:2]] & constraints[card[2]])
+            for n, from_player, clue in clues_for_card(g, current_player, card[2]):
+                test.assertTrue(clue in card[0:2])
+    return move
+
+class DealSamplerTest(unittest.TestCase):
+
+    def testDealsFitGame(self):
+        random.seed(0)
+        rng = random.Random(0)
+        for num_players in HAND_COUNT.keys():
+            g = create_new_game(num_players)
+            g["current_player"] = 0
+            memories = dict([(p, {}) for p in g["players"]])
+            args = {"test": self, "game": g, "rng": rng}
+            while not game_finished(g, g["current_player"], None) and g["deck_len"] > 0:
+                cp = g["current_player"]
+                move = checked_sampler_play_move(GameView(g, cp, True), cp, memories[cp], args)
+                apply_move(g, cp, move)
+
+class ProbabilityEngineTest(unittest.TestCase):
+
+    def testExactAndCached(self):
+        random.seed(0)
+        engine = ProbabilityEngine(max_size = 1000)
+        args = {"clue_algorithm": 1, "discard_algorithm": 1, "probability_engine": engine}
+        play_move_per_player = check_play_move_funcs(3, play_move)
+        g = play_one_game(3, play_move_per_player, args)
+        self.assertTrue(engine.table.misses > 0)
+        unseen = unseen_counts(g, 0)
+        # Every unseen copy of the cards a card could be is as likely
+        masks = {0: ALL_FACES, 1: CLUE_MASKS["Red"], 2: CLUE_MASKS[5] & CLUE_MASKS["Blue"], 3: 0}
+        for id, chances in engine.probabilities(g, masks, unseen).iteritems():
+            copies = [(card, unseen[card]) for card in mask_to_list(masks[id])]
+            total = float(sum([n for card, n in copies]))
+            expected = [sum([n for card, n in copies if test(card)]) / total if total else 0.0
+                        for test in (lambda card: playable(g, card), lambda card: discardable(g, card),
+                                     lambda card: FACE_BIT[card] & critical_mask(g))]
+            for p, e in zip(chances, expected):
+                self.assertAlmostEqual(p, e)
+        hits = engine.table.hits
+        engine.probabilities(g, masks, unseen)
+        self.assertEqual(engine.table.hits, hits + len(masks))
+
+    def testUnseenAndMasksMatch(self):
+        random.seed(0)
+        g = create_new_game(4)
+        g["current_player"] = 0
+        tracker = KnowledgeTracker(0)
+        while not game_finished(g, g["current_player"], None):
+            cp = g["current_player"]
+            tracker.update(GameView(g, 0, True))
+            self.assertEqual(unseen_counts(g, 0), tracker.unseen())
+            self.assertEqual(discardable_mask(g), faces_mask([card for card in FULL_SET if discardable(g, card)]))
+            apply_move(g, cp, play_move_random(GameView(g, cp, True), cp, {}, {}))
+
+class SearchTest(unittest.TestCase):
+
+    def testSearchPlaysWholeGame(self):
+        for mode in SEARCH_MODES:
+            for obfuscate_game in (False, True):
+                random.seed(0)
+                play_move_per_player = check_play_move_funcs(3, play_move_ai)
+                args = {"search": mode, "time_limit": None, "max_nodes": 200, "determinizations": 4}
+                g = play_one_game(3, play_move_per_player, args, obfuscate_game = obfuscate_game)
+                self.assertTrue(game_finished(g, g["current_player"], None) or g["deck_len"] == 0)
+
+    def testMctsDepthLimit(self):
+        random.seed(0)
+        g = create_new_game(3)
+        g["current_player"] = 0
+        for max_depth, one_move_each in ((1, True), (None, False)):
+            votes = defaultdict(int)
+            budget = SearchBudget(max_nodes = 100)
+            mcts_search(g, budget, random.Random(0), votes = votes, max_depth = max_depth)
+            # Each search of the tree applies one move when limited to one
+            self.assertEqual(sum(votes.values()) == budget.nodes, one_move_each)
+
+    def testSearchStopsAtFinalRound(self):
+        random.seed(0)
+        g = create_new_game(3)
+        g["current_player"] = 0
+        # Discard until the current player has the last turn of the game
+        while g["final_player"] is None or (g["current_player"] + 1) % 3 != g["final_player"]:
+            cp = g["current_player"]
+            apply_move(g, cp, ("discard", g["players"][cp][0][2]))
+        self.assertFalse(search_over(g))
+        # Only the current player's moves are searched
+        budget = SearchBudget(max_nodes = 1000)
+        beam_search(g, budget, max_depth = 5)
+        self.assertEqual(budget.nodes, len(all_moves(g, g["current_player"])))
+        votes = defaultdict(int)
+        budget = SearchBudget(max_nodes = 100)
+        mcts_search(g, budget, random.Random(0), votes = votes)
+        self.assertEqual(sum(votes.values()), budget.nodes)
+        token = apply_move(g, g["current_player"], all_moves(g, g["current_player"])[0])
+        self.assertTrue(search_over(g))
+        undo_move(g, token)
+        self.assertFalse(search_over(g))
+
+    def testOutOfBudgetStillMoves(self):
+        random.seed(0)
+        g = create_new_game(3)
+        g["current_player"] = 0
+        before = deepcopy(g)
+        for search in (lambda: beam_search(g, SearchBudget(max_nodes = 0)),
+                       lambda: mcts_search(g, SearchBudget(max_nodes = 0), random.Random(0))):
+            (move_type, data) = search()
+            self.assertTrue(valid_move(g, 0, {"type": move_type, "data": data})[0])
+            self.assertEqual(g, before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import zlib
+import struct
+from hanabi import *
+
+# A record file is a run of chunks, each the number of games in it and
+# the length of the data, then the zlib compressed game records one
+# after another (see encode_record). Chunks are only ever appended, so a
+# file can be added to by later runs.
+CHUNK_HEADER = struct.Struct("<II")
+
+class RecordWriter(object):
+    """Appends game records to the file `filename' as they are written,
+    compressing every `games_per_chunk' games as a chunk. Only the games
+    of the current chunk are held in memory. Pass it as the `record'
+    argument of `play' to archive every game played.
+
+    Use it in a with statement, or call `close', so the last chunk is
+    written."""
+    def __init__(self, filename, games_per_chunk = 1024, level = 6):
+        self.fh = open(filename, "ab")
+        self.games_per_chunk = games_per_chunk
+        self.level = level
+        self.records = []
+        self.num_games = 0
+
+    def write(self, record):
+        self.records.append(record)
+        self.num_games += 1
+        if len(self.records) >= self.games_per_chunk:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            data = zlib.compress("".join(self.records), self.level)
+            self.fh.write(CHUNK_HEADER.pack(len(self.records), len(data)))
+            self.fh.write(data)
+            self.records = []
+        self.fh.flush()
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_records(filename):
+    """Yield each game record in the file `filename' in the order they
+    were written, one chunk in memory at a time. See decode_record for
+    what a record holds."""
+    with open(filename, "rb") as fh:
+        while True:
+            header = fh.read(CHUNK_HEADER.size)
+            if not header:
+                break
+            (num_games, length) = CHUNK_HEADER.unpack(header)
+            data = zlib.decompress(fh.read(length))
+            offset = 0
+            for i in xrange(num_games):
+                (record, offset) = decode_record(data, offset)
+                yield record
+
+def replay_record(record, num_moves = None):
+    """Return the game of the `record' played back through the engine
+    from the deal, stopping after `num_moves' moves if given, e.g. to
+    get the game as it was for the invalid move of an
+    InvalidMoveError. A forfeited game is lost after its last move, as
+    in play_one_turn. Raises ValueError if a move is not valid, e.g. the
+    record doesn't belong to this version of the game."""
+    g = create_new_game(record["num_players"], record["deck"])
+    # Always played from player 0 in ascending order, see play_one_game
+    g["current_player"] = 0
+    for move in record["moves"][0:num_moves]:
+        (is_valid_move, error_str) = valid_move(g, g["current_player"], move)
+        if not is_valid_move:
+            raise ValueError("move %d %s is not valid because '%s'" % (len(g["moves"]), move, error_str))
+        # A copy, as apply_move adds the card IDs to a clue
+        apply_move(g, g["current_player"], dict(move))
+    if record.get("forfeited") and num_moves is None:
+        g["lives"] = 0
+        g["forfeited"] = True
+    return g
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Replay the games in a record file.")
+    parser.add_argument("filename", help = "The record file to read.")
+    parser.add_argument("--print-games", action = "store_true",
+                        help = "Print each game as it ends.")
+    args = parser.parse_args()
+
+    num_games = 0
+    total_score = 0
+    for record in read_records(args.filename):
+        g = replay_record(record)
+        num_games += 1
+        total_score += score(g)
+        if args.print_games:
+            print "Game with seed %d:" % record["seed"]
+            print_game(g, -1, True)
+    print "Replayed %d game%s, mean score %.2f" % (num_games, ("s" if num_games != 1 else ""),
+                                                   float(total_score) / num_games if num_games else 0.0)
@@ -0,0 +1,78 @@
+import unittest
+import os
+import random
+import tempfile
+from hanabi import *
+from hanabi_record import *
+from hanabi_test import SeedFileTest
+
+class RecordTest(SeedFileTest):
+
+    def setUp(self):
+        SeedFileTest.setUp(self)
+        (fd, self.filename) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        SeedFileTest.tearDown(self)
+
+    def testReplaySameStats(self):
+        random.seed(0)
+        with RecordWriter(self.filename, games_per_chunk = 3) as writer:
+            stats = play(10, 3, play_move_random, record = writer)
+        records = list(read_records(self.filename))
+        replayed = [game_stats(replay_record(r)) for r in records]
+        self.assertEqual(replayed, stats)
+        # The records aren't changed by replaying them
+        self.assertEqual(records, list(read_records(self.filename)))
+
+    def testSameRecordsForAnyWorkerCount(self):
+        random.seed(0)
+        with RecordWriter(self.filename) as writer:
+            play(12, 4, play_move_random, record = writer)
+        random.seed(0)
+        with RecordWriter(self.filename) as writer:
+            play(12, 4, play_move_random, workers = 3, record = writer)
+        records = list(read_records(self.filename))
+        self.assertEqual(records[0:12], records[12:])
+
+    def testReplayInvalidMove(self):
+        def bad_move(game, current_player, memory, user_args):
+            if len(game["moves"]) == 7:
+                return {"type": "clue", "data": (current_player, "Red")}
+            return play_move_random(game, current_player, memory, user_args)
+
+        random.seed(0)
+        policy = InvalidMovePolicy("substitute")
+        play(2, 3, bad_move, error_policy = policy)
+        for error in policy.errors:
+            g = replay_record(decode_record(error["record"])[0], error["move_number"])
+            self.assertEqual(len(g["moves"]), 7)
+            self.assertFalse(valid_move(g, error["player"], eval(error["move"]))[0])
+
+    def testReplayForfeit(self):
+        def bad_move(game, current_player, memory, user_args):
+            if len(game["moves"]) == 7:
+                return {"type": "play", "data": 99}
+            return play_move_random(game, current_player, memory, user_args)
+
+        random.seed(0)
+        policy = InvalidMovePolicy("forfeit")
+        with RecordWriter(self.filename) as writer:
+            stats = play(3, 3, bad_move, record = writer, error_policy = policy)
+        records = list(read_records(self.filename))
+        self.assertTrue(all([r["forfeited"] for r in records]))
+        self.assertEqual(decode_record(policy.errors[0]["record"])[0], records[0])
+        self.assertEqual([game_stats(replay_record(r)) for r in records], stats)
+        # Up to the invalid move the game is still going
+        self.assertTrue(replay_record(records[0], 7)["lives"] > 0)
+
+    def testMovesRoundTrip(self):
+        g = create_new_game(5)
+        for move in [{"type": "clue", "data": (pid, clue)} for pid in g["players"] for clue in CLUES] + \
+                    [{"type": t, "data": id} for t in ("discard", "play") for id in xrange(DECK_SIZE)]:
+            self.assertEqual(unpack_move(pack_move(move)), move)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import os
+import random
+import multiprocessing
+import cPickle as pickle
+from tabulate import tabulate
+from hanabi import *
+import hanabi_dgraham
+
+# A sweep plays hanabi_dgraham.play_move with every combination of clue
+# and discard algorithm, for each number of players and master seed.
+# Each of those is a cell:
+#
+#   cell = (clue_algorithm, discard_algorithm, num_players, master_seed)
+#
+# and the games of a cell are dealt from its master seed (see
+# game_seed), so every combination of algorithms plays the same deals
+# and they can be compared game by game. The cells are spread across a
+# process pool, and the stats of each cell are written to a cache
+# directory as it is done, so an interrupted sweep picks up where it
+# left off.
+DEFAULT_CACHE_DIR = "hanabi_sweep_cache"
+
+def sweep_cells(clue_algorithms, discard_algorithms, player_counts, seeds):
+    return [(ca, da, num_players, seed)
+            for num_players in player_counts
+            for seed in seeds
+            for ca in clue_algorithms
+            for da in discard_algorithms]
+
+def cell_filename(cache_dir, cell, num_games):
+    return os.path.join(cache_dir, "c%d-d%d-p%d-s%d-n%d.stats" % (cell + (num_games,)))
+
+def read_cell(cache_dir, cell, num_games):
+    """Return the cached stats of `cell', or None if it hasn't been
+    played."""
+    filename = cell_filename(cache_dir, cell, num_games)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as fh:
+        return pickle.load(fh)
+
+def write_cell(cache_dir, cell, num_games, stats):
+    # Written to a temporary file first, so a sweep interrupted part way
+    # through writing doesn't leave half a cell in the cache
+    filename = cell_filename(cache_dir, cell, num_games)
+    with open(filename + ".tmp", "wb") as fh:
+        pickle.dump(stats, fh, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + ".tmp", filename)
+
+def play_cell(cell, num_games):
+    """Play the `num_games' games of `cell' and return their stats."""
+    (ca, da, num_players, seed) = cell
+    play_move_per_player = check_play_move_funcs(num_players, hanabi_dgraham.play_move)
+    args = {"clue_algorithm": ca, "discard_algorithm": da}
+    # The games seed the global random module for the players, so it is
+    # put back afterwards as play() does
+    random_state = random.getstate()
+    try:
+        return play_games(0, num_games, seed, num_players, play_move_per_player, args, True, False)[0]
+    finally:
+        random.setstate(random_state)
+
+def _play_cell_worker(args):
+    (cell, num_games) = args
+    return (cell, play_cell(cell, num_games))
+
+def run_sweep(cells, num_games, workers = 1, cache_dir = None):
+    """Play `num_games' games for each of `cells' and return {cell:
+    stats}. Cells already in `cache_dir' are read from there rather than
+    played again, and the rest are added to it as they are done."""
+    results = {}
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for cell in cells:
+            stats = read_cell(cache_dir, cell, num_games)
+            if stats is not None:
+                results[cell] = stats
+    to_play = [(cell, num_games) for cell in cells if cell not in results]
+    print "%d of %d cells cached, playing %d" % (len(results), len(cells), len(to_play))
+
+    def done(cell, stats):
+        results[cell] = stats
+        if cache_dir is not None:
+            write_cell(cache_dir, cell, num_games, stats)
+        print "Clue algorithm %d, discard algorithm %d, %d players, seed %d: mean score %.2f (%d of %d cells)" % \
+            (cell + (float(sum([s[1] for s in stats])) / len(stats), len(results), len(cells)))
+
+    if workers > 1 and len(to_play) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for cell, stats in pool.imap_unordered(_play_cell_worker, to_play):
+                done(cell, stats)
+        except BaseException:
+            # Stop the cells still playing rather than waiting for them,
+            # those already done are in the cache
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        for args in to_play:
+            done(*_play_cell_worker(args))
+    return results
+
+def paired_difference(stats, baseline):
+    """Return a RunningStat of the differences in score between the games
+    in `stats' and the same games in `baseline'."""
+    difference = RunningStat()
+    for s, b in zip(stats, baseline):
+        difference.add(s[1] - b[1])
+    return difference
+
+def sweep_table(results, baseline = (0, 0)):
+    """Return the rows comparing the (clue algorithm, discard algorithm)
+    combinations in `results' for each number of players, over all the
+    seeds. The difference in score is paired by game against the
+    `baseline' combination with the same number of players."""
+    configs = {}
+    for (ca, da, num_players, seed), stats in results.iteritems():
+        configs.setdefault((num_players, ca, da), {})[seed] = stats
+
+    rows = []
+    for (num_players, ca, da) in sorted(configs):
+        by_seed = configs[(num_players, ca, da)]
+        aggregator = StatsAggregator()
+        for seed in sorted(by_seed):
+            for s in by_seed[seed]:
+                aggregator.add(s)
+        score = aggregator.score()
+        row = [num_players, ca, da, aggregator.num_games,
+               pct(aggregator.counts["won"], aggregator.num_games),
+               pct(aggregator.counts["lost"], aggregator.num_games),
+               score.mean, score.confidence()]
+        base = configs.get((num_players,) + baseline)
+        if base is not None and (ca, da) != baseline:
+            difference = RunningStat()
+            for seed in sorted(by_seed):
+                if seed in base:
+                    difference.merge(paired_difference(by_seed[seed], base[seed]))
+            row.extend([difference.mean, difference.confidence()])
+        else:
+            row.extend([None, None])
+        rows.append(row)
+    return rows
+
+SWEEP_HEADERS = ["Players", "Clue", "Discard", "Games", "Won %", "Lost %", "Score", "+/- 95%", "vs baseline", "+/- 95%"]
+
+def print_sweep_table(results, baseline = (0, 0)):
+    print "Scores over all seeds, differences paired by game against clue algorithm %d, discard algorithm %d:" % baseline
+    print tabulate(sweep_table(results, baseline), headers = SWEEP_HEADERS, floatfmt = ".2f", missingval = "-")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Compare the clue and discard algorithms of hanabi_dgraham on the same deals.")
+    parser.add_argument("-n", type = int, default = 100,
+                        help = "How many games to play for each cell.")
+    parser.add_argument("-p", type = int, nargs = "+", default = sorted(HAND_COUNT.keys()), choices = sorted(HAND_COUNT.keys()),
+                        help = "The numbers of players.")
+    parser.add_argument("--clue-algorithms", type = int, nargs = "+", default = range(hanabi_dgraham.NUM_CLUE_ALGORITHMS),
+                        help = "The clue algorithms to compare.")
+    parser.add_argument("--discard-algorithms", type = int, nargs = "+", default = range(hanabi_dgraham.NUM_DISCARD_ALGORITHMS),
+                        help = "The discard algorithms to compare.")
+    parser.add_argument("--seeds", type = int, default = 1,
+                        help = "How many master seeds to deal the games of each cell from.")
+    parser.add_argument("--first-seed", type = int, default = 0,
+                        help = "The first master seed, the others follow on from it.")
+    parser.add_argument("--baseline", type = int, nargs = 2, default = [0, 0],
+                        help = "The clue and discard algorithm the others are compared against.")
+    parser.add_argument("-w", "--workers", type = int, default = multiprocessing.cpu_count(),
+                        help = "How many processes to play the cells in.")
+    parser.add_argument("--cache", type = str, default = DEFAULT_CACHE_DIR,
+                        help = "The directory to cache the stats of each cell in.")
+    parser.add_argument("--no-cache", action = "store_true",
+                        help = "Play every cell, without reading or writing the cache.")
+    args = parser.parse_args()
+
+    cells = sweep_cells(args.clue_algorithms, args.discard_algorithms, args.p,
+                        range(args.first_seed, args.first_seed + args.seeds))
+    results = run_sweep(cells, args.n, args.workers, None if args.no_cache else args.cache)
+    print
+    print_sweep_table(results, tuple(args.baseline))
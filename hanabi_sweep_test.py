@@ -0,0 +1,51 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from hanabi_sweep import *
+
+class SweepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def testCellsPlaySameDeals(self):
+        cells = sweep_cells([0, 1], [1], [3], [7])
+        results = run_sweep(cells, 4, workers = 2, cache_dir = self.cache_dir)
+        self.assertEqual(sorted(results), sorted(cells))
+        for cell in cells:
+            self.assertEqual(results[cell], play_cell(cell, 4))
+            self.assertEqual(read_cell(self.cache_dir, cell, 4), results[cell])
+        # Each game is the deal its master seed gives it
+        g = replay_game(7, 2, 3, hanabi_dgraham.play_move, {"clue_algorithm": 1, "discard_algorithm": 1})
+        self.assertEqual(game_stats(g), results[(1, 1, 3, 7)][2])
+        rows = sweep_table(results, (0, 1))
+        self.assertEqual([row[:4] for row in rows], [[3, 0, 1, 4], [3, 1, 1, 4]])
+        self.assertEqual(rows[0][8], None)
+        difference = paired_difference(results[(1, 1, 3, 7)], results[(0, 1, 3, 7)])
+        self.assertAlmostEqual(rows[1][8], rows[1][6] - rows[0][6])
+        self.assertAlmostEqual(rows[1][8], difference.mean)
+
+    def testResumesFromCache(self):
+        cells = sweep_cells([0], [0, 1], [2], [0])
+        # A cell already in the cache isn't played again
+        cached = [(True, 25, 10, 0, 3)]
+        write_cell(self.cache_dir, cells[0], 1, cached)
+        results = run_sweep(cells, 1, cache_dir = self.cache_dir)
+        self.assertEqual(results[cells[0]], cached)
+        self.assertEqual(results[cells[1]], play_cell(cells[1], 1))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted([os.path.basename(cell_filename(self.cache_dir, cell, 1)) for cell in cells]))
+
+    def testRandomStateKept(self):
+        random.seed(0)
+        state = random.getstate()
+        run_sweep(sweep_cells([0], [0], [2], [0]), 2)
+        self.assertEqual(random.getstate(), state)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,32 @@
 import unittest
 from hanabi import *
+import hanabi
+import cPickle as pickle
+import sys
+import os
+import shutil
+import tempfile
 import random
+import time
+import operator
+from copy import deepcopy
+from StringIO import StringIO
 
-class PlayMoveTest(unittest.TestCase):
+class SeedFileTest(unittest.TestCase):
+    """For tests that call play(), which writes the master seed to
+    SEED_FILENAME. It is written to a temporary directory rather than
+    the current one."""
+
+    def setUp(self):
+        self.seed_dir = tempfile.mkdtemp()
+        self.seed_filename = hanabi.SEED_FILENAME
+        hanabi.SEED_FILENAME = os.path.join(self.seed_dir, "hanabi_seed.dat")
+
+    def tearDown(self):
+        hanabi.SEED_FILENAME = self.seed_filename
+        shutil.rmtree(self.seed_dir)
+
+class PlayMoveTest(SeedFileTest):
 
     #def setUp(self):
         
@@ -23,7 +47,346 @@ class PlayMoveTest(unittest.TestCase):
             return {"type": "discard", "data": random.choice(my_hand)}
 
 
+        with open(hanabi.SEED_FILENAME, "wb") as fh:
+            pickle.dump(1234, fh)
         play(1, 3, move, load_state = True)
 
+class ParallelPlayTest(SeedFileTest):
+
+    def testSameStatsForAnyWorkerCount(self):
+        random.seed(0)
+        serial = play(12, 3, play_move_random)
+        random.seed(0)
+        parallel = play(12, 3, play_move_random, workers = 3)
+        self.assertEqual(serial, parallel)
+
+    def testRandomStateIndependentOfWorkers(self):
+        next_numbers = []
+        for workers in (1, 2):
+            random.seed(0)
+            play(4, 3, play_move_random, workers = workers)
+            next_numbers.append(random.getrandbits(32))
+        self.assertEqual(next_numbers[0], next_numbers[1])
+
+class StatsAggregatorTest(SeedFileTest):
+
+    def testMatchesStatsList(self):
+        random.seed(0)
+        stats = play(40, 3, play_move_random)
+        aggregator = StatsAggregator()
+        for s in stats:
+            aggregator.add(s)
+        self.assertEqual(aggregator.num_games, 40)
+        for outcome in OUTCOMES:
+            group = [s for s in stats if game_outcome(s) == outcome]
+            self.assertEqual(aggregator.counts[outcome], len(group))
+            self.assertEqual(sum(aggregator.histograms[outcome]), len(group))
+            if group:
+                scores = [s[1] for s in group]
+                (low, mean, high) = aggregator.columns[outcome]["score"].mmm()
+                self.assertEqual((low, high), (min(scores), max(scores)))
+                self.assertAlmostEqual(mean, mmm(scores)[1])
+        scores = [s[1] for s in stats]
+        mean = float(sum(scores)) / len(scores)
+        variance = sum([(x - mean) ** 2 for x in scores]) / (len(scores) - 1)
+        self.assertAlmostEqual(aggregator.score().mean, mean)
+        self.assertAlmostEqual(aggregator.score().variance(), variance)
+
+    def testMergeAndWorkers(self):
+        random.seed(0)
+        serial = play(12, 3, play_move_random, keep_stats = False, progress_every = 5)
+        random.seed(0)
+        parallel = play(12, 3, play_move_random, workers = 2, keep_stats = False)
+        self.assertEqual(serial.counts, parallel.counts)
+        self.assertEqual(serial.histograms, parallel.histograms)
+        self.assertEqual(serial.score().mean, parallel.score().mean)
+        self.assertEqual(serial.score().variance(), parallel.score().variance())
+
+    def testSameSummaryForAnyWorkers(self):
+        summaries = []
+        for workers in (1, 2, 3):
+            random.seed(0)
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                play(30, 3, play_move_random, workers = workers)
+                summaries.append(sys.stdout.getvalue())
+            finally:
+                sys.stdout = stdout
+        self.assertEqual(summaries[1], summaries[0])
+        self.assertEqual(summaries[2], summaries[0])
+
+class ReplayGameTest(SeedFileTest):
+
+    def testReplayAnyGame(self):
+        random.seed(0)
+        stats = play(10, 3, play_move_random)
+        master_seed = load_master_seed()
+        for i in (9, 0, 4):
+            self.assertEqual(game_stats(replay_game(master_seed, i, 3, play_move_random)), stats[i])
+
+    def testDealsIndependentOfPlayers(self):
+        def greedy_move(game, current_player, memory, user_args):
+            # Uses a lot more random numbers than play_move_random
+            for i in xrange(100):
+                random.random()
+            return play_move_random(game, current_player, memory, user_args)
+
+        for move_func in (play_move_random, greedy_move):
+            play_move_per_player = check_play_move_funcs(3, move_func)
+            records = play_games(0, 3, 1234, 3, play_move_per_player, {}, True, False, True)[1]
+            decks = [decode_record(r)[0]["deck"] for r in records]
+            if move_func is play_move_random:
+                expected = decks
+            self.assertEqual(decks, expected)
+            self.assertEqual(decks[1], create_new_deck(random.Random(game_seed(1234, 1))))
+
+class GameProfileTest(SeedFileTest):
+
+    def testCountsEveryTurn(self):
+        for workers in (1, 2):
+            random.seed(0)
+            profile = GameProfile(profile_every = 3)
+            stats = play(6, 3, play_move_random, workers = workers, profile = profile)
+            turns = sum([s[2] for s in stats])
+            self.assertEqual(profile.games, 6)
+            self.assertEqual(profile.turns(), turns)
+            self.assertEqual(sum(profile.latency_counts), turns)
+            self.assertEqual(sorted(profile.player_turns), [0, 1, 2])
+            self.assertTrue(profile.profiled_games >= 2)
+            self.assertTrue(profile.profile_stats.total_calls > 0)
+
+    def testCountsForfeitedTurn(self):
+        random.seed(0)
+        profile = GameProfile()
+        stats = play(4, 3, bad_move, profile = profile, error_policy = InvalidMovePolicy("forfeit"))
+        # The move that forfeits each game is a turn too
+        self.assertEqual(profile.turns(), sum([s[2] for s in stats]) + 4)
+        self.assertEqual(profile.player_turns[1], 4)
+
+def slow_move(game, current_player, memory, user_args):
+    # Player 1 never finishes a move, the others take a little while
+    if current_player == 1:
+        while True:
+            pass
+    time.sleep(0.002)
+    return play_move_random(game, current_player, memory, user_args)
+
+def swallowing_move(game, current_player, memory, user_args):
+    # Player 1 tries to carry on whatever goes wrong
+    if current_player == 1:
+        while True:
+            try:
+                while True:
+                    pass
+            except Exception:
+                pass
+    return play_move_random(game, current_player, memory, user_args)
+
+class TimeBudgetTest(SeedFileTest):
+
+    def testFallbackForSlowMoves(self):
+        for workers in (1, 2):
+            random.seed(0)
+            # Well over the others' sleep, so they aren't counted as
+            # running over when the machine is busy
+            budget = TimeBudget(move_seconds = 0.03)
+            stats = play(4, 3, slow_move, workers = workers, time_budget = budget)
+            self.assertEqual(budget.turns, sum([s[2] for s in stats]))
+            # Only player 1's moves
+            self.assertEqual(budget.overruns, sum([(s[2] + 1) // 3 for s in stats]))
+            self.assertEqual(budget.games_over, 4)
+
+    def testNotSwallowedByStrategy(self):
+        random.seed(0)
+        budget = TimeBudget(move_seconds = 0.01)
+        stats = play(2, 3, swallowing_move, time_budget = budget)
+        self.assertEqual(budget.overruns, sum([(s[2] + 1) // 3 for s in stats]))
+
+    def testGameLimit(self):
+        random.seed(0)
+        budget = TimeBudget(game_seconds = 0.01)
+        play_move_per_player = check_play_move_funcs(3, slow_move)
+        g = play_one_game(3, play_move_per_player, {}, budget = budget)
+        # Players 0 and 2 run out of time after a few moves
+        self.assertTrue(budget.overruns > (len(g["moves"]) + 1) // 3)
+        self.assertTrue(budget.used[0] < 0.02)
+
+def bad_move(game, current_player, memory, user_args):
+    # Player 1 plays a card that isn't in their hand
+    if current_player == 1:
+        return {"type": "play", "data": 99}
+    return play_move_random(game, current_player, memory, user_args)
+
+def bad_first_game_move(game, current_player, memory, user_args):
+    # Player 0 makes an invalid move at the start of the game where player
+    # 1 holds the `bad_hand', the other games are slow
+    if current_player == 0 and game["players"][1] == user_args["bad_hand"]:
+        return {"type": "play", "data": 99}
+    time.sleep(0.02)
+    return play_move_random(game, current_player, memory, user_args)
+
+class InvalidMoveTest(SeedFileTest):
+
+    def testAbort(self):
+        for workers in (1, 2):
+            random.seed(0)
+            with self.assertRaises(InvalidMoveError) as cm:
+                play(4, 3, bad_move, workers = workers, error_policy = InvalidMovePolicy("abort"))
+            error = cm.exception
+            self.assertEqual((error.game_index, error.player, error.move_number), (0, 1, 1))
+            # The record has the moves up to the invalid one
+            self.assertEqual(len(decode_record(error.record)[0]["moves"]), error.move_number)
+
+    def testAbortDoesntWaitForOtherGames(self):
+        random.seed(0)
+        deck = create_new_deck(random.Random(game_seed(random.getrandbits(32), 0)))
+        random.seed(0)
+        start = time.time()
+        self.assertRaises(InvalidMoveError, play, 40, 3, bad_first_game_move, {"bad_hand": deck[5:10]}, workers = 2)
+        # The other games would take several times as long
+        self.assertTrue(time.time() - start < 3)
+
+    def testForfeit(self):
+        random.seed(0)
+        policy = InvalidMovePolicy("forfeit")
+        stats = play(4, 3, bad_move, workers = 2, error_policy = policy)
+        self.assertEqual(policy.games(), range(4))
+        self.assertTrue(all([not s[0] and s[2] == 1 for s in stats]))
+
+    def testSubstitute(self):
+        random.seed(0)
+        policy = InvalidMovePolicy("substitute")
+        stats = play(4, 3, bad_move, error_policy = policy)
+        # Every one of player 1's moves was replaced
+        self.assertEqual(len(policy.errors), sum([(s[2] + 1) // 3 for s in stats]))
+        error = policy.errors[-1]
+        self.assertEqual(error["player"], 1)
+        self.assertEqual(decode_record(error["record"])[0]["seed"] & 0xffffffff, error["game"])
+
+    def testBadMoveFuncs(self):
+        self.assertRaises(ValueError, check_play_move_funcs, 3, {"0": play_move_random})
+        self.assertRaises(ValueError, check_play_move_funcs, 3, 0)
+
+class FireworksTest(unittest.TestCase):
+
+    def testIndexMatchesPiles(self):
+        random.seed(0)
+        play_move_per_player = check_play_move_funcs(3, play_move_random)
+        for i in xrange(10):
+            g = play_one_game(3, play_move_per_player, {})
+            played = sort_by_colour(g["played"], True)
+            discarded = sort_by_colour(g["discarded"])
+            for c in COLOURS:
+                self.assertEqual(g["fireworks"][COLOUR_INDEX[c]], played[c][0] if c in played else 0)
+                for v in VALUES:
+                    self.assertEqual(discarded_count(g, (c, v)), discarded.get(c, []).count(v))
+                    self.assertEqual(played_count(g, (c, v)), hand_has(g["played"], (c, v)))
+
+class ClueIndexTest(unittest.TestCase):
+
+    def testIndexMatchesMoves(self):
+        random.seed(0)
+        play_move_per_player = check_play_move_funcs(3, play_move_random)
+        for i in xrange(10):
+            g = play_one_game(3, play_move_per_player, {})
+            for pid in g["players"]:
+                clues = [(n, from_player, m["data"]) for n, (from_player, m) in enumerate(g["moves"])
+                         if m["type"] == "clue" and m["data"][0] == pid]
+                given = list(chain.from_iterable([data[2] for n, from_player, data in clues]))
+                self.assertEqual(sorted(cards_given_clue(g, pid)), sorted(set(given)))
+                for card_id in given:
+                    self.assertTrue(was_given_clue(g, pid, card_id))
+                    self.assertEqual(clues_for_card(g, pid, card_id),
+                                     [(n, from_player, data[1]) for n, from_player, data in clues if card_id in data[2]])
+
+class UndoMoveTest(unittest.TestCase):
+
+    def testUndoRestoresGame(self):
+        random.seed(0)
+        for num_players in HAND_COUNT.keys():
+            g = create_new_game(num_players)
+            g["current_player"] = 0
+            while not game_finished(g, g["current_player"], None):
+                cp = g["current_player"]
+                move = play_move_random(GameView(g, cp, True), cp, {}, {})
+                self.assertTrue(valid_move(g, cp, move)[0])
+                before = deepcopy(g)
+                token = apply_move(g, cp, move)
+                after = deepcopy(g)
+                self.assertNotEqual(g, before)
+                undo_move(g, token)
+                self.assertEqual(g, before)
+                apply_move(g, cp, move)
+                self.assertEqual(g, after)
+
+class ClueTableTest(unittest.TestCase):
+
+    def testTablesMatchHands(self):
+        random.seed(0)
+        for num_players in HAND_COUNT.keys():
+            g = create_new_game(num_players)
+            g["current_player"] = 0
+            while not game_finished(g, g["current_player"], None):
+                cp = g["current_player"]
+                for pid, hand in g["players"].iteritems():
+                    table = dict([(clue, tuple(get_card_ids(hand, clue))) for clue in CLUES])
+                    self.assertEqual(g["clue_tables"][pid], dict([(k, v) for k, v in table.iteritems() if v]))
+                moves = legal_moves(g, cp)
+                self.assertEqual(len(set(moves)), len(moves))
+                for move_type, data in moves:
+                    self.assertTrue(valid_move(g, cp, {"type": move_type, "data": data})[0])
+                # Every clue valid_move allows is generated
+                clues = [(pid, clue) for pid in g["players"] if pid != cp for clue in CLUES
+                         if valid_move(g, cp, {"type": "clue", "data": (pid, clue)})[0]]
+                self.assertEqual(clues, [data for move_type, data in moves if move_type == "clue"])
+                apply_move(g, cp, random.choice(moves))
+
+class CompactCardTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        g = create_new_game(4)
+        cg = compact_game(g)
+        self.assertEqual(cg["deck"].typecode, COMPACT_TYPECODE)
+        g2 = expand_game(cg)
+        for key in ("deck", "played", "discarded", "players"):
+            self.assertEqual(g2[key], g[key])
+
+    def testPredicatesMatch(self):
+        deck = create_new_deck()
+        for i in xrange(0, len(deck), 5):
+            hand = deck[i:i + 5]
+            compact_hand = pack_cards(hand)
+            for c in COLOURS:
+                ci = COLOUR_INDEX[c]
+                self.assertEqual(compact_hand_has_colour(compact_hand, ci), hand_has_colour(hand, c))
+                self.assertEqual(compact_card_ids_for_colour(compact_hand, ci), get_card_ids_for_colour(hand, c))
+                for v in VALUES:
+                    self.assertEqual(compact_hand_has(compact_hand, pack_face(c, v)), hand_has(hand, (c, v)))
+            for v in VALUES:
+                self.assertEqual(compact_hand_has_value(compact_hand, v), hand_has_value(hand, v))
+                self.assertEqual(compact_card_ids_for_value(compact_hand, v), get_card_ids_for_value(hand, v))
+
+class GameViewTest(SeedFileTest):
+
+    def testViewIsReadOnly(self):
+        g = create_new_game(3)
+        view = GameView(g, 0, True)
+        self.assertEqual(view["players"][0], [c[2] for c in g["players"][0]])
+        self.assertEqual(view["players"][1], g["players"][1])
+        self.assertEqual(len(view["deck"]), 0)
+        self.assertFalse(0 in view["clue_tables"])
+        self.assertEqual(view["clue_tables"][1], g["clue_tables"][1])
+        self.assertRaises(TypeError, operator.setitem, view, "lives", 0)
+        self.assertRaises(AttributeError, getattr, view["players"][1], "append")
+        self.assertEqual(deepcopy(view)["players"][0], [c[2] for c in g["players"][0]])
+
+    def testSameStatsAsCopiedGame(self):
+        random.seed(0)
+        viewed = play(5, 3, play_move_random)
+        random.seed(0)
+        copied = play(5, 3, play_move_random, copy_game = True)
+        self.assertEqual(viewed, copied)
+
 if __name__ == '__main__':
     unittest.main()